@@ -0,0 +1,395 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import re
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+# local stand-ins for a ckan portal and for s3 plus the data.world api, for benchmarking the scrapers
+# offline. catalogs, listings and file contents are generated deterministically from the config, so
+# nothing is stored and two runs against the same config see the same data
+
+CKAN_DEFAULTS = {
+    'n_datasets': 1000,
+    'resources_per_dataset': 2,
+    'file_size': 64 << 10,  # mean size, files spread over half to one and a half times this
+    'latency': 0.0,  # seconds added to every response
+    'throttle_rate': 0.0,  # fraction of requests answered with 429
+    'retry_after': 1,
+    'vocab_size': 2000,
+}
+S3_DEFAULTS = {
+    'bucket': 'bench-bucket',
+    'n_objects': 2000,
+    'objects_per_dataset': 2,
+    'n_owners': 20,
+    'file_size': 64 << 10,
+    'latency': 0.0,
+    'throttle_rate': 0.0,  # fraction of requests answered with 503 SlowDown (429 on the api)
+    'retry_after': 1,
+    'vocab_size': 2000,
+}
+
+CATALOG_EPOCH = datetime(2020, 1, 1)
+LAST_MODIFIED = formatdate(CATALOG_EPOCH.timestamp(), usegmt=True)
+FILLER_ROW = b'1,some free text in a cell,3.14159,2020-01-01\n'
+WRITE_SIZE = 256 << 10
+LISTING_PAGE = 1000
+SERVER_BACKLOG = 1024
+START_TIMEOUT = 30
+
+
+def spread_size(mean_size, ind):
+    # deterministic per file, between half and one and a half times the mean
+    return mean_size//2 + (ind*2654435761) % (mean_size + 1)
+
+
+def synthetic_tags(rng, vocab_size, max_tags=8):
+    # a few tags per dataset, skewed so a handful of tags are very common like on the real portals
+    n_tags = rng.randint(1, max_tags)
+    return ['tag-{0}'.format(int(vocab_size**rng.random()) - 1) for _ in range(n_tags)]
+
+
+def make_filler(max_size):
+    return (FILLER_ROW*(max_size//len(FILLER_ROW) + 1))[:max_size]
+
+
+def csv_head(file_id):
+    # the first row differs per file, so the blob store doesn't collapse every download into one blob
+    return 'id,text,value,date\n{0},first row,0,2020-01-01\n'.format(file_id).encode()
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = SERVER_BACKLOG
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # clients hang up mid-body on purpose (size caps, files already present)
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def delay(self):
+        if self.config['latency']:
+            time.sleep(self.config['latency'])
+
+    def should_throttle(self):
+        return self.config['throttle_rate'] and random.random() < self.config['throttle_rate']
+
+    def send_bytes(self, status, body, content_type='application/json', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, obj, status=200):
+        self.send_bytes(status, json.dumps(obj).encode())
+
+    def send_throttled(self, status=429, body=b'', content_type='text/plain'):
+        self.send_bytes(status, body, content_type, [('Retry-After', str(self.config['retry_after']))])
+
+    def send_file(self, file_id, size, etag):
+        # conditional and ranged gets like a real file server. the body is a unique head followed by
+        # the shared filler, so any size is served without building it
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        head = csv_head(file_id)[:size]
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match and self.headers.get('If-Range', etag) in (etag, LAST_MODIFIED):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_bytes(416, b'', 'text/plain', [('Content-Range', 'bytes */{0}'.format(size))])
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        filler = memoryview(self.server.filler)
+        pos = start
+        while pos <= end:
+            if pos < len(head):
+                chunk = head[pos:min(len(head), end + 1)]
+            else:
+                chunk = filler[pos - len(head):min(pos - len(head) + WRITE_SIZE, end + 1 - len(head))]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+
+
+class CKANHandler(FakeHandler):
+    # the ckan action api calls the scrapers use (package_search with paging, sorting and a
+    # metadata_modified range filter, the package list fallback, the health probes) plus the files
+
+    @staticmethod
+    def setup_server(server):
+        config = server.config
+        server.filler = make_filler(config['file_size']*3//2 + 1)
+
+    def dataset(self, ind, base_url):
+        config = self.config
+        modified = (CATALOG_EPOCH + timedelta(seconds=ind)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+        resources = []
+        for res_ind in range(config['resources_per_dataset']):
+            file_ind = ind*config['resources_per_dataset'] + res_ind
+            resources.append({'id': 'resource-{0}-{1}'.format(ind, res_ind), 'format': 'CSV',
+                              'url': '{0}/files/{1}/{2}.csv'.format(base_url, ind, res_ind),
+                              'size': str(spread_size(config['file_size'], file_ind)),
+                              'last_modified': modified, 'created': modified})
+        return {'id': 'dataset-{0}'.format(ind), 'name': 'bench-dataset-{0}'.format(ind),
+                'title': 'Bench dataset {0}'.format(ind), 'metadata_created': modified,
+                'metadata_modified': modified, 'resources': resources, 'num_resources': len(resources),
+                'tags': [{'display_name': tag, 'name': tag}
+                         for tag in sorted(set(synthetic_tags(random.Random(ind), config['vocab_size'])))]}
+
+    def params(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body or b'{}'))
+            else:
+                params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        return params
+
+    def first_modified_at(self, fq):
+        # datasets are modified one second apart in index order, so the range filter is arithmetic
+        match = re.search(r'metadata_modified:\[(\S+) TO \*\]', fq or '')
+        if not match:
+            return 0
+        since = datetime.strptime(match.group(1).rstrip('Z')[:23], '%Y-%m-%dT%H:%M:%S.%f')
+        return max(0, math.ceil((since - CATALOG_EPOCH).total_seconds()))
+
+    def action(self, name, params):
+        n_datasets = self.config['n_datasets']
+        base_url = 'http://' + self.headers.get('Host', '{0}:{1}'.format(*self.server.server_address))
+        if name == 'status_show':
+            return {'site_title': 'benchmark portal', 'ckan_version': '2.9.0'}
+        if name == 'package_list':
+            limit = int(params.get('limit') or n_datasets)
+            offset = int(params.get('offset') or 0)
+            return ['bench-dataset-{0}'.format(ind) for ind in range(offset, min(n_datasets, offset + limit))]
+        if name == 'package_search':
+            first = self.first_modified_at(params.get('fq')) + int(params.get('start') or 0)
+            rows = int(params.get('rows') or 10)
+            return {'count': max(0, n_datasets - self.first_modified_at(params.get('fq'))),
+                    'results': [self.dataset(ind, base_url) for ind in range(first, min(n_datasets, first + rows))]}
+        if name == 'current_package_list_with_resources':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or n_datasets)
+            return [self.dataset(ind, base_url) for ind in range(offset, min(n_datasets, offset + limit))]
+        return None
+
+    def do_GET(self):
+        self.delay()
+        path = urlparse(self.path).path
+        if path.startswith(('/api/3/action/', '/api/action/')):
+            params = self.params()
+            if self.should_throttle():
+                return self.send_throttled()
+            result = self.action(path.rsplit('/', 1)[-1], params)
+            if result is None:
+                return self.send_json({'success': False, 'error': {'__type': 'Not Found Error', 'message': 'Not found'}}, 404)
+            return self.send_json({'success': True, 'result': result})
+
+        match = re.match(r'^/files/(\d+)/(\d+)\.csv$', path)
+        if match:
+            if self.should_throttle():
+                return self.send_throttled()
+            ind, res_ind = int(match.group(1)), int(match.group(2))
+            file_ind = ind*self.config['resources_per_dataset'] + res_ind
+            size = spread_size(self.config['file_size'], file_ind)
+            return self.send_file('{0}-{1}'.format(ind, res_ind), size, '"file-{0}-{1}"'.format(file_ind, size))
+
+        if path in ('', '/'):
+            return self.send_bytes(200, b'<html>benchmark portal</html>', 'text/html')
+        self.send_bytes(404, b'not found', 'text/plain')
+
+    do_POST = do_GET
+    do_HEAD = do_GET
+
+
+class S3Handler(FakeHandler):
+    # path-style s3 (ListObjects v1 and v2 with prefix, delimiter and paging, GetObject and
+    # HeadObject with conditional and ranged requests) and the data.world dataset endpoint under /v0
+
+    @staticmethod
+    def setup_server(server):
+        config = server.config
+        server.filler = make_filler(config['file_size']*3//2 + 1)
+        objects = {}
+        for ind in range(config['n_objects']):
+            dataset_ind = ind // config['objects_per_dataset']
+            key = 'derived/owner-{0}/dataset-{1}/file-{2}.csv'.format(
+                dataset_ind % config['n_owners'], dataset_ind, ind % config['objects_per_dataset'])
+            size = spread_size(config['file_size'], ind)
+            objects[key] = (ind, size, '"{0}"'.format(hashlib.md5('{0}:{1}'.format(key, size).encode()).hexdigest()))
+        server.objects = objects
+        server.keys = sorted(objects)
+
+    def list_objects(self, params):
+        keys = self.server.keys
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter')
+        max_keys = min(LISTING_PAGE, int(params.get('max-keys') or LISTING_PAGE))
+        after = params.get('continuation-token') or params.get('start-after') or params.get('marker')
+        ind = bisect_right(keys, after) if after else bisect_left(keys, prefix)
+
+        contents, prefixes, last = [], [], None
+        while ind < len(keys) and keys[ind].startswith(prefix) and len(contents) + len(prefixes) < max_keys:
+            key = keys[ind]
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+                prefixes.append(common_prefix)
+                last = common_prefix
+                # skip past everything under the common prefix
+                ind = bisect_left(keys, common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1))
+            else:
+                contents.append(key)
+                last = key
+                ind += 1
+        truncated = ind < len(keys) and keys[ind].startswith(prefix)
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                 '<Name>{0}</Name><Prefix>{1}</Prefix><MaxKeys>{2}</MaxKeys>'.format(
+                     escape(self.config['bucket']), escape(prefix), max_keys),
+                 '<IsTruncated>{0}</IsTruncated>'.format('true' if truncated else 'false')]
+        if delimiter:
+            parts.append('<Delimiter>{0}</Delimiter>'.format(escape(delimiter)))
+        if params.get('list-type') == '2':
+            parts.append('<KeyCount>{0}</KeyCount>'.format(len(contents) + len(prefixes)))
+            if truncated:
+                parts.append('<NextContinuationToken>{0}</NextContinuationToken>'.format(escape(last)))
+        elif truncated:
+            parts.append('<NextMarker>{0}</NextMarker>'.format(escape(last)))
+        for key in contents:
+            _, size, etag = self.server.objects[key]
+            parts.append('<Contents><Key>{0}</Key><LastModified>2020-01-01T00:00:00.000Z</LastModified>'
+                         '<ETag>{1}</ETag><Size>{2}</Size><StorageClass>STANDARD</StorageClass></Contents>'.format(
+                             escape(key), escape(etag), size))
+        for common_prefix in prefixes:
+            parts.append('<CommonPrefixes><Prefix>{0}</Prefix></CommonPrefixes>'.format(escape(common_prefix)))
+        parts.append('</ListBucketResult>')
+        self.send_bytes(200, ''.join(parts).encode(), 'application/xml')
+
+    def send_error_xml(self, status, code, message):
+        body = ('<?xml version="1.0" encoding="UTF-8"?><Error><Code>{0}</Code><Message>{1}</Message></Error>'
+                .format(code, message)).encode()
+        if status == 503:
+            return self.send_throttled(503, body, 'application/xml')
+        self.send_bytes(status, body, 'application/xml')
+
+    def dataset_metadata(self, owner, dataset):
+        rng = random.Random('{0}/{1}'.format(owner, dataset))
+        files = [{'name': 'file-{0}.csv'.format(ind)} for ind in range(self.config['objects_per_dataset'])]
+        return {'id': dataset, 'owner': owner, 'title': dataset.replace('-', ' '), 'files': files,
+                'tags': sorted(set(synthetic_tags(rng, self.config['vocab_size'])))}
+
+    def do_GET(self):
+        self.delay()
+        url = urlparse(self.path)
+        path = unquote(url.path)
+
+        match = re.match(r'^/v0/datasets/([^/]+)/([^/]+)$', path)
+        if match:
+            if self.should_throttle():
+                return self.send_throttled()
+            return self.send_json(self.dataset_metadata(*match.groups()))
+
+        if self.should_throttle():
+            return self.send_error_xml(503, 'SlowDown', 'Please reduce your request rate.')
+        bucket, _, key = path.lstrip('/').partition('/')
+        if bucket != self.config['bucket']:
+            return self.send_error_xml(404, 'NoSuchBucket', 'The specified bucket does not exist')
+        if not key:
+            return self.list_objects({name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()})
+        if key not in self.server.objects:
+            return self.send_error_xml(404, 'NoSuchKey', 'The specified key does not exist.')
+        ind, size, etag = self.server.objects[key]
+        self.send_file('s3-{0}'.format(ind), size, etag)
+
+    do_HEAD = do_GET
+
+
+def serve(handler_class, config, port_queue):
+    server = BenchHTTPServer(('127.0.0.1', 0), handler_class)
+    server.config = config
+    handler_class.setup_server(server)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeServer:
+    # runs one stand-in in its own process, so serving doesn't compete with the code under test for
+    # the gil or show up in its cpu time and memory
+
+    def __init__(self, handler_class, defaults, **config):
+        unknown = set(config) - set(defaults)
+        if unknown:
+            raise ValueError('unknown settings: {0}'.format(', '.join(sorted(unknown))))
+        self.handler_class = handler_class
+        self.config = dict(defaults, **config)
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.handler_class, self.config, port_queue), daemon=True)
+        self.process.start()
+        self.url = 'http://127.0.0.1:{0}'.format(port_queue.get(timeout=START_TIMEOUT))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+
+def fake_ckan(**config):
+    return FakeServer(CKANHandler, CKAN_DEFAULTS, **config)
+
+
+def fake_s3(**config):
+    return FakeServer(S3Handler, S3_DEFAULTS, **config)
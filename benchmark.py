@@ -0,0 +1,301 @@
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import time
+import traceback
+
+from bench_servers import fake_ckan, fake_s3, synthetic_tags
+from utils import get_timestamp, write_json
+
+
+# offline benchmarks: the scrapers against the local ckan and s3 stand-ins in bench_servers.py, and
+# the tag pipeline against synthetic corpora. every case runs in a fresh process inside its own
+# working directory (so the manifest, rate limiter and indexes start empty) and reports wall time,
+# datasets/s, MB/s, cpu time (its own plus its worker processes') and peak rss
+BENCH_DIR = 'data/bench'
+TAG_CORPUS_SIZES = (10000, 100000, 1000000)
+TAG_VOCAB_SIZE = 20000
+TAG_SOURCE = 'bench'
+HOST_RATE = 50.0  # per-host request rate the limiter starts at, so short runs aren't all slow start
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CKAN_CASES = ('ckan', 'ckan-warm', 'ckan-parallel')
+S3_CASES = ('s3-serial', 's3-parallel')
+TAG_CASES = ('get-all-tags', 'get-all-tags-warm', 'build-target-matrix')
+
+
+def metric_totals(metrics_dir='data/metrics'):
+    # counters summed over the json snapshots every process of a run wrote, see metrics.py
+    totals = {}
+    if os.path.isdir(metrics_dir):
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith('.json'):
+                with open(os.path.join(metrics_dir, filename)) as json_file:
+                    for counter in json.load(json_file)['counters']:
+                        totals[counter['name']] = totals.get(counter['name'], 0) + counter['value']
+    return totals
+
+
+def clear_metrics(metrics_dir='data/metrics'):
+    # a warm rerun in the same directory should only count its own work
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def seed_host_rates(urls, rate=HOST_RATE):
+    from rate_limit import get_host, get_rate_limiter
+
+    for url in urls:
+        get_rate_limiter().set_rate(get_host(url), rate)
+
+
+def scraper_counts(n_datasets):
+    totals = metric_totals()
+    return {'datasets': n_datasets, 'bytes': totals.get('bytes_total', 0), 'files': totals.get('files_total', 0),
+            'retries': totals.get('retries_total', 0), 'failures': totals.get('failures_total', 0)}
+
+
+def bench_ckan(ckan_url, n_datasets, rate=HOST_RATE):
+    from ckan_scraping import scrape_ckan_instance
+
+    clear_metrics()
+    seed_host_rates([ckan_url], rate)
+    scrape_ckan_instance(ckan_url, formats=['csv'], data_dir='data/ckan/bench')
+    return scraper_counts(n_datasets)
+
+
+def bench_ckan_parallel(ckan_urls, n_datasets, n_workers=None, rate=HOST_RATE):
+    from ckan_scraping import parallel_ckan_scrape
+
+    clear_metrics()
+    write_json({'bench-{0}'.format(ind): url for ind, url in enumerate(ckan_urls)}, 'ckan-instances.json')
+    seed_host_rates(ckan_urls, rate)
+    parallel_ckan_scrape(formats=['csv'], data_dir='data/ckan', n_workers=n_workers)
+    return scraper_counts(n_datasets*len(ckan_urls))
+
+
+def bench_s3(bucket, n_datasets, parallel=True, n_workers=None, rate=HOST_RATE):
+    import ddw_scraping
+
+    clear_metrics()
+    seed_host_rates([ddw_scraping.DDW_API_URL], rate)
+    if parallel:
+        ddw_scraping.read_s3_parallel(base_dir='data/ddw-s3', bucket_name=bucket, formats=['csv'], n_workers=n_workers)
+    else:
+        ddw_scraping.read_s3_serial(base_dir='data/ddw-s3', bucket_name=bucket, formats=['csv'])
+    return scraper_counts(n_datasets)
+
+
+def make_tag_corpus(base_dir, n_datasets, vocab_size=TAG_VOCAB_SIZE, seed=0):
+    # <base_dir>/labeled/<id>/<id>_tags.json for get_all_tags and the same tags in the tag index for
+    # build_target_matrix, written the way the scrapers write them
+    from tag_index import get_tag_index
+
+    rng = random.Random(seed)
+    tag_index = get_tag_index()
+    for ind in range(n_datasets):
+        data_id = 'owner-{0}.dataset-{1}'.format(ind % 1000, ind)
+        folder = os.path.join(base_dir, 'labeled', data_id)
+        os.makedirs(folder, exist_ok=True)
+        tags = synthetic_tags(rng, vocab_size)
+        write_json(tags, os.path.join(folder, '{0}_tags.json'.format(data_id)))
+        tag_index.set_tags(TAG_SOURCE, data_id, tags)
+    return {'datasets': n_datasets}
+
+
+def bench_get_all_tags(base_dir, n_datasets):
+    from ddw_scraping import get_all_tags
+
+    get_all_tags(base_dir=os.path.join(base_dir, 'labeled'))
+    return {'datasets': n_datasets}
+
+
+def bench_build_target_matrix(base_dir, n_datasets):
+    from ddw_scraping import build_target_matrix
+
+    build_target_matrix(base_dir=base_dir, source=TAG_SOURCE, rebuild=True)
+    return {'datasets': n_datasets}
+
+
+def case_main(func, kwargs, workdir, log_filename, conn):
+    # runs in the fresh process: cwd is the case's working directory and stdout goes to its log,
+    # so the scrapers' per-file prints cost what they cost in production without flooding the report.
+    # the cases import the scrapers lazily, which a relative '' on sys.path would miss after the chdir
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    sys.stdout.flush()
+    log_file = open(log_filename, 'w')
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    counts, error = {}, None
+    try:
+        counts = func(**kwargs) or {}
+    except Exception:
+        error = traceback.format_exc()
+    wall = time.perf_counter() - start
+    sys.stdout.flush()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = sum(getattr(usage_self, field) - getattr(start_self, field) +
+              getattr(usage_children, field) - getattr(start_children, field) for field in ('ru_utime', 'ru_stime'))
+    # ru_maxrss is in kilobytes on linux; for children it is the largest single worker
+    conn.send({'wall': wall, 'cpu': cpu, 'peak_rss_mb': max(usage_self.ru_maxrss, usage_children.ru_maxrss)/1024,
+               'counts': counts, 'error': error})
+    conn.close()
+
+
+def run_case(name, func, kwargs, workdir, log_dir):
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    log_filename = os.path.abspath(os.path.join(log_dir, name + '.log'))
+    process = multiprocessing.Process(target=case_main, args=(func, kwargs, os.path.abspath(workdir), log_filename, send_conn))
+    process.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {'wall': None, 'cpu': None, 'peak_rss_mb': None, 'counts': {},
+                  'error': 'case process died with exit code {0}'.format(process.exitcode)}
+
+    counts = result['counts']
+    result['name'] = name
+    result['datasets_per_sec'] = counts['datasets']/result['wall'] if result['wall'] and counts.get('datasets') else None
+    result['mb_per_sec'] = counts['bytes']/2**20/result['wall'] if result['wall'] and counts.get('bytes') else None
+    result['log'] = log_filename
+    print_result(result)
+    return result
+
+
+def print_result(result):
+    def fmt(value, digits=1):
+        return '-' if value is None else '{0:.{1}f}'.format(value, digits)
+
+    print('{0:<28} {1:>9} s {2:>10} datasets/s {3:>8} MB/s {4:>9} cpu s {5:>8} MB peak rss'.format(
+        result['name'], fmt(result['wall'], 2), fmt(result['datasets_per_sec']), fmt(result['mb_per_sec']),
+        fmt(result['cpu'], 2), fmt(result['peak_rss_mb'])))
+    extra = {key: value for key, value in result['counts'].items() if key not in ('datasets', 'bytes')}
+    if extra:
+        print('{0:<28} {1}'.format('', ', '.join('{0}: {1}'.format(key, value) for key, value in extra.items())))
+    if result['error']:
+        print('  failed:', result['error'].strip().splitlines()[-1], '(see {0})'.format(result['log']))
+
+
+def run_ckan_benchmarks(run_dir, cases=CKAN_CASES, n_instances=4, n_workers=None, rate=HOST_RATE, **server_config):
+    # server_config goes to the fake portals: n_datasets, resources_per_dataset, file_size, latency,
+    # throttle_rate, retry_after (see bench_servers.CKAN_DEFAULTS)
+    results = []
+    log_dir = os.path.join(run_dir, 'logs')
+    servers = [fake_ckan(**server_config) for _ in range(n_instances if 'ckan-parallel' in cases else 1)]
+    for server in servers:
+        server.__enter__()
+    try:
+        n_datasets = servers[0].config['n_datasets']
+        workdir = os.path.join(run_dir, 'ckan')
+        if 'ckan' in cases or 'ckan-warm' in cases:
+            kwargs = {'ckan_url': servers[0].url, 'n_datasets': n_datasets, 'rate': rate}
+            results.append(run_case('ckan', bench_ckan, kwargs, workdir, log_dir))
+            if 'ckan-warm' in cases:
+                # same directory again: everything is revalidated with conditional requests
+                results.append(run_case('ckan-warm', bench_ckan, kwargs, workdir, log_dir))
+        if 'ckan-parallel' in cases:
+            kwargs = {'ckan_urls': [server.url for server in servers], 'n_datasets': n_datasets,
+                      'n_workers': n_workers, 'rate': rate}
+            results.append(run_case('ckan-parallel', bench_ckan_parallel, kwargs, os.path.join(run_dir, 'ckan-parallel'),
+                                    log_dir))
+    finally:
+        for server in servers:
+            server.__exit__(None, None, None)
+    return results
+
+
+def run_s3_benchmarks(run_dir, cases=S3_CASES, n_workers=None, rate=HOST_RATE, **server_config):
+    # server_config goes to the s3 stand-in: n_objects, objects_per_dataset, n_owners, file_size,
+    # latency, throttle_rate, retry_after (see bench_servers.S3_DEFAULTS). the scrapers find it through
+    # AWS_ENDPOINT_URL and DDW_API_URL, which the case processes inherit
+    results = []
+    log_dir = os.path.join(run_dir, 'logs')
+    with fake_s3(**server_config) as server:
+        env = {'AWS_ENDPOINT_URL': server.url, 'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+               'AWS_DEFAULT_REGION': 'us-east-1', 'DDW_API_URL': server.url + '/v0'}
+        saved_env = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            config = server.config
+            n_datasets = -(-config['n_objects'] // config['objects_per_dataset'])
+            for name in cases:
+                kwargs = {'bucket': config['bucket'], 'n_datasets': n_datasets, 'parallel': name == 's3-parallel',
+                          'n_workers': n_workers, 'rate': rate}
+                results.append(run_case(name, bench_s3, kwargs, os.path.join(run_dir, name), log_dir))
+        finally:
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+    return results
+
+
+def run_tag_benchmarks(run_dir, sizes=TAG_CORPUS_SIZES, cases=TAG_CASES, vocab_size=TAG_VOCAB_SIZE):
+    # the corpus is written once per size (not timed) and every case reads it from the same directory.
+    # get-all-tags starts with an empty folder index, get-all-tags-warm reuses the one it built
+    results = []
+    log_dir = os.path.join(run_dir, 'logs')
+    for n_datasets in sizes:
+        workdir = os.path.join(run_dir, 'tags-{0}'.format(n_datasets))
+        print('writing a synthetic corpus of', n_datasets, 'tagged datasets')
+        setup = run_case('setup-tags-{0}'.format(n_datasets), make_tag_corpus,
+                         {'base_dir': 'corpus', 'n_datasets': n_datasets, 'vocab_size': vocab_size}, workdir, log_dir)
+        if setup['error']:
+            results.append(setup)
+            continue
+        for name, func in (('get-all-tags', bench_get_all_tags), ('get-all-tags-warm', bench_get_all_tags),
+                           ('build-target-matrix', bench_build_target_matrix)):
+            if name in cases:
+                results.append(run_case('{0}-{1}'.format(name, n_datasets), func,
+                                        {'base_dir': 'corpus', 'n_datasets': n_datasets}, workdir, log_dir))
+    return results
+
+
+def run_benchmarks(suites=('ckan', 's3', 'tags'), bench_dir=BENCH_DIR, keep=False, ckan_config=None, s3_config=None,
+                   tag_sizes=TAG_CORPUS_SIZES):
+    # runs the chosen suites and appends every result to <bench_dir>/results.jsonl. the working
+    # directories are removed afterwards unless keep is set; the logs always stay
+    run_dir = os.path.join(bench_dir, get_timestamp())
+    os.makedirs(os.path.join(run_dir, 'logs'), exist_ok=True)
+    print('benchmark run in', run_dir)
+
+    results = []
+    try:
+        if 'ckan' in suites:
+            results += run_ckan_benchmarks(run_dir, **(ckan_config or {}))
+        if 's3' in suites:
+            results += run_s3_benchmarks(run_dir, **(s3_config or {}))
+        if 'tags' in suites:
+            results += run_tag_benchmarks(run_dir, sizes=tag_sizes)
+    finally:
+        with open(os.path.join(bench_dir, 'results.jsonl'), 'a') as results_file:
+            for result in results:
+                results_file.write(json.dumps(dict(result, run=os.path.basename(run_dir))) + '\n')
+        if not keep:
+            for entry in os.listdir(run_dir):
+                if entry != 'logs':
+                    shutil.rmtree(os.path.join(run_dir, entry), ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmarks()
+    # run_benchmarks(suites=('ckan',), ckan_config={'n_datasets': 5000, 'latency': 0.05, 'throttle_rate': 0.01})
+    # run_benchmarks(suites=('s3',), s3_config={'n_objects': 20000, 'file_size': 1 << 20})
+    # run_benchmarks(suites=('tags',), tag_sizes=(10000,))
@@ -0,0 +1,181 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from part_file import BUFFER_SIZE
+from utils import open_db
+
+
+BLOB_STORE_PATH = 'data/blobs'
+FICLONE = 0x40049409  # linux ioctl that reflinks one file's blocks into another
+
+
+def hash_file(path, buffer_size=BUFFER_SIZE):
+    sha256 = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as data_file:
+        while True:
+            n_read = data_file.readinto(buffer)
+            if not n_read:
+                return sha256.hexdigest()
+            sha256.update(view[:n_read])
+
+
+def clone_file(src, dest):
+    # copy without moving the data through python where the os allows it: a copy-on-write reflink
+    # (btrfs, xfs) shares the blocks, copy_file_range copies inside the kernel. plain copy otherwise
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                size = os.fstat(src_file.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n_copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), size - copied)
+                    if not n_copied:
+                        break
+                    copied += n_copied
+                if copied == size:
+                    return
+            except OSError:
+                pass
+            src_file.seek(0)
+            dest_file.seek(0)
+            dest_file.truncate()
+        shutil.copyfileobj(src_file, dest_file, BUFFER_SIZE)
+
+
+def link_or_copy(src, dest):
+    # hardlink src at dest, replacing whatever is there; clone it if they're on different filesystems
+    tmp_dest = '{0}.link-{1}-{2}'.format(dest, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmp_dest)
+    except OSError:
+        clone_file(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+
+class BlobStore:
+    # content-addressed storage: every distinct file body is kept once at <root>/<ab>/<cd>/<sha256>
+    # and the dataset folders hold hardlinks to it, so a file mirrored by several portals costs
+    # disk (and downstream processing) once. refs.db maps every linked path to its blob
+
+    def __init__(self, root=BLOB_STORE_PATH):
+        self.root = root
+        self.lock = threading.Lock()
+        self.conn = open_db(os.path.join(root, 'refs.db'))
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS refs (
+                                path TEXT PRIMARY KEY,
+                                sha256 TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                instance TEXT,
+                                added REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS refs_sha256 ON refs (sha256)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS refs_instance ON refs (instance)')
+        # the inode of every blob, so hardlinks made after adopting (staged or renamed dataset
+        # folders) can be traced back to their content without a path in refs
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS inodes (
+                                dev INTEGER NOT NULL,
+                                ino INTEGER NOT NULL,
+                                sha256 TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                mtime_ns INTEGER NOT NULL,
+                                PRIMARY KEY (dev, ino))''')
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def lookup(self, path):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM refs WHERE path = ?', (path,)).fetchone()
+        return dict(row) if row else None
+
+    def lookup_file(self, path):
+        # sha256 of the blob path is a hardlink to, or None. size and mtime have to match as well,
+        # in case the blob was removed and its inode reused
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM inodes WHERE dev = ? AND ino = ?', (stat.st_dev, stat.st_ino)).fetchone()
+        if row and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+            return row['sha256']
+        return None
+
+    def record_inode(self, sha256):
+        stat = os.stat(self.blob_path(sha256))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?)',
+                              (stat.st_dev, stat.st_ino, sha256, stat.st_size, stat.st_mtime_ns))
+
+    def index_inodes(self):
+        # fills in blobs stored before the inodes table existed
+        with self.lock:
+            missing = [row['sha256'] for row in self.conn.execute(
+                'SELECT DISTINCT sha256 FROM refs WHERE sha256 NOT IN (SELECT sha256 FROM inodes)').fetchall()]
+        for sha256 in missing:
+            if os.path.isfile(self.blob_path(sha256)):
+                self.record_inode(sha256)
+
+    def adopt(self, path, sha256, size, instance=None):
+        # move a finished download into the store (or drop it if we already hold that content) and
+        # leave a hardlink to the blob in its place
+        blob = self.blob_path(sha256)
+        if os.path.isfile(blob):
+            print('duplicate content, linking to blob:', path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                pass  # another worker stored the same content first
+            except OSError:
+                clone_file(path, blob)
+        link_or_copy(blob, path)
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)', (path, sha256, size, instance, time.time()))
+        self.record_inode(sha256)
+        return blob
+
+    def adopt_file(self, path, instance=None):
+        # for files that weren't hashed while streaming
+        return self.adopt(path, hash_file(path), os.path.getsize(path), instance)
+
+    def dedup_stats(self):
+        # per instance: files, logical bytes, distinct blobs and the bytes those blobs actually take
+        with self.lock:
+            rows = self.conn.execute('''SELECT instance, COUNT(*) AS n_files, SUM(size) AS logical_bytes,
+                                               COUNT(DISTINCT sha256) AS n_blobs,
+                                               (SELECT SUM(size) FROM (SELECT DISTINCT sha256, size FROM refs AS inner_refs
+                                                                       WHERE inner_refs.instance IS refs.instance)) AS stored_bytes
+                                        FROM refs GROUP BY instance ORDER BY instance''').fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def report_dedup(root=BLOB_STORE_PATH):
+    for stats in get_blob_store(root).dedup_stats():
+        ratio = stats['logical_bytes']/stats['stored_bytes'] if stats['stored_bytes'] else 1.0
+        print('{0}: {1} files in {2} blobs, {3:.1f} MB logical / {4:.1f} MB stored, dedup ratio {5:.2f}'.format(
+            stats['instance'], stats['n_files'], stats['n_blobs'],
+            stats['logical_bytes']/2**20, (stats['stored_bytes'] or 0)/2**20, ratio))
+
+
+_stores = {}
+
+
+def get_blob_store(root=BLOB_STORE_PATH):
+    # one connection per process, so pool workers can share the store
+    key = (os.getpid(), root)
+    if key not in _stores:
+        _stores[key] = BlobStore(root)
+    return _stores[key]
@@ -0,0 +1,204 @@
+import ast
+import asyncio
+import os
+
+import requests
+from ckanapi.errors import CKANAPIError, NotFound
+
+from metrics import get_metrics
+from rate_limit import MAX_RETRIES, THROTTLE_STATUSES, get_host, get_rate_limiter, parse_retry_after
+from utils import read_json, write_json
+
+
+PAGE_SIZE = 100
+CURSOR_FILENAME = '_catalog-cursor.json'
+SYNC_FILENAME = '_last-sync.json'
+
+
+class CatalogCursor:
+    # remembers the offset of the first catalog page that hasn't been fully processed, so a
+    # crashed crawl restarts at that page instead of re-enumerating the whole catalog
+    key = 'offset'
+    default = 0
+
+    def __init__(self, cursor_file):
+        self.cursor_file = cursor_file
+
+    def load(self):
+        if os.path.isfile(self.cursor_file) and os.path.getsize(self.cursor_file) > 0:
+            return read_json(self.cursor_file)[self.key]
+        return self.default
+
+    def save(self, position):
+        tmp_file = self.cursor_file + '.tmp'
+        write_json({self.key: position}, tmp_file)
+        os.replace(tmp_file, self.cursor_file)
+
+    def clear(self):
+        if os.path.isfile(self.cursor_file):
+            os.remove(self.cursor_file)
+
+
+class SyncState(CatalogCursor):
+    # the metadata_modified of the newest dataset an incremental sync has fully processed, in
+    # solr date format. it is never cleared: it is where the next sync starts
+    key = 'metadata_modified'
+    default = None
+
+
+def solr_time(timestamp):
+    # ckan reports naive utc times with microseconds, solr range queries want ms precision and a Z.
+    # truncating keeps the bound inclusive, so at worst a few datasets are seen twice
+    return timestamp[:23] + 'Z'
+
+
+def error_status(err):
+    # http status of an error ckanapi didn't recognize, which it reports as repr([url, status, body])
+    try:
+        return ast.literal_eval(str(err))[1]
+    except (ValueError, SyntaxError, TypeError, IndexError):
+        return None
+
+
+def action_missing(err):
+    # the portal doesn't have the action at all: ckan answers 400 "Action name not known", some older
+    # portals a not found error
+    message = str(err).lower()
+    return (isinstance(err, NotFound) or error_status(err) == 404
+            or 'action name not known' in message or 'action not found' in message)
+
+
+def call_action(instance, action, max_retries=MAX_RETRIES, **data_dict):
+    # catalog calls count against the same per-host budget as the downloads, and feed 429/5xx
+    # responses back into it the same way: the host's rate is cut and the call retried after the backoff
+    limiter = get_rate_limiter()
+    metrics = get_metrics()
+    host = get_host(instance.address)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(host)
+        try:
+            result = instance.call_action(action, data_dict)
+        except CKANAPIError as err:
+            status = error_status(err)
+            if status not in THROTTLE_STATUSES or attempt == max_retries:
+                raise err
+            # the session remembers the Retry-After ckanapi drops (see connections.get_session)
+            wait = limiter.throttled(host, parse_retry_after(getattr(instance.session, 'last_retry_after', None)))
+            print('throttled by', host, 'status:', status, 'backing off', round(wait, 1), 'seconds')
+            metrics.inc('retries_total', host=host, reason='throttled')
+            continue
+        except requests.exceptions.ConnectionError as err:
+            print('connection error calling', action, 'on', instance.address)
+            print('error:', err)
+            if attempt == max_retries:
+                raise err
+            limiter.throttled(host)
+            metrics.inc('retries_total', host=host, reason='connection')
+            continue
+        limiter.succeeded(host)
+        return result
+
+
+def fetch_page(instance, offset, page_size=PAGE_SIZE, method='package_search'):
+    if method == 'package_search':
+        # sort by creation time so datasets added mid-crawl land on later pages
+        response = call_action(instance, 'package_search', rows=page_size, start=offset, sort='metadata_created asc')
+        return response['results']
+    return call_action(instance, 'current_package_list_with_resources', limit=page_size, offset=offset)
+
+
+def iter_catalog_pages(instance, start=0, page_size=PAGE_SIZE, method='package_search'):
+    # yields (offset, datasets) one page at a time, fetching the next page only when asked
+    offset = start
+    while True:
+        try:
+            page = fetch_page(instance, offset, page_size=page_size, method=method)
+        except CKANAPIError as err:
+            # older portals don't expose package_search, fall back to the paged package list. that list
+            # is in another order, so only switch before the first page, never part way through
+            if method != 'package_search' or offset != start or not action_missing(err):
+                raise err
+            print('package_search not available, falling back to current_package_list_with_resources:', err)
+            method = 'current_package_list_with_resources'
+            continue
+
+        if not page:
+            return
+        yield offset, page
+        offset += len(page)
+
+
+def fetch_modified_page(instance, since, offset=0, page_size=PAGE_SIZE):
+    fq = 'metadata_modified:[{0} TO *]'.format(since) if since else ''
+    response = call_action(instance, 'package_search', rows=page_size, start=offset, fq=fq, sort='metadata_modified asc')
+    return response['results']
+
+
+def iter_modified_pages(instance, since=None, page_size=PAGE_SIZE):
+    # yields (watermark, datasets) for every dataset modified at or after since, oldest first. pages are
+    # fetched by keyset (each query starts at the last page's newest time), so datasets edited mid-sync
+    # just move to the end instead of shifting offsets. once a page and everything before it is processed
+    # the watermark can be saved as the next since; None means it can't be saved yet
+    try:
+        page = fetch_modified_page(instance, since, page_size=page_size)
+    except CKANAPIError as err:
+        if not action_missing(err):
+            raise err
+        print('package_search not available, filtering the full package list instead:', err)
+        yield from iter_modified_fallback(instance, since, page_size)
+        return
+
+    seen = set()  # ids already yielded at the current lower bound
+    offset = 0
+    while page:
+        new_datasets = [dataset for dataset in page if dataset['id'] not in seen]
+        last = solr_time(page[-1]['metadata_modified'])
+        if last == since:
+            # the whole page shares one timestamp (bulk harvests do this), page through the ties
+            offset += len(page)
+            seen.update(dataset['id'] for dataset in page)
+        else:
+            since, offset = last, 0
+            seen = {dataset['id'] for dataset in page if solr_time(dataset['metadata_modified']) == last}
+        yield since, new_datasets
+        page = fetch_modified_page(instance, since, offset=offset, page_size=page_size)
+
+
+def iter_modified_fallback(instance, since=None, page_size=PAGE_SIZE):
+    # portals without package_search: the list isn't ordered by modification, so the whole catalog is
+    # still enumerated and only the new watermark at the very end can be saved
+    newest = since
+    for _, page in iter_catalog_pages(instance, page_size=page_size, method='current_package_list_with_resources'):
+        modified = [dataset for dataset in page if not since or solr_time(dataset['metadata_modified']) >= since]
+        for dataset in modified:
+            newest = max(newest or '', solr_time(dataset['metadata_modified']))
+        yield None, modified
+    yield newest, []
+
+
+def iter_ckan_datasets(instance, page_size=PAGE_SIZE, cursor=None, method='package_search'):
+    start = cursor.load() if cursor else 0
+    for offset, page in iter_catalog_pages(instance, start=start, page_size=page_size, method=method):
+        yield from page
+        if cursor:
+            cursor.save(offset + len(page))
+    if cursor:
+        cursor.clear()
+
+
+async def aiter_catalog_pages(instance, start=0, page_size=PAGE_SIZE, method='package_search'):
+    async for item in aiter_pages(iter_catalog_pages(instance, start=start, page_size=page_size, method=method)):
+        yield item
+
+
+async def aiter_pages(pages):
+    # the ckan client is blocking, so fetch pages on an executor thread and keep one page of
+    # lookahead in flight while the caller hands the current page to the downloaders
+    loop = asyncio.get_running_loop()
+    pending = loop.run_in_executor(None, next, pages, None)
+    while True:
+        item = await pending
+        if item is None:
+            return
+        pending = loop.run_in_executor(None, next, pages, None)
+        yield item
@@ -1,180 +1,500 @@
+import asyncio
 import json
 import multiprocessing
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import requests
 from ckanapi import RemoteCKAN
-from glob import glob
-import numpy as np
-
-from utilities import get_dataset_name, is_valid_resource, strip_empty
-import subprocess
+from ckanapi.errors import CKANAPIError
+
+from blob_store import link_or_copy
+from ckan_catalog import (CURSOR_FILENAME, PAGE_SIZE, SYNC_FILENAME, CatalogCursor, SyncState, aiter_catalog_pages,
+                          aiter_pages, call_action, iter_catalog_pages, iter_modified_pages)
+from connections import get_session
+from download_engine import DownloadEngine, GLOBAL_CONCURRENCY, HOST_CONCURRENCY, MAX_FILE_SIZE
+from fs_index import INDEX_THREADS, folder_files, get_folder_index
+from health import probe_instances, rank_instances
+from manifest import REJECTED, TOO_LARGE, has_validators, is_complete
+from metrics import Progress, export_metrics, get_metrics, profile_section
+from metadata_catalog import ckan_entry, get_metadata_catalog, metadata_filename, record_metadata
+from normalize import EXCEL_FORMATS, normalize_file
+from rate_limit import get_host
+from scheduler import PageTracker, drain_work_queue, run_work_queue
+from shards import LEASE_CHECK_INTERVAL, LeaseLost, get_shard_queue, run_shard_workers
+from tag_index import get_tag_index
+from utilities import get_dataset_name, get_resource_size, is_valid_resource, strip_empty
 from utils import read_json, write_json
 from collections import Counter
 
 
-MIN_WAIT = 2
-MAX_WAIT = 60
-
-
-def scrape_ckan_instance(ckan_url="https://open.alberta.ca", formats=['xls', 'xlsx', 'csv'], data_dir='data/ckan'):
-    # def scrape_ckan_instance(**kwargs):
-    # ckan_url = kwargs['ckan_url'] if kwargs['ckan_url'] else 'https://open.alberta.ca'
-    # formats = kwargs['formats'] if kwargs['formats'] else ['xls', 'xlsx', 'csv']
-    # data_dir = kwargs['data_dir'] if kwargs['data_dir'] else 'data/ckan'
-
-    def save_metadata(dataset, dataset_folder):  # dataset_name=None, data_dir='data/ckan'):
-        dataset_name = dataset_folder.split('/')[-1]  # get_dataset_name(dataset)
-        filename = '{0}/{1}_metadata.json'.format(dataset_folder, dataset_name)
-        with open(filename, 'w') as json_file:
-            metadata = strip_empty(dataset)
-            json.dump(metadata, json_file, indent=2)
-
-    def process_resource(resource, dataset_folder, formats=['xls', 'xlsx', 'csv']):
-        try:
-            # if filetype not in formats, return
-            if not resource['url'].split('.')[-1].lower() in formats:
-                print('invalid filetype, resource url:', resource['url'])
-                return
-
-            resource_fname = resource['url'].split('/')[-1]
-            data_filename = '{0}/{1}'.format(dataset_folder, resource_fname)
-
-            # if file already exists and isnt empty, return
-            if os.path.isfile(data_filename) and os.path.getsize(data_filename) > 0:
-                print('resource already present:', data_filename)
-                return
-
-            wait_time = MIN_WAIT
-            while True:
-                # TODO add timeout to skip large files
-                try:
-                    # o.w. request resource from url
-                    print('requesting', resource['url'])
-                    response = requests.get(resource['url'], stream=True)
-                    break
-
-                except requests.exceptions.ConnectionError as err:
-                    # TODO more careful check for rate limiting
-                    print('connection error requesting from url:', resource['url'])
-                    print('error:', err)
-                    print('waiting', wait_time, 'seconds ( max is', MAX_WAIT, ')')
-                    time.sleep(wait_time)
-                    if wait_time < MAX_WAIT:
-                        wait_time = min(2*wait_time, MAX_WAIT)  # exponentially increase the wait time until max
-                    else:
-                        break
-
-            if response and response.status_code == 200:
-                # if successful, stream data to file
-                print('saving file:', data_filename)
-                with open(data_filename, 'wb') as data_file:
-                    for chunk in response.iter_content():
-                        # if chunk:
-                        data_file.write(chunk)
-
-            else:
-                if response:
-                    print('request failed:', response.status_code)
-                print('failed resource:', strip_empty(resource))
+SHARD_PAGES = 20  # catalog pages per multi-node shard
+RESOURCE_VERSION_KEYS = ('url', 'last_modified', 'metadata_modified', 'size', 'hash')
 
-        except requests.exceptions.InvalidSchema as err:
-            print('invalid shema, not http? url:', resource['url'])
-            print('error:', err)
 
-        except Exception as err:
-            print('unknown error:', err)
-            raise err
+def catalog_key(dataset_folder):
+    # (instance, dataset name) of a <data_dir>/<instance>/<dataset> folder
+    instance_dir, dataset_name = os.path.split(os.path.normpath(dataset_folder))
+    return os.path.basename(instance_dir), dataset_name
+
+
+def save_metadata(dataset, dataset_folder):  # dataset_name=None, data_dir='data/ckan'):
+    metadata = strip_empty(dataset)
+    record_metadata(*catalog_key(dataset_folder), metadata, dataset_folder, ckan_entry(metadata))
+
+
+def load_metadata(dataset_folder):
+    # from the catalog, or the _metadata.json of folders scraped before it existed
+    metadata = get_metadata_catalog().get(*catalog_key(dataset_folder))
+    if metadata is None and os.path.isfile(metadata_filename(dataset_folder)):
+        metadata = read_json(metadata_filename(dataset_folder))
+    return metadata
+
+
+async def process_resource(engine, resource, dataset_folder, formats=['xls', 'xlsx', 'csv'], instance=None, normalize=None):
+    with profile_section('process_resource'), get_metrics().timer('resource_seconds', instance=instance):
+        return await _process_resource(engine, resource, dataset_folder, formats, instance, normalize)
+
+
+async def _process_resource(engine, resource, dataset_folder, formats, instance, normalize):
+    # if filetype not in formats, return
+    file_format = resource['url'].split('.')[-1].lower()
+    if file_format not in formats:
+        print('invalid filetype, resource url:', resource['url'])
+        get_metrics().inc('skips_total', instance=instance, reason='format')
+        return
+
+    resource_fname = resource['url'].split('/')[-1]
+    data_filename = '{0}/{1}'.format(dataset_folder, resource_fname)
+
+    # complete resources the server gave no validators for can't be revalidated, skip them
+    # straight from the manifest; everything else goes out as a conditional request
+    entry = engine.manifest.get(resource['url'], data_filename)
+    if is_complete(entry) and not has_validators(entry):
+        print('resource already present:', data_filename)
+        get_metrics().inc('skips_total', instance=instance, reason='present')
+        return
+    if entry and entry['status'] == TOO_LARGE and engine.max_file_size and entry['size'] > engine.max_file_size:
+        print('resource too large:', data_filename)
+        get_metrics().inc('skips_total', instance=instance, reason='too_large')
+        return
+    if entry and entry['status'] == REJECTED:
+        print('resource rejected on an earlier crawl:', data_filename)
+        get_metrics().inc('skips_total', instance=instance, reason='rejected')
+        return
+
+    size_hint = get_resource_size(resource)
+    if not await engine.download(resource['url'], data_filename, instance=instance, size_hint=size_hint,
+                                 file_format=file_format):
+        print('failed resource:', strip_empty(resource))
+        return False
+
+    # convert workbooks as they arrive, off the event loop (unchanged ones are skipped)
+    if normalize and file_format in EXCEL_FORMATS:
+        await asyncio.get_running_loop().run_in_executor(None, normalize_file, data_filename, normalize)
+
+
+def changed_resources(resources, dataset_folder):
+    # resources that are new or differ from the metadata saved on the last crawl, or whose file is missing
+    metadata = load_metadata(dataset_folder)
+    if metadata is None:
+        return resources
+    saved = {resource.get('id'): resource for resource in metadata.get('resources', [])}
+
+    def unchanged(resource):
+        old = saved.get(resource.get('id'))
+        return (old is not None and all((resource.get(key) or None) == (old.get(key) or None) for key in RESOURCE_VERSION_KEYS)
+                and os.path.isfile('{0}/{1}'.format(dataset_folder, resource['url'].split('/')[-1])))
+
+    return [resource for resource in resources if not unchanged(resource)]
+
+
+def prepare_dataset(dataset, data_dir, formats, max_file_size=None, only_changed=False):
+    # writes the dataset's folder and metadata, returns (size, resource, dataset_folder) download jobs
+    # find resources with valid format etc.
+    valid_resources = [resource for resource in dataset['resources']
+                       if is_valid_resource(resource, formats, max_size=max_file_size)]
+    if not valid_resources:
+        return []
+
+    dataset_name = get_dataset_name(dataset)
+    dataset_folder = '{0}/{1}'.format(data_dir, dataset_name)
+    os.makedirs(dataset_folder, exist_ok=True)
+
+    if only_changed:
+        valid_resources = changed_resources(valid_resources, dataset_folder)
+    save_metadata(dataset, dataset_folder)
+    get_tag_index().set_tags(os.path.basename(os.path.normpath(data_dir)), dataset_name,
+                             [tag['display_name'] for tag in dataset.get('tags', [])])
+    return [(get_resource_size(resource), resource, dataset_folder) for resource in valid_resources]
+
+
+async def process_dataset(engine, dataset, data_dir, formats=['xls', 'xlsx', 'csv'], instance=None):
+    # downloads one dataset's resources smallest first, returns a list of errors for the dataset
+    jobs = sorted(prepare_dataset(dataset, data_dir, formats, engine.max_file_size), key=size_order)
+    results = await asyncio.gather(*[process_resource(engine, resource, dataset_folder, formats=formats, instance=instance)
+                                     for _, resource, dataset_folder in jobs], return_exceptions=True)
+    errors = []
+    for (_, resource, _), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            errors.append('{0}: {1!r}'.format(resource['url'], result))
+        elif result is False:
+            errors.append('{0}: download failed'.format(resource['url']))
+    return errors
+
+
+def size_order(job):
+    # known sizes ascending, unknown sizes after them
+    return (job[0] is None, job[0] or 0)
+
+
+def report_errors(tasks, ckan_url):
+    for task in tasks:
+        if task.exception():
+            print('error while scraping ckan resource:', ckan_url)
+            print('error:', task.exception())
+        elif task.result() is False:
+            print('failed download while scraping ckan resource:', ckan_url)
+
+
+def settle_placeholder(placeholder, task):
+    # hands a deferred download's outcome to the placeholder its catalog page waits on
+    if task.cancelled():
+        placeholder.cancel()
+    elif task.exception():
+        placeholder.set_exception(task.exception())
+    else:
+        placeholder.set_result(task.result())
+
+
+async def scrape_ckan_instance_async(engine, ckan_url="https://open.alberta.ca", formats=['xls', 'xlsx', 'csv'], data_dir='data/ckan',
+                                     page_size=PAGE_SIZE, incremental=False, normalize=None):
 
     print('scraping ckan instance', ckan_url)
     if not os.path.isdir(data_dir):
         os.makedirs(data_dir)
 
-    instance = RemoteCKAN(ckan_url)
-    print('retrieving list of instance datasets for', ckan_url)
-    datasets = instance.action.current_package_list_with_resources()  # limit, offset)
-
+    # catalog pages are only ever fetched one at a time, so the instance can keep one keep-alive session
+    instance = RemoteCKAN(ckan_url, session=get_session(get_host(ckan_url)))
+    instance_name = os.path.basename(os.path.normpath(data_dir))
+    if incremental:
+        # only datasets modified since the last sync, and of those only the resources that changed.
+        # the saved watermark doubles as the cursor, and the first sync of an instance is a full crawl
+        cursor = SyncState(os.path.join(data_dir, SYNC_FILENAME))
+        since = cursor.load()
+        print('syncing', ckan_url, 'from', since or 'scratch')
+        pages = iter_modified_pages(instance, since, page_size=page_size)
+    else:
+        cursor = CatalogCursor(os.path.join(data_dir, CURSOR_FILENAME))
+        start = cursor.load()
+        if start:
+            print('resuming catalog for', ckan_url, 'at offset', start)
+        pages = ((offset + len(page), page) for offset, page in iter_catalog_pages(instance, start=start, page_size=page_size))
+
+    if incremental:
+        # the watermark moves past datasets whether or not their downloads worked, so every sync
+        # first retries what the manifest still has as failed or interrupted under this instance
+        # (before the catalog, so a retry and a changed resource never write the same file at once)
+        unfinished = engine.manifest.unfinished(data_dir)
+        print('retrying', len(unfinished), 'failed downloads for', ckan_url)
+        retries = [await engine.spawn(process_resource(engine, {'url': url}, os.path.dirname(data_filename), formats=formats,
+                                                       instance=instance_name, normalize=normalize))
+                   for url, data_filename in unfinished]
+        if retries:
+            await asyncio.wait(retries)
+            report_errors(retries, ckan_url)
+
+    # datasets are handed to the downloaders page by page as the catalog is enumerated
     print('processing datasets for', ckan_url)
-    for dataset in datasets:
-        # print(dataset['title'])
-        # find resources with valid format etc.
-        valid_resources = [resource for resource in dataset['resources'] if is_valid_resource(resource, formats)]
-        if valid_resources:
-            try:
-                dataset_name = get_dataset_name(dataset)
-                dataset_folder = '{0}/{1}'.format(data_dir, dataset_name)
-                if not os.path.isdir(dataset_folder):
-                    os.mkdir(dataset_folder)
-
-                save_metadata(dataset, dataset_folder)
+    open_pages = []  # (cursor position after page, download tasks) for pages not yet fully processed
+    deferred = []  # (size, resource, dataset_folder, placeholder) for files too big to fetch before the rest
+    async for position, page in aiter_pages(pages):
+        jobs = []
+        for dataset in page:
+            jobs.extend(prepare_dataset(dataset, data_dir, formats, engine.max_file_size, only_changed=incremental))
+
+        # smallest files first, and known-large files wait until the whole catalog has been handed out
+        # so a few huge files can't hold up thousands of small ones. placeholders keep the cursor from
+        # moving past a page until its deferred files are done too
+        tasks = []
+        for size, resource, dataset_folder in sorted(jobs, key=size_order):
+            if size is not None and size >= engine.large_file_size:
+                placeholder = asyncio.get_running_loop().create_future()
+                deferred.append((size, resource, dataset_folder, placeholder))
+                tasks.append(placeholder)
+            else:
+                tasks.append(await engine.spawn(process_resource(engine, resource, dataset_folder, formats=formats,
+                                                                 instance=instance_name, normalize=normalize)))
+        open_pages.append((position, tasks))
+
+        # advance the cursor past every leading page whose downloads have all finished
+        while open_pages and all(task.done() for task in open_pages[0][1]):
+            next_position, done_tasks = open_pages.pop(0)
+            report_errors(done_tasks, ckan_url)
+            if next_position is not None:
+                cursor.save(next_position)
+
+    print('processing', len(deferred), 'large resources for', ckan_url)
+    for size, resource, dataset_folder, placeholder in sorted(deferred, key=size_order):
+        task = await engine.spawn(process_resource(engine, resource, dataset_folder, formats=formats, instance=instance_name,
+                                                   normalize=normalize))
+        task.add_done_callback(partial(settle_placeholder, placeholder))
+
+    for position, tasks in open_pages:
+        if tasks:
+            await asyncio.wait(tasks)
+        report_errors(tasks, ckan_url)
+        if incremental and position is not None:
+            cursor.save(position)
+    if not incremental:
+        cursor.clear()
+
+
+async def _scrape_with_engine(scrape_args, **engine_kwargs):
+    with Progress('ckan'):
+        async with DownloadEngine(**engine_kwargs) as engine:
+            results = await asyncio.gather(*[scrape_ckan_instance_async(engine, *args) for args in scrape_args],
+                                           return_exceptions=True)
+
+    for args, result in zip(scrape_args, results):
+        if isinstance(result, Exception):
+            print('error while scraping ckan instance:', args[0])
+            print('error:', result)
+
+
+def scrape_ckan_instance(ckan_url="https://open.alberta.ca", formats=['xls', 'xlsx', 'csv'], data_dir='data/ckan',
+                         global_limit=GLOBAL_CONCURRENCY, host_limit=HOST_CONCURRENCY, max_file_size=MAX_FILE_SIZE,
+                         instance_budget=None, incremental=False, normalize=None):
+    # normalize='csv' or 'parquet' converts every downloaded workbook right after it arrives
+    asyncio.run(_scrape_with_engine([(ckan_url, formats, data_dir, PAGE_SIZE, incremental, normalize)], global_limit=global_limit, host_limit=host_limit,
+                                    max_file_size=max_file_size, instance_budget=instance_budget))
+
+
+def async_ckan_scrape(formats=['xls', 'xlsx', 'csv', 'json', 'txt'], data_dir='data/ckan',
+                      global_limit=GLOBAL_CONCURRENCY, host_limit=HOST_CONCURRENCY, max_file_size=MAX_FILE_SIZE,
+                      instance_budget=None, incremental=False, check_health=True):
+    # scrape every instance on a single event loop, sharing the global and per-host caps
 
-                for resource in valid_resources:
-                    process_resource(resource, dataset_folder, formats=formats)
+    with open('ckan-instances.json') as json_file:
+        instance_urls = json.load(json_file)
 
-            except Exception as err:
-                print('error while scraping ckan resource:', ckan_url)
-                print('client dataset obj:', dataset['name'])
-                raise err
+    host_limits = None
+    if check_health:
+        # skip portals that are down and give the fast ones more connections
+        instance_urls, host_limits = rank_instances(instance_urls, probe_instances(instance_urls.values()), host_limit)
 
+    scrape_args = [(ckan_url, formats, os.path.join(data_dir, ckan_name), PAGE_SIZE, incremental)
+                   for ckan_name, ckan_url in instance_urls.items()]
 
-def parallel_ckan_scrape(formats=['xls', 'xlsx', 'csv', 'json', 'txt'], data_dir='data/ckan'):
+    print('scraping', len(scrape_args), 'instances concurrently')
+    asyncio.run(_scrape_with_engine(scrape_args, global_limit=global_limit, host_limit=host_limit, host_limits=host_limits,
+                                    max_file_size=max_file_size, instance_budget=instance_budget))
+
+
+def enumerate_instance(ckan_url, data_dir, formats, max_file_size, page_size, tracker, put):
+    # producer for the work queue: one item per dataset that has something worth downloading
+    os.makedirs(data_dir, exist_ok=True)
+    instance_name = os.path.basename(os.path.normpath(data_dir))
+    instance = RemoteCKAN(ckan_url, session=get_session(get_host(ckan_url)))
+    start = tracker.cursor.load()
+    if start:
+        print('resuming catalog for', ckan_url, 'at offset', start)
+
+    for offset, page in iter_catalog_pages(instance, start=start, page_size=page_size):
+        datasets = [dataset for dataset in page
+                    if any(is_valid_resource(resource, formats, max_size=max_file_size) for resource in dataset['resources'])]
+        page_end = offset + len(page)
+        tracker.add_page(page_end, len(datasets))
+        for dataset in datasets:
+            put({'id': '{0}:{1}'.format(instance_name, dataset['id']), 'source': instance_name, 'page': page_end,
+                 'name': dataset['name'], 'data_dir': data_dir, 'dataset': dataset})
+    tracker.finish_enumeration()
+
+
+async def _ckan_worker(work_queue, result_queue, formats, engine_kwargs):
+    async with DownloadEngine(**engine_kwargs) as engine:
+        async def handle(item):
+            return await process_dataset(engine, item['dataset'], item['data_dir'], formats, instance=item['source'])
+
+        await drain_work_queue(work_queue, result_queue, handle, max_active=engine.global_limit)
+
+
+def ckan_worker(work_queue, result_queue, formats, engine_kwargs):
+    with export_metrics():
+        asyncio.run(_ckan_worker(work_queue, result_queue, formats, engine_kwargs))
+
+
+def count_datasets(instance):
+    try:
+        return call_action(instance, 'package_search', rows=0)['count']
+    except (CKANAPIError, requests.exceptions.ConnectionError) as err:
+        print('could not count datasets for', instance.address, ':', err)
+        return None
+
+
+def add_ckan_shards(shard_queue, instance_urls, formats, data_dir, page_size=PAGE_SIZE, max_file_size=MAX_FILE_SIZE,
+                    shard_pages=SHARD_PAGES):
+    # split every catalog into page-aligned ranges; the ids are deterministic so any number of
+    # nodes can run this against the same queue. catalogs we can't count become one shard
+    shard_span = shard_pages*page_size
+    for ckan_name, ckan_url in instance_urls.items():
+        instance = RemoteCKAN(ckan_url, session=get_session(get_host(ckan_url)))
+        count = count_datasets(instance)
+        offsets = range(0, count, shard_span) if count else [0]
+        for offset in offsets:
+            is_last = count is None or offset + shard_span >= count
+            payload = {'ckan_url': ckan_url, 'data_dir': os.path.join(data_dir, ckan_name), 'formats': formats,
+                       'offset': offset, 'limit': None if is_last else shard_span, 'page_size': page_size,
+                       'max_file_size': max_file_size}
+            shard_queue.add('ckan:{0}:{1}'.format(ckan_name, offset), 'ckan', payload)
+        print('added', len(offsets), 'shards for', ckan_name)
+
+
+async def _scrape_ckan_shard(payload, heartbeat, engine_kwargs):
+    data_dir = payload['data_dir']
+    os.makedirs(data_dir, exist_ok=True)
+    instance_name = os.path.basename(os.path.normpath(data_dir))
+    instance = RemoteCKAN(payload['ckan_url'], session=get_session(get_host(payload['ckan_url'])))
+    end = payload['offset'] + payload['limit'] if payload['limit'] else None
+
+    async with DownloadEngine(**dict(engine_kwargs, max_file_size=payload['max_file_size'])) as engine:
+        tasks = []
+        try:
+            async for offset, page in aiter_catalog_pages(instance, start=payload['offset'], page_size=payload['page_size']):
+                if end is not None:
+                    if offset >= end:
+                        break
+                    page = page[:end - offset]
+                for dataset in page:
+                    heartbeat.check()
+                    tasks.append(await engine.spawn(process_dataset(engine, dataset, data_dir, payload['formats'],
+                                                                    instance=instance_name)))
+            # once the lease is gone another worker may have the shard, so stop downloading
+            pending = tasks
+            while pending:
+                _, pending = await asyncio.wait(pending, timeout=LEASE_CHECK_INTERVAL)
+                heartbeat.check()
+        except LeaseLost:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    # failed downloads are already recorded in the manifest, only crashes fail the shard
+    for task in tasks:
+        if task.exception():
+            raise task.exception()
+        for error in task.result():
+            print('error while scraping ckan dataset:', error)
+
+
+def ckan_shard_handler(payload, heartbeat, engine_kwargs=None):
+    with export_metrics():
+        asyncio.run(_scrape_ckan_shard(payload, heartbeat, engine_kwargs or {}))
+
+
+def parallel_ckan_scrape(formats=['xls', 'xlsx', 'csv', 'json', 'txt'], data_dir='data/ckan', n_workers=None,
+                         page_size=PAGE_SIZE, global_limit=GLOBAL_CONCURRENCY, host_limit=HOST_CONCURRENCY,
+                         max_file_size=MAX_FILE_SIZE, instance_budget=None, shard_queue=None, check_health=True):
 
     # read in list of ckan instances
     with open('ckan-instances.json') as json_file:
         instance_urls = json.load(json_file)
 
-    scrape_args = [(ckan_url, formats, os.path.join(data_dir, ckan_name))
-                   for ckan_name, ckan_url in instance_urls.items()]
-
-    pool = multiprocessing.Pool()
-    print('multiprocess mapping scrape func over instance list')
-    # pool.starmap(scrape_ckan_instance, scrape_args)
-    pool.starmap_async(scrape_ckan_instance, scrape_args)
-
-    pool.close()
-    pool.join()
-
-
-def collect_tagged_data(data_dir='data/ckan'):
-
-    for dataset in glob(os.path.join(data_dir, '*/*')):
-        print(dataset)
-        csv_files = glob(os.path.join(dataset, '**/*.csv'), recursive=True)
-        if csv_files:
-            # if there is a csv, there should be a metadata file
-            metadata_file = glob(os.path.join(dataset, '**/*_metadata.json'), recursive=True)
-            assert len(metadata_file) == 1
-            metadata_file = metadata_file[0]
-
-            metadata = read_json(metadata_file)
+    host_limits = {}
+    if check_health:
+        # skip portals that are down, enumerate the fast ones first and give them more connections
+        instance_urls, host_limits = rank_instances(instance_urls, probe_instances(instance_urls.values()), host_limit)
+
+    # each worker process runs its own download engine, so the connection caps and per-instance byte
+    # budgets are split between them (the per-host rate limiter is already shared across processes)
+    n_workers = n_workers or multiprocessing.cpu_count()
+    engine_kwargs = {'global_limit': max(1, global_limit // n_workers), 'host_limit': max(1, host_limit // n_workers),
+                     'host_limits': {host: max(1, limit // n_workers) for host, limit in host_limits.items()},
+                     'max_file_size': max_file_size,
+                     'instance_budget': max(1, instance_budget // n_workers) if instance_budget else None}
+
+    if shard_queue:
+        # multi-node mode: every node adds the (same) shards to the shared queue, then works on
+        # whatever shards are left until there are none
+        add_ckan_shards(get_shard_queue(shard_queue), instance_urls, formats, data_dir, page_size, max_file_size)
+        run_shard_workers(shard_queue, {'ckan': partial(ckan_shard_handler, engine_kwargs=engine_kwargs)}, n_workers)
+        return get_shard_queue(shard_queue).counts()
+
+    # datasets from every instance are interleaved onto one queue that all worker processes pull
+    # from, so a giant portal is spread over every core instead of pinning one process for days
+
+    trackers = {}
+    producers = {}
+    for ckan_name, ckan_url in instance_urls.items():
+        instance_dir = os.path.join(data_dir, ckan_name)
+        trackers[ckan_name] = PageTracker(CatalogCursor(os.path.join(instance_dir, CURSOR_FILENAME)))
+        producers[ckan_name] = partial(enumerate_instance, ckan_url, instance_dir, formats, max_file_size, page_size,
+                                       trackers[ckan_name])
+
+    def on_result(result):
+        trackers[result['source']].item_done(result['page'])
+        for error in result['errors']:
+            print('error while scraping ckan dataset:', result['id'])
+            print('error:', error)
+
+    print('scraping', len(producers), 'instances with', n_workers, 'worker processes')
+    # the workers export their download metrics as they go, this process counts datasets
+    with Progress('ckan'):
+        failures = run_work_queue(producers, ckan_worker, (formats, engine_kwargs), on_result=on_result,
+                                  n_workers=n_workers)
+
+    print(len(failures), 'datasets had errors')
+    for ckan_name, count in Counter(result['source'] for result in failures).most_common():
+        print(ckan_name, count)
+    return failures
+
+
+def collect_dataset(data_dir, folder):
+    # writes the tags file of one indexed dataset folder and stages its csvs, returns the tags
+    csv_files = folder_files(folder, '.csv')
+    if not csv_files:
+        return None
+
+    # if there is a csv, there should be metadata
+    metadata = load_metadata(folder['path'])
+    if metadata is None:
+        print('no metadata for:', folder['path'])
+        return None
+
+    # check if tags present; if so, pull them out of metadata
+    tags = [tg['display_name'] for tg in metadata.get('tags', [])]
+    if tags:
+        tags_fname = metadata_filename(folder['path']).replace('_metadata.', '_tags.')
+        write_json(tags, tags_fname)
+
+        # name the dir for writing the prep data to
+        prep_dir = os.path.join(data_dir, 'preprocessed', os.path.relpath(folder['path'], data_dir))
+        os.makedirs(prep_dir, exist_ok=True)
+        # dataset files are hardlinks into the blob store, so staging them costs no copying
+        for fname in [*csv_files, tags_fname]:
+            link_or_copy(fname, os.path.join(prep_dir, os.path.basename(fname)))
+    return tags
+
+
+def collect_tagged_data(data_dir='data/ckan', n_threads=INDEX_THREADS):
+    # dataset folders are <data_dir>/<instance>/<dataset>, listed in one pass from the persisted index
+    folders = get_folder_index().index(data_dir, depth=2, exclude=('preprocessed',))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for folder, tags in zip(folders, executor.map(partial(collect_dataset, data_dir), folders)):
+            if tags:
+                print(folder['path'], 'tags:', tags)
 
-            # check if tags present; if so, pull them out of metadata
 
-            tags = [tg['display_name'] for tg in metadata.get('tags', [])]
-            print('tags:', tags)
-            if tags:
-                tags_fname = metadata_file.replace('_metadata.', '_tags.')
-                write_json(tags, tags_fname)
-
-                # name the dir for writing the prep data to
-                dataset_path = os.path.split(metadata_file)[0]
-                rel_dataset_path = dataset_path.replace(data_dir, '')
-                rel_dataset_path = rel_dataset_path[1:] if rel_dataset_path[0] is '/' else rel_dataset_path
-                prep_dir = os.path.join(data_dir, 'preprocessed', rel_dataset_path)
-                print('pred dir:', prep_dir)
-                if not os.path.isdir(prep_dir):
-                    os.makedirs(prep_dir)
-                subprocess.call(['cp', *csv_files, tags_fname, prep_dir])
-
-
-def get_alltags_list(data_dir='data/ckan'):
-    tag_files = glob(os.path.join(data_dir, '**/*_tags.json'), recursive=True)
-    all_tags = Counter(np.concatenate([read_json(tgf) for tgf in tag_files]))
+def get_alltags_list(source=None, n_tags=100):
+    # straight from the tag index the scrapers keep up to date, no tags files are read
+    all_tags = get_tag_index().top_tags(n_tags, source=source)
     print(all_tags)
+    return all_tags
 
 
 if __name__ == '__main__':
+    # async_ckan_scrape()
     # parallel_ckan_scrape()
     # collect_tagged_data()
     get_alltags_list()
@@ -0,0 +1,52 @@
+import os
+import threading
+from functools import partial
+
+import boto3
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+
+
+POOL_SIZE = 16
+S3_POOL_SIZE = 32
+
+_local = threading.local()
+_s3_clients = {}
+
+
+def remember_retry_after(session, response, *args, **kwargs):
+    session.last_retry_after = response.headers.get('Retry-After')
+
+
+def get_session(host):
+    # keep-alive session per host, kept per thread (requests sessions aren't thread safe) and
+    # per process (sockets mustn't be shared across a fork)
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+
+    key = (os.getpid(), host)
+    if key not in sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # ckanapi only hands back the status and body of a response, so the Retry-After of the last
+        # one is kept on the session for the rate limiter
+        session.last_retry_after = None
+        session.hooks['response'].append(partial(remember_retry_after, session))
+        sessions[key] = session
+    return sessions[key]
+
+
+def init_s3_worker(**client_kwargs):
+    # pool initializer: build this worker process's s3 client once, it is reused for every object
+    config = Config(max_pool_connections=S3_POOL_SIZE, retries={'max_attempts': 10, 'mode': 'adaptive'})
+    _s3_clients[os.getpid()] = boto3.client('s3', config=config, **client_kwargs)
+
+
+def get_s3_client(**client_kwargs):
+    if os.getpid() not in _s3_clients:
+        init_s3_worker(**client_kwargs)
+    return _s3_clients[os.getpid()]
@@ -0,0 +1,214 @@
+import codecs
+import csv
+import json
+import multiprocessing
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from blob_store import get_blob_store, hash_file
+from fs_index import folder_files, get_folder_index
+from sniff import DELIMITERS, SNIFF_SIZE
+
+
+PROFILES_PATH = 'data/csv-profiles.parquet'
+SAMPLE_SIZE = 20
+MAX_FIELD_SIZE = 16 << 20  # some portals put whole documents in a cell
+
+# trees the profiling stage walks: (root, folder depth)
+PROFILE_TREES = (
+    ('data/ckan/preprocessed', 2),
+    ('data/ddw-s3/labeled', 1),
+)
+
+NULL_VALUES = {'', 'na', 'n/a', 'nan', 'null', 'none', '-', '.'}
+BOOL_VALUES = {'true', 'false', 'yes', 'no', 't', 'f', 'y', 'n'}
+INT_RE = re.compile(r'^[-+]?\d[\d,]*$')
+FLOAT_RE = re.compile(r'^[-+]?(\d[\d,]*\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+DATE_RE = re.compile(r'^(\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{2,4})([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?Z?$')
+
+# a column's type is the first of these every non-null value fits
+TYPES = ('bool', 'int', 'float', 'date', 'string')
+TYPE_CHECKS = {
+    'bool': lambda value: value.lower() in BOOL_VALUES,
+    'int': INT_RE.match,
+    'float': FLOAT_RE.match,
+    'date': DATE_RE.match,
+}
+
+
+def sniff_dialect(head):
+    try:
+        return csv.Sniffer().sniff(head, delimiters=DELIMITERS)
+    except csv.Error:
+        return csv.excel
+
+
+class ColumnStats:
+    # constant-size running stats for one column: null count and the types still consistent with it
+
+    def __init__(self):
+        self.n_null = 0
+        self.types = list(TYPES[:-1])
+
+    def add(self, value):
+        value = value.strip()
+        if value.lower() in NULL_VALUES:
+            self.n_null += 1
+            return
+        if self.types:
+            self.types = [col_type for col_type in self.types if TYPE_CHECKS[col_type](value)]
+
+    def inferred_type(self, n_rows):
+        if self.n_null == n_rows:
+            return 'empty'
+        return self.types[0] if self.types else 'string'
+
+
+def profile_csv(csv_filename, sample_size=SAMPLE_SIZE, seed=0):
+    # one streaming pass: header, row count, per-column type and null rate, and a uniform sample of
+    # rows (reservoir sampling), in memory bounded by the widest row and the sample
+    with open(csv_filename, 'rb') as csv_file:
+        head = csv_file.read(SNIFF_SIZE)
+    try:
+        # not final, so a multibyte character cut off at the end of the head doesn't count against utf-8
+        codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'latin-1'  # never fails, so odd encodings still get profiled
+    dialect = sniff_dialect(head.decode(encoding, errors='ignore'))
+
+    rng = random.Random(seed)
+    sample = []
+    with open(csv_filename, newline='', encoding=encoding, errors='replace') as csv_file:
+        reader = csv.reader(csv_file, dialect)
+        header = next(reader, [])
+        stats = [ColumnStats() for _ in header]
+        n_rows = 0
+        for row in reader:
+            if not row:
+                continue
+            n_rows += 1
+            for col_stats, value in zip(stats, row):
+                col_stats.add(value)
+            for col_stats in stats[len(row):]:
+                col_stats.n_null += 1  # short rows are missing their trailing values
+            if len(sample) < sample_size:
+                sample.append(row)
+            else:
+                ind = rng.randrange(n_rows)
+                if ind < sample_size:
+                    sample[ind] = row
+
+    return {
+        'columns': header,
+        'types': [col_stats.inferred_type(n_rows) for col_stats in stats],
+        'null_rates': [col_stats.n_null/n_rows if n_rows else 0.0 for col_stats in stats],
+        'n_rows': n_rows,
+        'delimiter': dialect.delimiter,
+        'encoding': encoding,
+        'sample': json.dumps(sample),
+    }
+
+
+def content_hash(csv_filename):
+    # downloads were hashed on the way into the blob store, only other files need reading. the
+    # preprocessed and labeled copies are hardlinks at other paths, so they're matched by inode
+    blob_store = get_blob_store()
+    sha256 = blob_store.lookup_file(csv_filename)
+    if sha256:
+        return sha256
+    ref = blob_store.lookup(csv_filename)
+    if ref and ref['size'] == os.path.getsize(csv_filename):
+        return ref['sha256']
+    return hash_file(csv_filename)
+
+
+_known_profiles = {}
+
+
+def set_known_profiles(known):
+    # pool initializer, so the earlier profiles are sent to each worker once rather than with every file
+    _known_profiles.update(known)
+
+
+def profile_file(csv_filename, dataset, sample_size=SAMPLE_SIZE):
+    # a profile of the same content from an earlier run (see set_known_profiles) is reused as is
+    csv.field_size_limit(MAX_FIELD_SIZE)
+    sha256 = content_hash(csv_filename)
+    if sha256 in _known_profiles:
+        profile = dict(_known_profiles[sha256])
+    else:
+        profile = profile_csv(csv_filename, sample_size)
+    profile.update({'path': csv_filename, 'dataset': dataset, 'sha256': sha256})
+    return profile
+
+
+def csv_files(root, depth=1):
+    # (csv path, dataset id) for every csv in the dataset folders under root
+    files = []
+    for folder in get_folder_index().index(root, depth=depth):
+        dataset = os.path.relpath(folder['path'], root)
+        files.extend((csv_filename, dataset) for csv_filename in folder_files(folder, '.csv'))
+    return files
+
+
+def load_profiles(profiles_path=PROFILES_PATH):
+    import pyarrow.parquet as pq
+
+    if not os.path.isfile(profiles_path):
+        return []
+    return pq.read_table(profiles_path).to_pylist()
+
+
+def write_profiles(profiles, profiles_path=PROFILES_PATH):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(profiles_path) or '.', exist_ok=True)
+    schema = pa.schema([
+        ('path', pa.string()),
+        ('dataset', pa.string()),
+        ('sha256', pa.string()),
+        ('n_rows', pa.int64()),
+        ('columns', pa.list_(pa.string())),
+        ('types', pa.list_(pa.string())),
+        ('null_rates', pa.list_(pa.float32())),
+        ('delimiter', pa.string()),
+        ('encoding', pa.string()),
+        ('sample', pa.string()),  # json list of rows
+    ])
+    table = pa.Table.from_pylist(sorted(profiles, key=lambda profile: profile['path']), schema=schema)
+    tmp_path = profiles_path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, profiles_path)
+
+
+def profile_all(trees=PROFILE_TREES, profiles_path=PROFILES_PATH, n_workers=None, sample_size=SAMPLE_SIZE):
+    # profiles every csv under the trees into one parquet file, one row per csv. files whose content
+    # hash matches an existing profile are not read again
+    files = []
+    for root, depth in trees:
+        if os.path.isdir(root):
+            files.extend(csv_files(root, depth))
+
+    get_blob_store().index_inodes()
+    known = {profile['sha256']: {key: value for key, value in profile.items() if key not in ('path', 'dataset', 'sha256')}
+             for profile in load_profiles(profiles_path)}
+    profiles = []
+    with ProcessPoolExecutor(max_workers=n_workers or multiprocessing.cpu_count(), initializer=set_known_profiles,
+                             initargs=(known,)) as executor:
+        futures = {executor.submit(profile_file, csv_filename, dataset, sample_size): csv_filename
+                   for csv_filename, dataset in files}
+        for future in as_completed(futures):
+            try:
+                profiles.append(future.result())
+            except Exception as e:
+                print('error profiling', futures[future])
+                print('error:', e)
+
+    n_reused = sum(profile['sha256'] in known for profile in profiles)
+    print('profiled', len(profiles), 'of', len(files), 'csv files ({0} unchanged)'.format(n_reused))
+    write_profiles(profiles, profiles_path)
+    return profiles
@@ -1,91 +1,184 @@
 from datadotworld.client import api as ddw
-import requests
 import json
 import pandas as pd
 import numpy as np
 import boto3
 import os
-import glob
-import scipy.sparse as sp
 # from embedding import Embedding
-from utils import get_timestamp, write_json, read_json
+from utils import write_json, read_json
 from dotenv import load_dotenv
 import multiprocessing
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from boto3.s3.transfer import TransferConfig
-
+from blob_store import get_blob_store, hash_file
+from botocore.exceptions import ClientError
+from connections import get_s3_client, init_s3_worker
+from features import FEATURE_DIR, FEATURE_FIELDS, dataset_headers, load_feature_matrix, load_vectors, write_feature_matrix
+from fs_index import get_folder_index
+from manifest import COMPLETE, FAILED, get_manifest, is_complete
+from metadata_cache import get_metadata_cache
+from metadata_catalog import ddw_entry, get_metadata_catalog, metadata_file_missing, record_metadata
+from metrics import Progress, export_metrics, get_metrics, profile_section
+from part_file import BUFFER_SIZE, PartFile
+from rate_limit import ThroughputTarget, limited_get
+from shards import get_shard_queue, run_shard_workers
+from tag_index import get_tag_index
+from target_matrix import TARGET_CHUNK_SIZE, TARGET_DIR, load_target_matrix, write_target_matrix
+
+
+MIRROR_QUEUE_SIZE = 1024
+MULTIPART_THRESHOLD = 64 << 20
+MULTIPART_CHUNKSIZE = 16 << 20
+MULTIPART_CONCURRENCY = 8
+S3_SHARD_THREADS = 16
+CONTROL_INTERVAL = 5  # seconds between re-reads of the mirror control file
 
 load_dotenv(dotenv_path='ddw.env')
 TOKEN = os.getenv("TOKEN")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ACCESS_KEY = os.getenv("ACCESS_KEY")
+DDW_API_URL = os.getenv("DDW_API_URL", 'https://api.data.world/v0')  # overridden to point at a local stand-in
+
+
+def export_table_json(sql_url, table_name, data_filepath, req_params):
+    # loads the whole table into memory, kept for comparison with the streaming export
+    data_query = 'SELECT * FROM {0}'.format(table_name)
+    # , 'includeTableSchema': False (in params)
+    data = limited_get(sql_url, params={'query': data_query}, **req_params)
+    if data.status_code == 200:
+        data = json.loads(data.content)
+        df = pd.DataFrame(data)
+        # print('saving to file:', data_filepath)
+        df.to_csv(data_filepath, index=False)
+    else:
+        print('request failed:', data.__dict__)
+
+
+def export_table_csv(sql_url, table_name, data_filepath, req_params):
+    # ask the sql endpoint for csv and stream it to disk, never holding more than one buffer
+    data_query = 'SELECT * FROM {0}'.format(table_name)
+    headers = dict(req_params['headers'], Accept='text/csv')
+    response = limited_get(sql_url, params={'query': data_query}, headers=headers, stream=True)
+    try:
+        if response.status_code != 200:
+            print('request failed:', response.status_code, sql_url, table_name)
+            return
+
+        part = PartFile(data_filepath)
+        try:
+            part.open()
+            for chunk in response.iter_content(chunk_size=BUFFER_SIZE):
+                part.write(chunk)
+            part.commit()
+        finally:
+            part.close()
+    finally:
+        response.close()
+
+
+def list_dataset_tables(base_url, ds, req_params, data_dir='data/ddw'):
+    # saves the dataset's tags and returns (sql_url, table_name, data_filepath) for each table
+    key = '{0}/{1}'.format(ds['owner'], ds['id'])
+    file_key = key.replace('/', '_')
+    print('processing dataset:', file_key)
+
+    ds_content, _ = get_metadata_cache().get_or_fetch(
+        key, lambda: fetch_dataset_metadata(base_url, ds['owner'], ds['id'], req_params))
+    if ds_content is None:
+        return []
+
+    with open('{0}/{1}_tags.json'.format(data_dir, file_key), 'w') as json_file:
+        json.dump(ds_content['tags'], json_file, indent=2)
+    get_tag_index().set_tags('ddw', file_key, ds_content['tags'])
+
+    # get table names
+    table_query = 'SELECT * FROM Tables'
+    sql_url = '{0}/sql/{1}'.format(base_url, key)
+    tables = limited_get(sql_url, params={'query': table_query}, **req_params)
+    tables = json.loads(tables.content)
+
+    table_args = []
+    for table in tables:
+        if table:
+            table_name = table['tableId']
+            if table_name:
+                # print('reading from table:', table_name)
+                data_filepath = '{0}/{1}_{2}.csv'.format(data_dir, file_key, table_name)
+                table_args.append((sql_url, table_name, data_filepath))
+            else:
+                print('missing table id:', table)
+        else:
+            print('missing table in:', tables)
+    return table_args
 
 
-def scrape_ddw(user='craig-corcoran', project='dataset-labeling'):
+def scrape_ddw(user='craig-corcoran', project='dataset-labeling', data_dir='data/ddw', streaming=True, n_workers=8):
 
     req_params = {'headers': {'Authorization': 'Bearer {0}'.format(TOKEN)}}
-    response = requests.get('https://api.data.world/v0/projects/{0}/{1}'.format(user, project), **req_params)
+    response = limited_get('{0}/projects/{1}/{2}'.format(DDW_API_URL, user, project), **req_params)
     content = json.loads(response.content)
 
     datasets = content['linkedDatasets']
 
-    base_url = 'https://api.data.world/v0'
-
-    tags = {}
-    for ds in datasets:
-        key = '{0}/{1}'.format(ds['owner'], ds['id'])
-        file_key = key.replace('/', '_')
-        print('processing dataset:', file_key)
-
-        dat_url = '{0}/datasets/{1}'.format(base_url, key)
-        response = requests.get(dat_url, **req_params)
-        ds_content = json.loads(response.content)
-        tags[key] = ds_content['tags']
-
-        with open('data/ddw/{0}_tags.json'.format(file_key), 'w') as json_file:
-            json.dump(ds_content['tags'], json_file, indent=2)
-
-        # get table names
-        table_query = 'SELECT * FROM Tables'
-        sql_url = '{0}/sql/{1}'.format(base_url, key)
-        tables = requests.get(sql_url, params={'query': table_query}, **req_params)
-        tables = json.loads(tables.content)
-
-        for table in tables:
-            if table:
-                table_name = table['tableId']
-                if table_name:
-                    # print('reading from table:', table_name)
-                    data_query = 'SELECT * FROM {0}'.format(table_name)
-                    # , 'includeTableSchema': False (in params)
-                    data = requests.get(sql_url, params={'query': data_query}, **req_params)
-                    if data.status_code == 200:
-                        try:
-                            data = json.loads(data.content)
-                            df = pd.DataFrame(data)
-                            data_filepath = 'data/ddw/{0}_{1}.csv'.format(file_key, table_name)
-                            # print('saving to file:', data_filepath)
-                            df.to_csv(data_filepath, index=False)
-
-                        except Exception as e:
-                            print('error:', e)
-                    else:
-                        print('request failed:', data.__dict__)
-                else:
-                    print('missing table id:', table)
-            else:
-                print('missing table in:', tables)
+    base_url = DDW_API_URL
+    export_table = export_table_csv if streaming else export_table_json
+    os.makedirs(data_dir, exist_ok=True)
+
+    # datasets are listed and their tables exported concurrently on one bounded pool; only this
+    # thread submits work, so dataset jobs never wait on table jobs queued behind them
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        dataset_futures = {executor.submit(list_dataset_tables, base_url, ds, req_params, data_dir): ds for ds in datasets}
+        table_futures = {}
+        for future in as_completed(dataset_futures):
+            try:
+                for table_args in future.result():
+                    table_futures[executor.submit(export_table, *table_args, req_params)] = table_args
+            except Exception as e:
+                print('error with dataset:', dataset_futures[future])
+                print('error:', e)
+
+        for future in as_completed(table_futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('error with table:', table_futures[future][1:])
+                print('error:', e)
 
 
 def metadata_present(metadata_fname):
     return os.path.isfile(metadata_fname) and (os.path.getsize(metadata_fname) > 0)
 
 
-def process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name, formats):
+def fetch_dataset_metadata(base_url, owner, data_key, req_params, metadata_fname=None):
+    # metadata written by runs before the cache existed is reused instead of asking the api again
+    if metadata_fname and metadata_present(metadata_fname):
+        return read_json(metadata_fname)
+
+    # print('getting metadata for dataset: {0}/{1}'.format(owner, data_key))
+    response = limited_get('{0}/datasets/{1}/{2}'.format(base_url, owner, data_key), **req_params)
+    if response.status_code != 200:
+        print('metadata request failed:', response.status_code, owner, data_key)
+        return None
+    return json.loads(response.text)
+
+
+def dataset_files_missing(bucket_name, data_id, dir_path, content):
+    tags_fname = '{0}/{1}_tags.json'.format(dir_path, data_id)
+    return ((content.get('tags') and not os.path.isfile(tags_fname)) or metadata_file_missing(dir_path)
+            or get_metadata_catalog().folder(bucket_name, data_id) != dir_path)
+
+
+def process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name, formats, etag=None, size=None,
+                          throughput=None):
+    with profile_section('process_bucket_object'), get_metrics().timer('object_seconds', instance=bucket_name):
+        return _process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name, formats, etag, size,
+                                      throughput)
+
+
+def _process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name, formats, etag, size, throughput):
 
     # print('processing object: ', obj)
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
+    s3_client = get_s3_client()  # built once per worker, see init_s3_worker
 
     # object keys are of the form: derived/<owner>/<dataset-name>/<file-name>
     # remove "derived" prefix, replace "/" in path with "." for filename
@@ -98,55 +191,126 @@ def process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name,
     # print('processing object: ', data_id)
 
     dir_path = '{0}/{1}'.format(base_dir, data_id)
-    if not os.path.isdir(dir_path):
-        try:
-            os.makedirs(dir_path)
-        except FileExistsError as err:
-            print('async directory creation error:', err)
+    os.makedirs(dir_path, exist_ok=True)
 
     # TODO handle deeper nested directories (getting "does not exist" from ddw api)
+    # every object in a dataset asks for the same metadata, the cache makes sure only one of them
+    # (across all workers) actually calls the api and only the first one writes the files
     metadata_fname = '{0}/{1}_metadata.json'.format(dir_path, data_id)
-    if not metadata_present(metadata_fname):
-        try:
-            # print('getting metadata for dataset: {0}'.format(data_id))
-            response = requests.get('{0}/datasets/{1}/{2}'.format(base_url, owner, data_key), **req_params)
-            content = json.loads(response.text)
-
-            write_json(content, metadata_fname)
+    try:
+        content, fetched = get_metadata_cache().get_or_fetch(
+            '{0}/{1}'.format(owner, data_key),
+            lambda: fetch_dataset_metadata(base_url, owner, data_key, req_params, metadata_fname))
+        # cached metadata still gets written out if its files or catalog record are gone, e.g. when
+        # mirroring into a fresh base_dir, after a folder was deleted or a crash right after caching
+        if content is not None and (fetched or dataset_files_missing(bucket_name, data_id, dir_path, content)):
+            record_metadata(bucket_name, data_id, content, dir_path, ddw_entry(content))
             if content.get('tags'):
                 # print('found tags from', metadata_fname, content['tags'])
                 tags_fname = '{0}/{1}_tags.json'.format(dir_path, data_id)
                 write_json(content['tags'], tags_fname)
+            get_tag_index().set_tags(bucket_name, data_id, content.get('tags'))
 
-        except Exception as e:
-            print('error with metadata in:', metadata_fname)
-            print('error:', e)
-            # raise e
+    except Exception as e:
+        print('error with metadata in:', metadata_fname)
+        print('error:', e)
+        # raise e
 
-    # skip if file is already present,
+    # skip if the manifest says we already have this version of the object
     data_fname = '{0}/{1}'.format(dir_path, fname)
+    data_url = 's3://{0}/{1}'.format(bucket_name, obj_key)
     file_format = os.path.splitext(fname)[1].replace('.', '')
-    if os.path.isfile(data_fname) and os.path.getsize(data_fname) > 0:
+    manifest = get_manifest()
+    entry = manifest.get(data_url, data_fname)
+    # without a listing etag to compare, objects with a recorded etag get a conditional download below
+    metrics = get_metrics()
+    if is_complete(entry) and (entry['etag'] == etag if etag else not entry['etag']):
         print('file already present:', data_fname)
+        metrics.inc('skips_total', instance=bucket_name, reason='present')
+        return
 
     # if formats are given, make sure file format is in desired formats
-    elif (formats and file_format in formats) or not formats:
+    if (formats and file_format in formats) or not formats:
+        # files saved before the manifest existed count as present if they match the listed size
+        if entry is None and size is not None and os.path.isfile(data_fname) and os.path.getsize(data_fname) == size:
+            print('file already present:', data_fname)
+            manifest.record(data_url, data_fname, COMPLETE, size=size, etag=etag)
+            metrics.inc('skips_total', instance=bucket_name, reason='present')
+            return
+
+        extra_args = conditional_s3_args(entry)
         try:
+            # only transfers count against the mirror's byte rate, skipped objects don't
+            if throughput:
+                throughput.wait(size)
             print('saving file:', data_fname)
-            config = TransferConfig(use_threads=False)
-            s3.meta.client.download_file(bucket_name, obj_key, data_fname, Config=config)
+            data_size, sha256 = download_bucket_object(s3_client, bucket_name, obj_key, data_fname, size, extra_args)
             # bucket.download_file(obj_key, data_fname)
+            get_blob_store().adopt(data_fname, sha256, data_size, bucket_name)
+            manifest.record(data_url, data_fname, COMPLETE, size=data_size, sha256=sha256, etag=etag)
+            metrics.inc('files_total', instance=bucket_name, result='downloaded')
+            metrics.inc('bytes_total', data_size, instance=bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                print('file unchanged:', data_fname)
+                manifest.record(data_url, data_fname, COMPLETE)
+                metrics.inc('files_total', instance=bucket_name, result='unchanged')
+            else:
+                print('error with file', obj_key)
+                print('error:', e)
+                metrics.inc('failures_total', instance=bucket_name, reason=e.response['Error']['Code'])
+                if not is_complete(entry):
+                    manifest.record(data_url, data_fname, FAILED)
         except Exception as e:
             print('error with file', obj_key)
             print('error:', e)
-    # else:
-    #     print('invalid format:', data_fname)
+            metrics.inc('failures_total', instance=bucket_name, reason=type(e).__name__)
+            if not is_complete(entry):
+                manifest.record(data_url, data_fname, FAILED)
+    else:
+        # print('invalid format:', data_fname)
+        metrics.inc('skips_total', instance=bucket_name, reason='format')
+
+
+def download_bucket_object(s3_client, bucket_name, obj_key, data_fname, size=None, extra_args={}):
+    # small objects stream through a part file and get hashed on the way in, big ones are fetched as
+    # concurrent ranged parts and hashed afterwards
+    if size is not None and size >= MULTIPART_THRESHOLD:
+        s3_client.download_file(bucket_name, obj_key, data_fname, ExtraArgs=extra_args, Config=transfer_config(size))
+        return os.path.getsize(data_fname), hash_file(data_fname)
+
+    response = s3_client.get_object(Bucket=bucket_name, Key=obj_key, **extra_args)
+    part = PartFile(data_fname)
+    try:
+        part.open()
+        for chunk in response['Body'].iter_chunks(chunk_size=BUFFER_SIZE):
+            part.write(chunk)
+        return part.commit(response['ContentLength'])
+    finally:
+        part.close()
+        response['Body'].close()
+
+
+def transfer_config(size):
+    # small objects go in one request on the worker's own thread, big ones get split into ranged
+    # parts fetched concurrently
+    if size is not None and size >= MULTIPART_THRESHOLD:
+        return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                              max_concurrency=MULTIPART_CONCURRENCY, use_threads=True)
+    return TransferConfig(use_threads=False)
+
+
+def conditional_s3_args(entry):
+    # the s3 equivalent of conditional_headers, used when we have no listing etag to compare with
+    if is_complete(entry) and entry['etag']:
+        return {'IfNoneMatch': entry['etag']}
+    return {}
 
 
 def read_s3_serial(base_dir='data/ddw-s3', bucket_name='dataworld-newknowledge-us-east-1', formats=['xls', 'xlsx', 'csv', 'json', 'txt'], batch_size=64):
 
     req_params = {'headers': {'Authorization': 'Bearer {0}'.format(TOKEN)}}
-    base_url = 'https://api.data.world/v0'
+    base_url = DDW_API_URL
 
     s3 = boto3.resource('s3',
                         aws_access_key_id=ACCESS_KEY,  # TODO Needed or even working? seems to load from ~/.aws/credentials instead
@@ -159,47 +323,134 @@ def read_s3_serial(base_dir='data/ddw-s3', bucket_name='dataworld-newknowledge-u
     if not os.path.isdir(base_dir):
         os.makedirs(base_dir)
 
-    for i, page in enumerate(obj_gen.pages()):
-        # process_bucket_object(obj, base_dir, base_url, req_params, bucket, formats)
-        print('page', i)
-        scrape_args = [(obj.key, base_dir, base_url, req_params, bucket_name, formats) for obj in page]
-        for args in scrape_args:
-            process_bucket_object(*args)
+    with Progress('s3'):
+        for i, page in enumerate(obj_gen.pages()):
+            # process_bucket_object(obj, base_dir, base_url, req_params, bucket, formats)
+            print('page', i)
+            scrape_args = [(obj.key, base_dir, base_url, req_params, bucket_name, formats, obj.e_tag, obj.size) for obj in page]
+            for args in scrape_args:
+                process_bucket_object(*args)
 
 
-def read_s3_parallel(base_dir='data/ddw-s3', bucket_name='dataworld-newknowledge-us-east-1', formats=['xls', 'xlsx', 'csv', 'json', 'txt'], batch_size=64):
+def read_throughput_target(control_file, default):
+    # the control file lets a running mirror be retuned, e.g. {"target_mbps": 200}
+    if os.path.isfile(control_file) and os.path.getsize(control_file) > 0:
+        try:
+            return read_json(control_file).get('target_mbps', 0)*2**20
+        except ValueError as err:
+            print('bad mirror control file:', err)
+    return default
+
+
+def mirror_worker(queue, throughput, control_file, base_dir, base_url, req_params, bucket_name, formats):
+    init_s3_worker()
+    with export_metrics():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            # the workers pick up a retuned target, so it keeps working after listing has finished
+            if throughput.check_due(CONTROL_INTERVAL):
+                throughput.set_target(read_throughput_target(control_file, throughput.target.value))
+            obj_key, etag, size = item
+            try:
+                process_bucket_object(obj_key, base_dir, base_url, req_params, bucket_name, formats, etag=etag, size=size,
+                                      throughput=throughput)
+            except Exception as e:
+                print('error with object', obj_key)
+                print('error:', e)
+
+
+def add_s3_shards(shard_queue, base_dir, bucket_name, formats, prefix='derived'):
+    # one shard per owner, i.e. per derived/<owner>/ prefix
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    n_shards = 0
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix.rstrip('/') + '/', Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            owner_prefix = common_prefix['Prefix']
+            payload = {'prefix': owner_prefix, 'base_dir': base_dir, 'bucket_name': bucket_name, 'formats': formats}
+            shard_queue.add('s3:{0}:{1}'.format(bucket_name, owner_prefix), 's3', payload)
+            n_shards += 1
+    print('added', n_shards, 'shards for bucket', bucket_name)
+
+
+def process_shard_object(heartbeat, *args, **kwargs):
+    # once the lease is gone another worker may have the shard, so the objects left are dropped
+    heartbeat.check()
+    return process_bucket_object(*args, **kwargs)
+
+
+def s3_shard_handler(payload, heartbeat):
+    req_params = {'headers': {'Authorization': 'Bearer {0}'.format(TOKEN)}}
+    base_url = DDW_API_URL
+    os.makedirs(payload['base_dir'], exist_ok=True)
+
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    with export_metrics(), ThreadPoolExecutor(max_workers=S3_SHARD_THREADS) as executor:
+        futures = []
+        for page in paginator.paginate(Bucket=payload['bucket_name'], Prefix=payload['prefix']):
+            heartbeat.check()
+            for obj in page.get('Contents', []):
+                futures.append(executor.submit(process_shard_object, heartbeat, obj['Key'], payload['base_dir'], base_url,
+                                               req_params, payload['bucket_name'], payload['formats'], etag=obj['ETag'],
+                                               size=obj['Size']))
+        for future in futures:
+            future.result()
+
+
+def read_s3_parallel(base_dir='data/ddw-s3', bucket_name='dataworld-newknowledge-us-east-1', formats=['xls', 'xlsx', 'csv', 'json', 'txt'], batch_size=64,
+                     n_workers=None, queue_size=MIRROR_QUEUE_SIZE, target_mbps=0, control_file=None, shard_queue=None):
+
+    if shard_queue:
+        # multi-node mode: every node adds the (same) per-owner shards to the shared queue, then
+        # works on whatever shards are left until there are none
+        add_s3_shards(get_shard_queue(shard_queue), base_dir, bucket_name, formats)
+        run_shard_workers(shard_queue, {'s3': s3_shard_handler}, n_workers)
+        return get_shard_queue(shard_queue).counts()
 
     req_params = {'headers': {'Authorization': 'Bearer {0}'.format(TOKEN)}}
-    base_url = 'https://api.data.world/v0'
+    base_url = DDW_API_URL
 
     s3 = boto3.resource('s3',
                         # aws_access_key_id=ACCESS_KEY,  # TODO Needed or even working? seems to load from ~/.aws/credentials instead
                         # aws_secret_access_key=SECRET_KEY,
                         )
 
-    # client.download_file(Bucket="mybucket",
-    #                      Key="foo/bar.fastq.gz", Filename="bar.fastq.gz", Config=config)
-
     bucket = s3.Bucket(bucket_name)
     obj_gen = bucket.objects.filter(Prefix='derived')
 
     if not os.path.isdir(base_dir):
         os.makedirs(base_dir)
 
-    for i, page in enumerate(obj_gen.pages()):
-        print('page', i)
-        with multiprocessing.Pool() as pool:
-            scrape_args = [(obj.key, base_dir, base_url, req_params, bucket_name, formats) for obj in page]
-            print('multiprocess mapping scrape func over batch of', len(scrape_args), 'objects from bucket')
-            # pool.starmap_async(process_bucket_object, scrape_args)
-            pool.starmap(process_bucket_object, scrape_args)
-            time.sleep(2)
-
-        pool.join()
-
-    # pool.close()
-
-    # pool.starmap(process_bucket_object, scrape_args)
+    # listing feeds a bounded queue drained by long-lived workers, so the next page is listed while
+    # the current one downloads and a slow page never stalls the whole mirror
+    control_file = control_file or '{0}/_mirror-control.json'.format(base_dir)
+    throughput = ThroughputTarget(read_throughput_target(control_file, target_mbps*2**20))
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    worker_args = (queue, throughput, control_file, base_dir, base_url, req_params, bucket_name, formats)
+    workers = [multiprocessing.Process(target=mirror_worker, args=worker_args)
+               for _ in range(n_workers or multiprocessing.cpu_count())]
+
+    # the workers export their download metrics as they go, this process counts what it queued
+    metrics = get_metrics()
+    with Progress('s3'):
+        for worker in workers:
+            worker.start()
+        try:
+            for i, page in enumerate(obj_gen.pages()):
+                print('page', i, 'queueing', len(page), 'objects')
+                for obj in page:
+                    queue.put((obj.key, obj.e_tag, obj.size))
+                metrics.inc('items_total', len(page), source=bucket_name, result='queued')
+                try:
+                    metrics.set('queue_depth', queue.qsize(), queue='mirror')
+                except NotImplementedError:  # no qsize on macos
+                    pass
+        finally:
+            for _ in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
 
     # scrape_args = ((obj, base_dir, base_url, req_params, bucket, formats)
     #                for obj in bucket.objects.filter(Prefix='derived'))
@@ -261,21 +512,22 @@ def move_labeled(base_dir='data/ddw-s3'):
     if not os.path.isdir(labeled_dir):
         os.mkdir(labeled_dir)
 
-    directories = glob.glob('{0}/*'.format(base_dir))
-    for folder in directories:
-        data_id = get_data_id(base_dir, folder)
-        tags_fname = get_tags_filename(folder, data_id)
-
-        if metadata_present(tags_fname):
-            with open(tags_fname) as json_file:
-                tags = json.load(json_file)
-                if tags:
-                    print('moving folder', folder, 'to', '{0}/labeled/{1}'.format(base_dir, data_id))
-                    os.rename(folder, '{0}/labeled/{1}'.format(base_dir, data_id))
-                else:
-                    print('empty tag file, delete?')
+    # folders and their tags come from the persisted index instead of a glob and a read per folder
+    index = get_folder_index()
+    catalog = get_metadata_catalog()
+    for folder in index.index(base_dir, exclude=('labeled',)):
+        data_id = get_data_id(base_dir, folder['path'])
+        if folder['tags_file']:
+            if folder['tags']:
+                print('moving folder', folder['path'], 'to', '{0}/labeled/{1}'.format(base_dir, data_id))
+                os.rename(folder['path'], '{0}/labeled/{1}'.format(base_dir, data_id))
+                index.rename(folder['path'], '{0}/labeled/{1}'.format(base_dir, data_id))
+                # the catalog follows too, so export_metadata_files still finds the folder
+                catalog.rename(folder['path'], '{0}/labeled/{1}'.format(base_dir, data_id))
+            else:
+                print('empty tag file, delete?')
         else:
-            print('no tag file for:', folder)
+            print('no tag file for:', folder['path'])
 
 
 def get_tags_filename(folder, data_id):
@@ -284,29 +536,24 @@ def get_tags_filename(folder, data_id):
 
 def get_all_tags(base_dir='data/ddw-s3/labeled', n_tags=1000):
 
-    directories = glob.glob('{0}/*'.format(base_dir))
     all_tags = set()
     tag_freq = {}
     tags_dict = {}
 
-    for folder in directories:
+    for folder in get_folder_index().index(base_dir):
         # print('processing tags in:', folder)
-        # data_id = folder.replace(base_dir, '').replace('/', '')
-        data_id = get_data_id(base_dir, folder)
-        # tags_fname = '{0}/{1}_tags.json'.format(folder, data_id)
-        tags_fname = get_tags_filename(folder, data_id)
-        if metadata_present(tags_fname):
-            with open(tags_fname) as json_file:
-                tags = json.load(json_file)
-                if tags:
-                    tags_dict[data_id] = tags
-                    all_tags.update(tags)
-                    for tag in tags:
-                        tag_freq[tag] = 1 + tag_freq.get(tag, 0)
-                else:
-                    print('empty tags list in:', folder)
+        data_id = get_data_id(base_dir, folder['path'])
+        if folder['tags_file']:
+            tags = folder['tags']
+            if tags:
+                tags_dict[data_id] = tags
+                all_tags.update(tags)
+                for tag in tags:
+                    tag_freq[tag] = 1 + tag_freq.get(tag, 0)
+            else:
+                print('empty tags list in:', folder['path'])
         else:
-            print('missing/empty tags in:', folder)
+            print('missing/empty tags in:', folder['path'])
 
     print('all tags:', all_tags)
     freq_vals = list(tag_freq.values())
@@ -325,45 +572,34 @@ def get_all_tags(base_dir='data/ddw-s3/labeled', n_tags=1000):
         json.dump(tags_dict, json_file, indent=2)
 
 
-def build_target_matrix(base_dir='data/ddw-s3'):
-
+def iter_tags_dict(base_dir='data/ddw-s3'):
+    # (data_id, tags) from the tags_dict.json written by get_all_tags
     dict_path = '{0}/tags_dict.json'.format(base_dir)
     with open(dict_path) as json_file:
         print('loading tags from file')
-        tags_dict = json.load(json_file)
-
-    unique_tags = list(set([tag for tag_list in tags_dict.values() for tag in tag_list]))
-    print('unique tags:', unique_tags)
-    data_ids = list(tags_dict.keys())
-    n_tags = len(unique_tags)
-    n_datasets = len(data_ids)
-    print('number of unique tags:', n_tags)
-
-    tag_to_index = {tag: ind for (ind, tag) in enumerate(unique_tags)}
-
-    print('computing nonzero indices')
-    row_inds = np.concatenate([[ind]*len(data_tags) for (ind, data_tags) in enumerate(tags_dict.values())])
-    col_inds = np.array([tag_to_index[tag] for data_tags in tags_dict.values() for tag in data_tags])
-
-    assert len(row_inds) == len(col_inds)
-    n_nonzero = len(col_inds)
-    data = np.ones(n_nonzero, dtype=int)
-
-    print('building csr matrix')
-    target_matrix = sp.csr_matrix((data, (row_inds, col_inds)), shape=(n_datasets, n_tags))
-
-    print('saving target data to file')
-    timestamp = get_timestamp()
-    matrix_filename = '{0}/target-matrix_{1}.npz'.format(base_dir, timestamp)
-    sp.save_npz(matrix_filename, target_matrix)
-    np.save('{0}/tags_{1}.npy'.format(base_dir, timestamp), unique_tags)
-    np.save('{0}/dataset-ids_{1}.npy'.format(base_dir, timestamp), data_ids)
-
-    return {
-        'target_matrix': target_matrix,
-        'tags': unique_tags,
-        'dataset_ids': data_ids,
-    }
+        yield from json.load(json_file).items()
+
+
+def build_target_matrix(base_dir='data/ddw-s3', source='dataworld-newknowledge-us-east-1', rebuild=False,
+                        chunk_size=TARGET_CHUNK_SIZE):
+    # streams every tagged dataset of source out of the tag index into the dataset x tag matrix at
+    # <base_dir>/target-matrix, appending rows for datasets it doesn't have yet. source=None reads
+    # tags_dict.json instead. rebuild=True starts from scratch, e.g. after tags of existing rows changed
+    dataset_tags = iter_tags_dict(base_dir) if source is None else get_tag_index().iter_dataset_tags(source)
+    target_dir = os.path.join(base_dir, TARGET_DIR)
+    write_target_matrix(dataset_tags, target_dir, chunk_size=chunk_size, rebuild=rebuild)
+    return load_target_matrix(target_dir)
+
+
+def build_feature_matrix(base_dir='data/ddw-s3', vectors_path='data/word-vectors.bin', source='dataworld-newknowledge-us-east-1',
+                         fields=FEATURE_FIELDS, pooling='mean', rebuild=False):
+    # embeds the column headers (from the csv profiles) and tags of every row of the target matrix
+    # build_target_matrix wrote, into <base_dir>/features with one row per target row
+    target = load_target_matrix(os.path.join(base_dir, TARGET_DIR))
+    features_dir = os.path.join(base_dir, FEATURE_DIR)
+    write_feature_matrix(target, load_vectors(vectors_path), features_dir, headers=dataset_headers(), source=source,
+                         fields=fields, pooling=pooling, rebuild=rebuild)
+    return load_feature_matrix(features_dir)
 
     # compare tags to vocab of word embedding
     # vectorize datasets
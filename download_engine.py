@@ -0,0 +1,311 @@
+import asyncio
+import os
+import time
+from collections import Counter
+from email.utils import formatdate
+
+import aiohttp
+from yarl import URL
+
+from blob_store import get_blob_store
+from metrics import get_metrics
+from manifest import COMPLETE, FAILED, REJECTED, TOO_LARGE, conditional_headers, get_manifest, is_complete, is_partial
+from part_file import IncompleteDownload, PartFile
+from rate_limit import MAX_RETRIES, THROTTLE_STATUSES, Throttled, get_host, get_rate_limiter, parse_retry_after
+from sniff import SNIFF_SIZE, BogusContent, check_content
+
+
+GLOBAL_CONCURRENCY = 256
+HOST_CONCURRENCY = 8
+CHUNK_SIZE = 256 << 10
+MAX_FILE_SIZE = 2 << 30  # per-file cap, bigger transfers are skipped or aborted
+LARGE_FILE_SIZE = 100 << 20  # files at least this big are scheduled after everything else
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 600
+
+
+class TooLarge(Exception):
+
+    def __init__(self, size, cap):
+        super().__init__('{0} bytes is over the {1} byte cap'.format(size, cap))
+        self.size = size
+
+
+class OverBudget(Exception):
+    pass
+
+
+def check_url(url):
+    # raise aiohttp.InvalidURL unless url is something we can fetch over http
+    try:
+        parsed = URL(url)
+    except ValueError as err:
+        raise aiohttp.InvalidURL(url) from err
+    if parsed.scheme not in ('http', 'https') or not parsed.host:
+        raise aiohttp.InvalidURL(url)
+
+
+class DownloadEngine:
+    # runs many resource downloads concurrently on one event loop, with a global cap on open
+    # requests and a (configurable) cap per host so no single portal gets hammered
+
+    def __init__(self, global_limit=GLOBAL_CONCURRENCY, host_limit=HOST_CONCURRENCY, host_limits=None,
+                 max_pending=None, connect_timeout=60, read_timeout=300, manifest=None, limiter=None, blob_store=None,
+                 max_file_size=MAX_FILE_SIZE, large_file_size=LARGE_FILE_SIZE, instance_budget=None):
+        self.max_file_size = max_file_size
+        self.large_file_size = large_file_size
+        self.instance_budget = instance_budget  # total bytes to download per instance this run
+        self.bytes_used = Counter()
+        self.metrics = get_metrics()
+        self.blob_store = blob_store or get_blob_store()
+        self.manifest = manifest or get_manifest()
+        self.limiter = limiter or get_rate_limiter()
+        self.global_limit = global_limit
+        self.host_limit = host_limit
+        self.host_limits = host_limits or {}
+        self.max_pending = max_pending or 4*global_limit
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.session = None
+        self._global_sem = None
+        self._pending_sem = None
+        self._host_sems = {}
+        self._buffers = []
+
+    async def __aenter__(self):
+        # one keep-alive connection pool for every host, per-host limits are the semaphores below
+        connector = aiohttp.TCPConnector(limit=self.global_limit, limit_per_host=0, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         ttl_dns_cache=DNS_CACHE_TTL)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        self._global_sem = asyncio.Semaphore(self.global_limit)
+        self._pending_sem = asyncio.Semaphore(self.max_pending)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def host_semaphore(self, host):
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(self.host_limits.get(host, self.host_limit))
+        return self._host_sems[host]
+
+    async def spawn(self, coro):
+        # schedule coro as a task, blocking the caller while too many tasks are outstanding so
+        # enumerating a huge catalog doesn't queue up millions of coroutines at once
+        await self._pending_sem.acquire()
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(lambda _: self._pending_sem.release())
+        return task
+
+    def check_size(self, size, instance=None):
+        if size is not None and self.max_file_size and size > self.max_file_size:
+            raise TooLarge(size, self.max_file_size)
+        if self.instance_budget and self.bytes_used[instance] + (size or 0) > self.instance_budget:
+            raise OverBudget('{0} has used {1} of its {2} byte budget'.format(instance, self.bytes_used[instance],
+                                                                              self.instance_budget))
+
+    async def download(self, url, data_filename, instance=None, size_hint=None, file_format=None):
+        host = get_host(url)
+        entry = self.manifest.get(url, data_filename)
+        try:
+            check_url(url)
+        except aiohttp.InvalidURL as err:
+            print('invalid url, not http?', url)
+            print('error:', err)
+            self._mark_failed(url, data_filename, entry)
+            self.metrics.inc('failures_total', instance=instance, reason='invalid_url')
+            return False
+        try:
+            self.check_size(size_hint, instance)
+        except (TooLarge, OverBudget) as err:
+            print('skipping', url, ':', err)
+            self.metrics.inc('skips_total', instance=instance, reason=type(err).__name__)
+            if isinstance(err, TooLarge):
+                self.manifest.record(url, data_filename, TOO_LARGE, size=err.size)
+            return False
+
+        part = PartFile(data_filename, buffer=self._buffers.pop() if self._buffers else None)
+        try:
+            async with self.host_semaphore(host):
+                for attempt in range(MAX_RETRIES + 1):
+                    # wait for the host's shared token bucket before taking a global slot
+                    await self.limiter.acquire_async(host)
+                    try:
+                        async with self._global_sem:
+                            result = await self._fetch(url, data_filename, entry, part, instance, file_format)
+                        await self.limiter.succeeded_async(host)
+                        return result
+
+                    except aiohttp.InvalidURL as err:
+                        # e.g. a redirect to somewhere we can't follow
+                        print('invalid url, not http?', url)
+                        print('error:', err)
+                        self._mark_failed(url, data_filename, entry)
+                        self.metrics.inc('failures_total', instance=instance, reason='invalid_url')
+                        return False
+
+                    except (TooLarge, OverBudget) as err:
+                        print('aborting', url, ':', err)
+                        part.discard()
+                        self.metrics.inc('skips_total', instance=instance, reason=type(err).__name__)
+                        if isinstance(err, TooLarge):
+                            self.manifest.record(url, data_filename, TOO_LARGE, size=err.size)
+                        return False
+
+                    except BogusContent as err:
+                        print('rejecting', url, ':', err)
+                        part.discard()
+                        self.manifest.record(url, data_filename, REJECTED)
+                        self.metrics.inc('skips_total', instance=instance, reason='bogus_content')
+                        return False
+
+                    except Throttled as err:
+                        wait = await self.limiter.throttled_async(host, err.retry_after)
+                        print('throttled by', host, 'status:', err.status, 'backing off', round(wait, 1), 'seconds')
+                        self.metrics.inc('retries_total', host=host, reason='throttled')
+
+                    except IncompleteDownload as err:
+                        part.close()
+                        print('incomplete download:', err)
+                        self.metrics.inc('retries_total', host=host, reason='incomplete')
+
+                    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as err:
+                        # keep what we got in the part file, the next attempt resumes from there
+                        part.close()
+                        print('connection error requesting from url:', url)
+                        print('error:', err)
+                        await self.limiter.throttled_async(host)
+                        self.metrics.inc('retries_total', host=host, reason='connection')
+
+                    entry = self.manifest.get(url, data_filename)
+
+                print('giving up after', MAX_RETRIES, 'retries:', url)
+                self._mark_failed(url, data_filename, entry)
+                self.metrics.inc('failures_total', instance=instance, reason='retries')
+                return False
+        finally:
+            part.close()
+            self._buffers.append(part.buffer)
+
+    async def _fetch(self, url, data_filename, entry, part, instance=None, file_format=None):
+        headers = conditional_headers(entry)
+
+        # resume an interrupted transfer, but only if the server can tell us it hasn't changed since
+        offset = 0
+        if is_partial(entry) and (entry['etag'] or entry['last_modified']):
+            offset = part.existing_size()
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+                headers['If-Range'] = entry['etag'] or entry['last_modified']
+                headers['Accept-Encoding'] = 'identity'
+
+        # files saved before the manifest existed get revalidated against their mtime and size
+        legacy_size = None
+        if entry is None and os.path.isfile(data_filename):
+            legacy_size = os.path.getsize(data_filename)
+            if legacy_size > 0:
+                headers['If-Modified-Since'] = formatdate(os.path.getmtime(data_filename), usegmt=True)
+
+        print('requesting', url)
+        host = get_host(url)
+        start = time.monotonic()
+        async with self.session.get(url, headers=headers) as response:
+            # time to response headers, by host
+            self.metrics.observe('request_seconds', time.monotonic() - start, host=host)
+            self.metrics.inc('requests_total', host=host, status=response.status)
+            if response.status == 304:
+                print('resource unchanged:', data_filename)
+                self.metrics.inc('files_total', instance=instance, result='unchanged')
+                self.manifest.record(url, data_filename, COMPLETE, size=legacy_size or None)
+                return True
+
+            if response.status == 416 and offset:
+                # the part file no longer lines up with the remote file, start over
+                part.discard()
+                raise IncompleteDownload('range not satisfiable for {0}'.format(url))
+
+            if response.status in THROTTLE_STATUSES:
+                raise Throttled(response.status, parse_retry_after(response.headers.get('Retry-After')))
+
+            if response.status not in (200, 206):
+                print('request failed:', response.status, url)
+                self._mark_failed(url, data_filename, entry)
+                self.metrics.inc('failures_total', instance=instance, reason='status')
+                return False
+
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            expected_size = None
+            if response.headers.get('Content-Encoding', 'identity') == 'identity':
+                expected_size = response.content_length
+
+            # a too-big Content-Length means we can stop before reading any of the body
+            self.check_size(expected_size if response.status == 200 else None, instance)
+
+            if response.status == 206:
+                start, expected_size = parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    part.discard()
+                    raise IncompleteDownload('unexpected range {0} for {1}'.format(start, url))
+                print('resuming file at byte', offset, ':', data_filename)
+            else:
+                offset = 0
+                if legacy_size and expected_size == legacy_size:
+                    # legacy file is complete, drop the connection instead of reading the body
+                    print('resource already present:', data_filename)
+                    response.close()
+                    self.manifest.record(url, data_filename, COMPLETE, size=legacy_size,
+                                         etag=etag, last_modified=last_modified)
+                    self.metrics.inc('files_total', instance=instance, result='unchanged')
+                    return True
+
+                print('saving file:', data_filename)
+                self.manifest.start(url, data_filename, etag=etag, last_modified=last_modified)
+
+            # if successful, stream data to the part file and move it into place once complete
+            part.open(offset)
+            # hold back the first few KB of a fresh download until they pass the format check, so
+            # html error pages and misfiled archives are dropped before we pull the rest of the body
+            head = bytearray() if file_format and not offset else None
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if head is not None:
+                    head += chunk
+                    if len(head) < SNIFF_SIZE:
+                        continue
+                    check_content(bytes(head[:SNIFF_SIZE]), file_format)
+                    chunk, head = head, None
+                part.write(chunk)
+                self.bytes_used[instance] += len(chunk)
+                self.metrics.inc('bytes_total', len(chunk), instance=instance)
+                # servers that don't send (or misreport) a length get cut off once they pass the cap, and
+                # concurrent transfers for one instance stop once together they've used up its budget
+                if self.max_file_size and part.n_bytes > self.max_file_size:
+                    raise TooLarge(part.n_bytes, self.max_file_size)
+                self.check_size(None, instance)
+            if head is not None:  # the whole body fit in the sniffing window
+                check_content(bytes(head), file_format)
+                part.write(head)
+                self.bytes_used[instance] += len(head)
+                self.metrics.inc('bytes_total', len(head), instance=instance)
+                self.check_size(None, instance)
+            size, sha256 = part.commit(expected_size)
+        self.metrics.observe('transfer_seconds', time.monotonic() - start, host=host)
+
+        # identical content already downloaded for another dataset becomes a hardlink to one blob
+        self.blob_store.adopt(data_filename, sha256, size, instance)
+
+        self.manifest.record(url, data_filename, COMPLETE, size=size, sha256=sha256,
+                             etag=etag, last_modified=last_modified)
+        self.metrics.inc('files_total', instance=instance, result='downloaded')
+        return True
+
+    def _mark_failed(self, url, data_filename, entry):
+        # a failed revalidation shouldn't forget a good copy or a resumable partial one
+        if not (is_complete(entry) or is_partial(entry)):
+            self.manifest.record(url, data_filename, FAILED)
+
+
+def parse_content_range(content_range):
+    # "bytes <start>-<end>/<total>", total may be "*" when the server doesn't know it
+    byte_range, total = content_range.split(' ')[-1].split('/')
+    start = int(byte_range.split('-')[0])
+    return start, (None if total == '*' else int(total))
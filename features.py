@@ -0,0 +1,249 @@
+import json
+import os
+import re
+from hashlib import sha256
+
+import numpy as np
+
+from csv_profile import PROFILES_PATH, load_profiles
+from target_matrix import append_array
+from utils import max_of_ragged_rows, mean_of_ragged_rows, normalize_text, read_json, unit_norm_rows, write_json
+
+
+FEATURE_DIR = 'features'
+FEATURE_CHUNK_SIZE = 10000  # target matrix rows featurized per step
+POOL_BLOCK_TOKENS = 1 << 16  # token vectors gathered at once while pooling, bounds memory to this x dim
+FEATURE_DTYPE = np.float32
+FEATURE_FIELDS = ('headers', 'tags')  # leave out tags when the features are meant to predict them
+POOLINGS = ('mean', 'max', 'mean_max')
+TOKEN_RE = re.compile(r'[^0-9a-z]+')
+
+# a feature directory holds, next to the target matrix it is aligned with:
+#   features.f32    float32 rows back to back, one per target matrix row and in the same order
+#   meta.json       row count and width, how the rows were built, and digests of the dataset ids they
+#                   were built for and of those datasets' headers. written last, like the target matrix's
+FEATURES_FILENAME = 'features.f32'
+META_FILENAME = 'meta.json'
+
+
+def tokenize(text):
+    # column headers and tags come in every casing and separator style: CamelCase, snake_case, kebab-case
+    return [token for token in TOKEN_RE.split(normalize_text(str(text), to_list=False).lower()) if token]
+
+
+def load_vectors(vectors_path):
+    # word2vec format (.bin binary, .txt/.vec text) or a saved gensim KeyedVectors/model
+    from gensim.models import KeyedVectors
+
+    if vectors_path.endswith(('.bin', '.txt', '.vec')):
+        return KeyedVectors.load_word2vec_format(vectors_path, binary=vectors_path.endswith('.bin'))
+    return KeyedVectors.load(vectors_path)
+
+
+def model_rows(wv, tokens):
+    # (tokens in the vocabulary, their rows in wv.vectors) in one pass, for gensim 4 (key_to_index)
+    # and older versions (vocab[token].index) alike
+    if hasattr(wv, 'key_to_index'):
+        index = wv.key_to_index
+        known = [token for token in tokens if token in index]
+        return known, [index[token] for token in known]
+    vocab = wv.vocab
+    known = [token for token in tokens if token in vocab]
+    return known, [vocab[token].index for token in known]
+
+
+class TokenVectors:
+    # memoized text -> tokens -> vectors. every distinct string is tokenized once and every distinct
+    # token looked up in the model once; the vectors of known tokens are gathered in batches into one
+    # compact table, and each text is kept as a run of rows into that table (out of vocabulary tokens
+    # are dropped)
+
+    def __init__(self, model, normalize=True):
+        self.wv = getattr(model, 'wv', model)
+        self.dim = self.wv.vector_size
+        self.normalize = normalize
+        self.token_rows = {}  # token -> row in table, -1 if the model doesn't know it
+        self.text_index = {}  # text -> index into the ragged text arrays below
+        self.text_offsets, self.text_lengths, self.text_tokens = [], [], []
+        self._arrays = None
+        self.table = np.zeros((0, self.dim), dtype=FEATURE_DTYPE)
+
+    def add_tokens(self, tokens):
+        known, rows = model_rows(self.wv, tokens)
+        self.token_rows.update((token, -1) for token in tokens)
+        if known:
+            vectors = np.asarray(self.wv.vectors[np.array(rows)], dtype=FEATURE_DTYPE)
+            if self.normalize:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    vectors = np.nan_to_num(unit_norm_rows(vectors), copy=False)
+            start = len(self.table)
+            self.table = np.concatenate([self.table, vectors])
+            self.token_rows.update(zip(known, range(start, start + len(known))))
+
+    def lookup(self, texts):
+        # index of every text, tokenizing and resolving the ones not seen before in one batch
+        new_texts = {text for text in texts if text not in self.text_index}
+        if new_texts:
+            tokenized = {text: tokenize(text) for text in new_texts}
+            new_tokens = {token for tokens in tokenized.values() for token in tokens if token not in self.token_rows}
+            if new_tokens:
+                self.add_tokens(sorted(new_tokens))
+            for text, tokens in tokenized.items():
+                rows = [self.token_rows[token] for token in tokens if self.token_rows[token] >= 0]
+                self.text_index[text] = len(self.text_offsets)
+                self.text_offsets.append(len(self.text_tokens))
+                self.text_lengths.append(len(rows))
+                self.text_tokens.extend(rows)
+            self._arrays = None
+        return np.fromiter((self.text_index[text] for text in texts), dtype=np.int64, count=len(texts))
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.array(self.text_offsets, dtype=np.int64), np.array(self.text_lengths, dtype=np.int64),
+                            np.array(self.text_tokens, dtype=np.int64))
+        return self._arrays
+
+    def expand(self, texts, text_rows, n_rows):
+        # (table row of every token, ordered by output row; tokens per output row) for text occurrences
+        # texts[i] belonging to output row text_rows[i]
+        offsets, lengths, tokens = self.arrays()
+        occurrence_lengths = lengths[texts]
+        run_starts = np.cumsum(occurrence_lengths) - occurrence_lengths
+        positions = np.repeat(offsets[texts] - run_starts, occurrence_lengths) + np.arange(occurrence_lengths.sum())
+        token_rows = np.repeat(text_rows, occurrence_lengths)
+        order = np.argsort(token_rows, kind='stable')
+        return tokens[positions][order], np.bincount(token_rows, minlength=n_rows)
+
+
+def pool(table, token_ids, lengths, pooling='mean'):
+    # pooled vector per row, gathering at most about POOL_BLOCK_TOKENS token vectors at a time
+    width = table.shape[1]*(2 if pooling == 'mean_max' else 1)
+    pooled = np.zeros((len(lengths), width), dtype=FEATURE_DTYPE)
+    ends = np.cumsum(lengths)
+    row = 0
+    while row < len(lengths):
+        start = ends[row] - lengths[row]
+        # at least one row per block, however many tokens it has
+        stop = max(row + 1, int(np.searchsorted(ends, start + POOL_BLOCK_TOKENS, side='right')))
+        vectors = table[token_ids[start:ends[stop - 1]]]
+        block_lengths = lengths[row:stop]
+        if pooling in ('mean', 'mean_max'):
+            pooled[row:stop, :table.shape[1]] = mean_of_ragged_rows(vectors, block_lengths)
+        if pooling in ('max', 'mean_max'):
+            pooled[row:stop, width - table.shape[1]:] = max_of_ragged_rows(vectors, block_lengths)
+        row = stop
+    return pooled
+
+
+def dataset_headers(profiles_path=PROFILES_PATH):
+    # {dataset: column headers of all its csvs, each once} from the csv profiles (see csv_profile.py)
+    headers = {}
+    for profile in load_profiles(profiles_path):
+        columns = headers.setdefault(profile['dataset'], {})
+        columns.update(dict.fromkeys(column for column in profile['columns'] if column))
+    return {dataset: list(columns) for dataset, columns in headers.items()}
+
+
+def header_key(dataset_id, headers, source=None):
+    # target matrix rows are keyed by the tag index's dataset name, or [source, dataset] when built
+    # across sources; profiles by the dataset folder relative to its tree
+    if isinstance(dataset_id, (list, tuple)):
+        candidates = ['/'.join(dataset_id), dataset_id[1]]
+    else:
+        candidates = [dataset_id, '{0}/{1}'.format(source, dataset_id)]
+    return next((key for key in candidates if key in headers), None)
+
+
+def ids_hasher(dataset_ids, hasher=None):
+    # running digest of the dataset ids rows were built for, extended chunk by chunk
+    hasher = hasher or sha256()
+    for data_id in dataset_ids:
+        hasher.update((json.dumps(data_id) + '\n').encode('utf-8'))
+    return hasher
+
+
+def headers_hasher(dataset_ids, headers, source=None, hasher=None):
+    # running digest of the headers each row was built from, so re-profiled datasets are noticed
+    hasher = hasher or sha256()
+    for data_id in dataset_ids:
+        key = header_key(data_id, headers, source)
+        hasher.update((json.dumps(headers[key] if key is not None else []) + '\n').encode('utf-8'))
+    return hasher
+
+
+def write_feature_matrix(target, model, features_dir, headers=None, source=None, fields=FEATURE_FIELDS,
+                         pooling='mean', chunk_size=FEATURE_CHUNK_SIZE, rebuild=False, normalize=True):
+    # embeds every row of target (as returned by load_target_matrix) from its datasets' column headers
+    # and tags into features_dir. rows already featurized with the same settings for the same datasets
+    # and headers are kept and only rows the target matrix gained since are added
+    if pooling not in POOLINGS:
+        raise ValueError('unknown pooling: {0}'.format(pooling))
+    unknown_fields = set(fields) - set(FEATURE_FIELDS)
+    if unknown_fields:
+        raise ValueError('unknown fields: {0}'.format(', '.join(sorted(unknown_fields))))
+    headers = (headers or {}) if 'headers' in fields else {}
+    target_matrix, tags, dataset_ids = target['target_matrix'], target['tags'], target['dataset_ids']
+
+    vectors = TokenVectors(model, normalize=normalize)
+    width = vectors.dim*(2 if pooling == 'mean_max' else 1)
+    settings = {'dim': width, 'fields': list(fields), 'pooling': pooling, 'normalize': normalize}
+    os.makedirs(features_dir, exist_ok=True)
+    meta_file = os.path.join(features_dir, META_FILENAME)
+    meta = None if rebuild or not os.path.isfile(meta_file) else read_json(meta_file)
+    hasher = ids_hasher(dataset_ids[:meta['n_rows']] if meta else [])
+    header_hasher = headers_hasher(dataset_ids[:meta['n_rows']] if meta else [], headers, source)
+    if meta and ({key: meta.get(key) for key in settings} != settings or meta['n_rows'] > len(dataset_ids)
+                 or meta['ids_sha256'] != hasher.hexdigest()
+                 or meta.get('headers_sha256') != header_hasher.hexdigest()):
+        print('feature settings, target rows or headers changed, rebuilding', features_dir)
+        meta, hasher, header_hasher = None, ids_hasher([]), headers_hasher([], headers)
+    n_done = meta['n_rows'] if meta else 0
+
+    tag_texts = vectors.lookup(tags) if 'tags' in fields else None
+    indices, indptr = target_matrix.indices, target_matrix.indptr
+    for start in range(n_done, len(dataset_ids), chunk_size):
+        stop = min(start + chunk_size, len(dataset_ids))
+        texts, text_rows = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        if 'tags' in fields:
+            # a row's tags are its nonzero target columns
+            texts.append(tag_texts[indices[indptr[start]:indptr[stop]]])
+            text_rows.append(np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1])))
+        if 'headers' in fields:
+            chunk_headers, header_rows = [], []
+            for row, data_id in enumerate(dataset_ids[start:stop]):
+                key = header_key(data_id, headers, source)
+                if key is not None:
+                    chunk_headers.extend(headers[key])
+                    header_rows.extend([row]*len(headers[key]))
+            texts.append(vectors.lookup(chunk_headers))
+            text_rows.append(np.array(header_rows, dtype=np.int64))
+
+        token_ids, lengths = vectors.expand(np.concatenate(texts), np.concatenate(text_rows), stop - start)
+        features = pool(vectors.table, token_ids, lengths, pooling)
+        append_array(os.path.join(features_dir, FEATURES_FILENAME), features, start*width, FEATURE_DTYPE)
+
+        meta = dict(settings, n_rows=stop, ids_sha256=ids_hasher(dataset_ids[start:stop], hasher).hexdigest(),
+                    headers_sha256=headers_hasher(dataset_ids[start:stop], headers, source, header_hasher).hexdigest(),
+                    n_empty=(meta or {}).get('n_empty', 0) + int((lengths == 0).sum()))
+        tmp_file = meta_file + '.tmp'
+        write_json(meta, tmp_file)
+        os.replace(tmp_file, meta_file)
+        print('featurized rows', start, 'to', stop, 'of', len(dataset_ids))
+
+    if meta is None:
+        meta = dict(settings, n_rows=0, ids_sha256=hasher.hexdigest(), headers_sha256=header_hasher.hexdigest(),
+                    n_empty=0)
+        write_json(meta, meta_file)
+    n_oov = sum(row < 0 for row in vectors.token_rows.values())
+    print('features are', meta['n_rows'], 'x', width, '({0} rows without a known token);'.format(meta['n_empty']),
+          n_oov, 'of', len(vectors.token_rows), 'distinct tokens were out of vocabulary')
+    return meta
+
+
+def load_feature_matrix(features_dir, mmap_mode='r'):
+    # the dataset x dim feature matrix memory-mapped from disk, row i belongs to target matrix row i
+    meta = read_json(os.path.join(features_dir, META_FILENAME))
+    if not meta['n_rows']:
+        return np.zeros((0, meta['dim']), dtype=FEATURE_DTYPE)
+    return np.memmap(os.path.join(features_dir, FEATURES_FILENAME), dtype=FEATURE_DTYPE, mode=mmap_mode,
+                     shape=(meta['n_rows'], meta['dim']))
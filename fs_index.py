@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import open_db
+
+
+FS_INDEX_PATH = 'data/fs-index.db'
+INDEX_THREADS = 32  # listing is syscall bound, threads overlap the waits on slow disks and network mounts
+TAGS_SUFFIX = '_tags.json'
+
+
+def scan_folder(path):
+    # one recursive os.scandir pass: the mtime of every directory (to tell later whether the listing
+    # is stale), every file's relative path and size, and the tags file's contents if there is one
+    dirs = {}
+    files = []
+    tags_file = None
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = os.path.join(path, rel_dir)
+        dirs[rel_dir] = os.stat(abs_dir).st_mtime_ns
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel_path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((rel_path, stat.st_size))
+                    if not rel_dir and entry.name.endswith(TAGS_SUFFIX) and stat.st_size > 0:
+                        tags_file = (rel_path, stat.st_mtime_ns)
+
+    tags = None
+    if tags_file:
+        with open(os.path.join(path, tags_file[0])) as json_file:
+            tags = json.load(json_file)
+    return {'path': path, 'dirs': dirs, 'files': sorted(files), 'tags_file': tags_file, 'tags': tags}
+
+
+def list_folders(root, depth=1, exclude=()):
+    # directories exactly depth levels below root, skipping names in exclude and hidden/bookkeeping ones
+    folders = [root]
+    for _ in range(depth):
+        children = []
+        for folder in folders:
+            with os.scandir(folder) as entries:
+                children.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False)
+                                and entry.name not in exclude and not entry.name.startswith(('.', '_')))
+        folders = children
+    return sorted(folders)
+
+
+class FolderIndex:
+    # persisted listing of dataset folders, so the tree is walked once and later passes (and later
+    # runs) only rescan folders whose directory mtimes or tags file changed
+
+    def __init__(self, db_path=FS_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS folders (
+                                path TEXT PRIMARY KEY,
+                                content TEXT NOT NULL,
+                                scanned REAL NOT NULL)''')
+
+    def get(self, path):
+        with self.lock:
+            row = self.conn.execute('SELECT content FROM folders WHERE path = ?', (path,)).fetchone()
+        return json.loads(row['content']) if row else None
+
+    def put_many(self, folders):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                                  [(folder['path'], json.dumps(folder), now) for folder in folders])
+            self.conn.execute('COMMIT')
+
+    def rename(self, old_path, new_path):
+        # keep the listing of a folder that was moved, the next index() revalidates it as usual
+        folder = self.get(old_path)
+        with self.lock:
+            self.conn.execute('DELETE FROM folders WHERE path = ?', (old_path,))
+        if folder:
+            folder['path'] = new_path
+            self.put_many([folder])
+
+    def is_fresh(self, folder):
+        try:
+            if any(os.stat(os.path.join(folder['path'], rel_dir)).st_mtime_ns != mtime
+                   for rel_dir, mtime in folder['dirs'].items()):
+                return False
+            if folder['tags_file']:
+                rel_path, mtime = folder['tags_file']
+                return os.stat(os.path.join(folder['path'], rel_path)).st_mtime_ns == mtime
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _load_or_scan(self, path):
+        # returns (folder, rescanned)
+        folder = self.get(path)
+        if folder and self.is_fresh(folder):
+            return folder, False
+        return scan_folder(path), True
+
+    def index(self, root, depth=1, exclude=(), n_threads=INDEX_THREADS):
+        # listing of every folder depth levels below root, in path order
+        paths = list_folders(root, depth, exclude)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = list(executor.map(self._load_or_scan, paths))
+        rescanned = [folder for folder, fresh_scan in results if fresh_scan]
+        if rescanned:
+            self.put_many(rescanned)
+        print('indexed', len(results), 'folders under', root, '({0} rescanned)'.format(len(rescanned)))
+        return [folder for folder, _ in results]
+
+    def close(self):
+        self.conn.close()
+
+
+def folder_files(folder, suffix=''):
+    return [os.path.join(folder['path'], rel_path) for rel_path, _ in folder['files'] if rel_path.endswith(suffix)]
+
+
+_indexes = {}
+
+
+def get_folder_index(db_path=FS_INDEX_PATH):
+    # one connection per process
+    key = (os.getpid(), db_path)
+    if key not in _indexes:
+        _indexes[key] = FolderIndex(db_path)
+    return _indexes[key]
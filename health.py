@@ -0,0 +1,159 @@
+import asyncio
+import os
+import statistics
+import threading
+import time
+
+import aiohttp
+
+from rate_limit import get_host, get_rate_limiter
+from utils import open_db
+
+
+HEALTH_PATH = 'data/instance-health.db'
+HEALTH_TTL = 6*3600  # seconds a probe result is trusted before the instance is probed again
+PROBE_CONCURRENCY = 32
+PROBE_ATTEMPTS = 3
+PROBE_TIMEOUT = 15
+MIN_LATENCY = 0.05  # floor for weighting, so one very fast host doesn't get every connection
+
+# cheapest checks first; the api ones prove the portal can be crawled, HEAD only that the site is up
+PROBES = (
+    ('status_show', '/api/3/action/status_show', 'GET'),
+    ('package_list', '/api/3/action/package_list?limit=1', 'GET'),
+    ('head', '', 'HEAD'),
+)
+API_PROBES = ('status_show', 'package_list')
+
+
+class HealthCache:
+    # the latest probe result per instance url, so repeated crawls within the ttl don't re-probe
+
+    def __init__(self, db_path=HEALTH_PATH):
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS health (
+                                url TEXT PRIMARY KEY,
+                                alive INTEGER NOT NULL,
+                                probe TEXT,
+                                latency REAL,
+                                error_rate REAL NOT NULL,
+                                error TEXT,
+                                checked REAL NOT NULL)''')
+
+    def get(self, url, ttl=HEALTH_TTL):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM health WHERE url = ? AND checked > ?', (url, time.time() - ttl)).fetchone()
+        return dict(row) if row else None
+
+    def put(self, health):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (health['url'], health['alive'], health['probe'], health['latency'], health['error_rate'],
+                               health['error'], health['checked']))
+
+    def close(self):
+        self.conn.close()
+
+
+async def probe_once(session, ckan_url):
+    # returns (probe, latency, error) for the first probe that answers, probe is None if none did
+    error = None
+    for probe, path, http_method in PROBES:
+        await get_rate_limiter().acquire_async(get_host(ckan_url))
+        start = time.monotonic()
+        try:
+            async with session.request(http_method, ckan_url.rstrip('/') + path) as response:
+                if response.status >= 400:
+                    error = '{0} returned {1}'.format(probe, response.status)
+                    continue
+                if http_method == 'GET' and not (await response.json(content_type=None) or {}).get('success'):
+                    error = '{0} did not report success'.format(probe)
+                    continue
+                return probe, time.monotonic() - start, None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            error = '{0}: {1!r}'.format(probe, err)
+    return None, None, error
+
+
+async def probe_instance(session, ckan_url, attempts=PROBE_ATTEMPTS):
+    results = [await probe_once(session, ckan_url) for _ in range(attempts)]
+    api_latencies = [latency for probe, latency, _ in results if probe in API_PROBES]
+    errors = [error for _, _, error in results if error]
+    probes = [probe for probe, _, _ in results if probe]
+    return {'url': ckan_url,
+            'alive': int(bool(api_latencies)),
+            'probe': max(set(probes), key=probes.count) if probes else None,
+            'latency': statistics.median(api_latencies) if api_latencies else None,
+            'error_rate': 1 - len(api_latencies)/attempts,
+            'error': errors[-1] if errors else None,
+            'checked': time.time()}
+
+
+async def _probe_all(ckan_urls, concurrency, timeout):
+    sem = asyncio.Semaphore(concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(timeout=client_timeout) as session:
+        async def bounded(ckan_url):
+            async with sem:
+                return await probe_instance(session, ckan_url)
+
+        return await asyncio.gather(*[bounded(ckan_url) for ckan_url in ckan_urls])
+
+
+def probe_instances(ckan_urls, ttl=HEALTH_TTL, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT, cache=None):
+    # health of every instance url, probing concurrently only the ones without a fresh cached result
+    cache = cache or get_health_cache()
+    health = {}
+    for ckan_url in ckan_urls:
+        cached = cache.get(ckan_url, ttl)
+        if cached:
+            health[ckan_url] = cached
+    to_probe = [ckan_url for ckan_url in ckan_urls if ckan_url not in health]
+    if to_probe:
+        print('probing', len(to_probe), 'instances')
+        for result in asyncio.run(_probe_all(to_probe, concurrency, timeout)):
+            cache.put(result)
+            health[result['url']] = result
+    return health
+
+
+def rank_instances(instance_urls, health, host_limit):
+    # drops instances that are down and orders the rest fastest first. returns them with per-host
+    # connection limits scaled around host_limit: faster and more reliable than the median gets
+    # more (up to twice as many), slower or flakier gets fewer
+    live = {name: url for name, url in instance_urls.items() if health[url]['alive']}
+    for name in instance_urls:
+        if name not in live:
+            print('skipping unreachable instance', name, ':', health[instance_urls[name]]['error'])
+    if not live:
+        return {}, {}
+
+    median = statistics.median(health[url]['latency'] for url in live.values())
+    host_limits = {}
+    for url in live.values():
+        speed = max(median, MIN_LATENCY)/max(health[url]['latency'], MIN_LATENCY)
+        weight = speed*(1 - health[url]['error_rate'])
+        host_limits[get_host(url)] = max(1, min(2*host_limit, round(host_limit*weight)))
+    ranked = dict(sorted(live.items(), key=lambda item: health[item[1]]['latency']))
+    return ranked, host_limits
+
+
+def report_health(health):
+    for ckan_url, result in sorted(health.items(), key=lambda item: (not item[1]['alive'], item[1]['latency'] or 0)):
+        if result['alive']:
+            print('{0}: {1:.0f} ms via {2}, {3:.0%} errors'.format(ckan_url, 1000*result['latency'], result['probe'],
+                                                                  result['error_rate']))
+        else:
+            print('{0}: down ({1})'.format(ckan_url, result['error']))
+
+
+_caches = {}
+
+
+def get_health_cache(db_path=HEALTH_PATH):
+    # one connection per process
+    key = (os.getpid(), db_path)
+    if key not in _caches:
+        _caches[key] = HealthCache(db_path)
+    return _caches[key]
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+from utils import open_db
+
+
+MANIFEST_PATH = 'data/crawl-manifest.db'
+
+COMPLETE = 'complete'
+PARTIAL = 'partial'
+FAILED = 'failed'
+TOO_LARGE = 'too_large'
+REJECTED = 'rejected'  # body didn't match the format it claimed, see sniff.py
+
+
+class CrawlManifest:
+    # one row per (remote url, local path) recording what we saved and the validators the server
+    # gave us, so re-crawls can skip without touching the filesystem or revalidate with a
+    # conditional request instead of downloading again
+
+    def __init__(self, db_path=MANIFEST_PATH):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS resources (
+                                url TEXT NOT NULL,
+                                path TEXT NOT NULL,
+                                size INTEGER,
+                                sha256 TEXT,
+                                etag TEXT,
+                                last_modified TEXT,
+                                status TEXT NOT NULL,
+                                checked REAL NOT NULL,
+                                PRIMARY KEY (url, path))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS resources_path ON resources (path)')
+
+    def get(self, url, path):
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM resources WHERE url = ? AND path = ?', (url, path)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, url, path, status, size=None, sha256=None, etag=None, last_modified=None):
+        # fields left as None keep whatever was recorded before (e.g. on a 304 revalidation)
+        with self.lock:
+            self.conn.execute('''INSERT INTO resources (url, path, size, sha256, etag, last_modified, status, checked)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT (url, path) DO UPDATE SET
+                                    size = COALESCE(excluded.size, size),
+                                    sha256 = COALESCE(excluded.sha256, sha256),
+                                    etag = COALESCE(excluded.etag, etag),
+                                    last_modified = COALESCE(excluded.last_modified, last_modified),
+                                    status = excluded.status,
+                                    checked = excluded.checked''',
+                              (url, path, size, sha256, etag, last_modified, status, time.time()))
+
+    def start(self, url, path, etag=None, last_modified=None):
+        # a fresh transfer is starting, remember its validators so it can be resumed with If-Range
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO resources (url, path, size, sha256, etag, last_modified, status, checked)
+                                 VALUES (?, ?, NULL, NULL, ?, ?, ?, ?)''',
+                              (url, path, etag, last_modified, PARTIAL, time.time()))
+
+    def unfinished(self, folder):
+        # (url, path) of every failed or interrupted download saved under folder
+        prefix = os.path.join(folder, '')
+        # paths under folder sort between "<folder>/" and "<folder>0", so the path index does the work
+        with self.lock:
+            rows = self.conn.execute('SELECT url, path FROM resources WHERE path >= ? AND path < ? AND status IN (?, ?)',
+                                     (prefix, prefix[:-1] + '0', FAILED, PARTIAL)).fetchall()
+        return [(row['url'], row['path']) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def is_complete(entry):
+    return bool(entry) and entry['status'] == COMPLETE
+
+
+def is_partial(entry):
+    return bool(entry) and entry['status'] == PARTIAL
+
+
+def has_validators(entry):
+    return bool(entry) and bool(entry['etag'] or entry['last_modified'])
+
+
+def conditional_headers(entry):
+    headers = {}
+    if is_complete(entry):
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+_manifests = {}
+
+
+def get_manifest(db_path=MANIFEST_PATH):
+    # one connection per process, so pool workers can share the manifest file
+    key = (os.getpid(), db_path)
+    if key not in _manifests:
+        _manifests[key] = CrawlManifest(db_path)
+    return _manifests[key]
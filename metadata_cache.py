@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+
+from utils import open_db
+
+
+METADATA_CACHE_PATH = 'data/ddw-metadata.db'
+
+CLAIM_TIMEOUT = 120  # seconds before someone else's in-flight claim is treated as dead
+POLL_INTERVAL = 0.2
+
+
+class MetadataCache:
+    # dataset metadata keyed by "<owner>/<id>". concurrent callers asking for the same dataset,
+    # whether threads or worker processes, share one in-flight request: the first claims the
+    # dataset and fetches, the rest wait for its result. results persist across runs
+
+    def __init__(self, db_path=METADATA_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.dataset_locks = {}
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                                dataset TEXT PRIMARY KEY,
+                                content TEXT NOT NULL,
+                                fetched REAL NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS inflight (
+                                dataset TEXT PRIMARY KEY,
+                                claimed REAL NOT NULL)''')
+
+    def get(self, dataset):
+        with self.lock:
+            row = self.conn.execute('SELECT content FROM metadata WHERE dataset = ?', (dataset,)).fetchone()
+        return json.loads(row['content']) if row else None
+
+    def put(self, dataset, content):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)', (dataset, json.dumps(content), time.time()))
+
+    def _claim(self, dataset):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT claimed FROM inflight WHERE dataset = ?', (dataset,)).fetchone()
+                claimed = row is None or now - row['claimed'] > CLAIM_TIMEOUT
+                if claimed:
+                    self.conn.execute('INSERT OR REPLACE INTO inflight VALUES (?, ?)', (dataset, now))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def _release(self, dataset):
+        with self.lock:
+            self.conn.execute('DELETE FROM inflight WHERE dataset = ?', (dataset,))
+
+    def _dataset_lock(self, dataset):
+        with self.lock:
+            return self.dataset_locks.setdefault(dataset, threading.Lock())
+
+    def get_or_fetch(self, dataset, fetch):
+        # returns (content, fetched), fetched is True only for the caller that actually ran fetch.
+        # fetch returns None on failure, which is not cached so the next run tries again
+        content = self.get(dataset)
+        if content is not None:
+            return content, False
+
+        with self._dataset_lock(dataset):
+            while True:
+                content = self.get(dataset)
+                if content is not None:
+                    return content, False
+
+                if self._claim(dataset):
+                    try:
+                        content = fetch()
+                        if content is not None:
+                            self.put(dataset, content)
+                        return content, content is not None
+                    finally:
+                        self._release(dataset)
+
+                # another process is fetching this dataset, wait for its result (or for its claim to go stale)
+                time.sleep(POLL_INTERVAL)
+
+    def close(self):
+        self.conn.close()
+
+
+_caches = {}
+
+
+def get_metadata_cache(db_path=METADATA_CACHE_PATH):
+    # one connection per process, so pool workers can share the cache file
+    key = (os.getpid(), db_path)
+    if key not in _caches:
+        _caches[key] = MetadataCache(db_path)
+    return _caches[key]
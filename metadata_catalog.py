@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+import zlib
+from hashlib import sha256
+
+from fs_index import folder_files, get_folder_index
+from utils import open_db, read_json, write_json
+
+
+CATALOG_PATH = 'data/metadata-catalog.db'
+METADATA_SUFFIX = '_metadata.json'
+# the per-folder _metadata.json files are no longer written while scraping unless this is set;
+# export_metadata_files recreates them from the catalog for anything that still needs them
+WRITE_METADATA_FILES = False
+
+
+def metadata_filename(folder):
+    return os.path.join(folder, os.path.basename(os.path.normpath(folder)) + METADATA_SUFFIX)
+
+
+def pack(metadata):
+    return zlib.compress(json.dumps(metadata, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+
+def unpack(content):
+    return json.loads(zlib.decompress(content).decode('utf-8'))
+
+
+class MetadataCatalog:
+    # every dataset's metadata in one sqlite file instead of a json file per folder. records are
+    # append-only compressed json (a new version is only added when the content changed); the
+    # datasets table points at the latest one and formats and tags are indexed next to it, so
+    # "all csv datasets tagged x" is a query rather than a walk over the tree
+
+    def __init__(self, db_path=CATALOG_PATH):
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                                record_id INTEGER PRIMARY KEY,
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                content BLOB NOT NULL,
+                                digest TEXT NOT NULL,
+                                added REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS records_dataset ON records (source, dataset)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS datasets (
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                dataset_id TEXT,
+                                folder TEXT,
+                                record_id INTEGER NOT NULL,
+                                updated REAL NOT NULL,
+                                PRIMARY KEY (source, dataset))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS datasets_dataset_id ON datasets (dataset_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS datasets_folder ON datasets (folder)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS dataset_formats (
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                format TEXT NOT NULL,
+                                PRIMARY KEY (source, dataset, format))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS dataset_formats_format ON dataset_formats (format)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS dataset_tags (
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                tag TEXT NOT NULL,
+                                PRIMARY KEY (source, dataset, tag))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS dataset_tags_tag ON dataset_tags (tag)')
+
+    def put(self, source, dataset, metadata, folder=None, dataset_id=None, formats=(), tags=()):
+        # returns True if this content was new for the dataset
+        content = pack(metadata)
+        digest = sha256(content).hexdigest()
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('''SELECT digest FROM datasets JOIN records USING (record_id)
+                                           WHERE datasets.source = ? AND datasets.dataset = ?''', (source, dataset)).fetchone()
+                changed = row is None or row['digest'] != digest
+                if changed:
+                    record_id = self.conn.execute('INSERT INTO records (source, dataset, content, digest, added) VALUES (?, ?, ?, ?, ?)',
+                                                  (source, dataset, content, digest, now)).lastrowid
+                    self.conn.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?)',
+                                      (source, dataset, dataset_id, folder, record_id, now))
+                    self.conn.execute('DELETE FROM dataset_formats WHERE source = ? AND dataset = ?', (source, dataset))
+                    self.conn.executemany('INSERT OR IGNORE INTO dataset_formats VALUES (?, ?, ?)',
+                                          [(source, dataset, file_format.lower()) for file_format in formats if file_format])
+                    self.conn.execute('DELETE FROM dataset_tags WHERE source = ? AND dataset = ?', (source, dataset))
+                    self.conn.executemany('INSERT OR IGNORE INTO dataset_tags VALUES (?, ?, ?)',
+                                          [(source, dataset, tag) for tag in tags if tag])
+                elif folder is not None:
+                    # same content scraped into another tree, point at where it lives now
+                    self.conn.execute('UPDATE datasets SET folder = ? WHERE source = ? AND dataset = ? AND folder IS NOT ?',
+                                      (folder, source, dataset, folder))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return changed
+
+    def get(self, source, dataset):
+        with self.lock:
+            row = self.conn.execute('''SELECT content FROM datasets JOIN records USING (record_id)
+                                       WHERE datasets.source = ? AND datasets.dataset = ?''', (source, dataset)).fetchone()
+        return unpack(row['content']) if row else None
+
+    def folder(self, source, dataset):
+        # where a cataloged dataset was saved, None if it isn't cataloged
+        with self.lock:
+            row = self.conn.execute('SELECT folder FROM datasets WHERE source = ? AND dataset = ?', (source, dataset)).fetchone()
+        return row['folder'] if row else None
+
+    def rename(self, old_folder, new_folder):
+        # point the datasets saved in a folder that was moved at its new path, like FolderIndex.rename
+        with self.lock:
+            self.conn.execute('UPDATE datasets SET folder = ? WHERE folder = ?', (new_folder, old_folder))
+
+    def history(self, source, dataset):
+        # [(added, metadata)] every stored version, oldest first
+        with self.lock:
+            rows = self.conn.execute('SELECT added, content FROM records WHERE source = ? AND dataset = ? ORDER BY record_id',
+                                     (source, dataset)).fetchall()
+        return [(row['added'], unpack(row['content'])) for row in rows]
+
+    def find(self, source=None, file_format=None, tag=None, dataset_id=None):
+        # [(source, dataset)] matching every filter given
+        query = 'SELECT datasets.source, datasets.dataset FROM datasets'
+        conditions, params = [], []
+        if file_format is not None:
+            query += ' JOIN dataset_formats USING (source, dataset)'
+            conditions.append('dataset_formats.format = ?')
+            params.append(file_format.lower())
+        if tag is not None:
+            query += ' JOIN dataset_tags USING (source, dataset)'
+            conditions.append('dataset_tags.tag = ?')
+            params.append(tag)
+        if source is not None:
+            conditions.append('datasets.source = ?')
+            params.append(source)
+        if dataset_id is not None:
+            conditions.append('datasets.dataset_id = ?')
+            params.append(dataset_id)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY datasets.source, datasets.dataset', params).fetchall()
+        return [(row['source'], row['dataset']) for row in rows]
+
+    def iter_metadata(self, source=None, batch_size=1000):
+        # yields (source, dataset, folder, metadata) for the latest version of every dataset
+        query = '''SELECT datasets.source, datasets.dataset, folder, content FROM datasets JOIN records USING (record_id)
+                   {0} ORDER BY datasets.source, datasets.dataset'''.format('WHERE datasets.source = ?' if source else '')
+        with self.lock:
+            cursor = self.conn.execute(query, (source,) if source else ())
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row['source'], row['dataset'], row['folder'], unpack(row['content'])
+
+    def close(self):
+        self.conn.close()
+
+
+def ckan_entry(dataset):
+    # (dataset_id, formats, tags) of a ckan package
+    formats = {resource.get('format', '') for resource in dataset.get('resources', [])}
+    return dataset.get('id'), formats, [tag['display_name'] for tag in dataset.get('tags', [])]
+
+
+def ddw_entry(content):
+    # (dataset_id, formats, tags) of data.world dataset metadata
+    formats = {os.path.splitext(file_info.get('name', ''))[1].lstrip('.') for file_info in content.get('files', [])}
+    return content.get('id'), formats, content.get('tags') or []
+
+
+def record_metadata(source, dataset, metadata, folder, entry):
+    # catalog a dataset's metadata, and write its _metadata.json too if the old layout is wanted
+    dataset_id, formats, tags = entry
+    get_metadata_catalog().put(source, dataset, metadata, folder=folder, dataset_id=dataset_id, formats=formats, tags=tags)
+    if WRITE_METADATA_FILES and folder:
+        write_json(metadata, metadata_filename(folder))
+
+
+def metadata_file_missing(folder):
+    # a folder that should have a _metadata.json (see WRITE_METADATA_FILES) but doesn't
+    return WRITE_METADATA_FILES and not os.path.isfile(metadata_filename(folder))
+
+
+def export_metadata_files(source=None):
+    # recreate the per-folder _metadata.json layout from the catalog
+    n_written = 0
+    for _, _, folder, metadata in get_metadata_catalog().iter_metadata(source):
+        if folder and os.path.isdir(folder):
+            write_json(metadata, metadata_filename(folder))
+            n_written += 1
+    print('exported', n_written, 'metadata files')
+
+
+def import_metadata_files(root, source, entry=ckan_entry, depth=1, exclude=()):
+    # load the _metadata.json files of an existing tree into the catalog, found through the folder index
+    catalog = get_metadata_catalog()
+    n_imported = 0
+    for folder in get_folder_index().index(root, depth=depth, exclude=exclude):
+        metadata_files = folder_files(folder, METADATA_SUFFIX)
+        if metadata_files:
+            metadata = read_json(metadata_files[0])
+            dataset_id, formats, tags = entry(metadata)
+            catalog.put(source, os.path.relpath(folder['path'], root), metadata, folder=folder['path'],
+                        dataset_id=dataset_id, formats=formats, tags=tags)
+            n_imported += 1
+    print('imported', n_imported, 'metadata files from', root)
+
+
+_catalogs = {}
+
+
+def get_metadata_catalog(db_path=CATALOG_PATH):
+    # one connection per process, so pool workers can share the catalog file
+    key = (os.getpid(), db_path)
+    if key not in _catalogs:
+        _catalogs[key] = MetadataCatalog(db_path)
+    return _catalogs[key]
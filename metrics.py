@@ -0,0 +1,317 @@
+import cProfile
+import glob
+import json
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+METRICS_DIR = 'data/metrics'
+PROFILE_DIR = 'data/profiles'
+PROFILE_ENV = 'SCRAPER_PROFILE'  # 'cprofile' or 'sample' turns on the profiling hooks
+PREFIX = 'scraper_'
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PROGRESS_INTERVAL = 1.0
+EXPORT_INTERVAL = 15.0
+WORKER_EXPORT_INTERVAL = 2.0  # how often worker processes write their snapshot for the parent's Progress
+SAMPLE_INTERVAL = 0.01
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Metrics:
+    # counters, gauges and latency histograms for this process, keyed by name and labels
+    # (instance, bucket, host, ...). cheap enough to update from the download hot path
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.gauges = {}
+        self.histograms = {}  # (name, labels) -> [count per bucket..., +inf count, sum]
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, label_key(labels)] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name, label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, label_key(labels)), [0]*(len(LATENCY_BUCKETS) + 2))
+            for ind, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[ind] += 1
+                    break
+            else:
+                histogram[len(LATENCY_BUCKETS)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def total(self, name):
+        # a counter summed over all its labels
+        with self.lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'counters': [{'name': name, 'labels': dict(key), 'value': value}
+                             for (name, key), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(key), 'value': value}
+                           for (name, key), value in sorted(self.gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(key), 'buckets': list(LATENCY_BUCKETS),
+                                'counts': histogram[:-1], 'sum': histogram[-1]}
+                               for (name, key), histogram in sorted(self.histograms.items())],
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for (name, key), value in sorted(self.counters.items()):
+                lines.append('{0}{1}{2} {3}'.format(PREFIX, name, format_labels(key), value))
+            for (name, key), value in sorted(self.gauges.items()):
+                lines.append('{0}{1}{2} {3}'.format(PREFIX, name, format_labels(key), value))
+            for (name, key), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip([*LATENCY_BUCKETS, '+Inf'], histogram[:-1]):
+                    cumulative += count
+                    lines.append('{0}{1}_bucket{2} {3}'.format(PREFIX, name, format_labels(key, [('le', str(bound))]),
+                                                               cumulative))
+                lines.append('{0}{1}_sum{2} {3}'.format(PREFIX, name, format_labels(key), histogram[-1]))
+                lines.append('{0}{1}_count{2} {3}'.format(PREFIX, name, format_labels(key), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, metrics_dir=METRICS_DIR):
+        # <host>-<pid>.prom for a node exporter textfile collector and <host>-<pid>.json, both atomic
+        os.makedirs(metrics_dir, exist_ok=True)
+        base = os.path.join(metrics_dir, '{0}-{1}'.format(socket.gethostname(), os.getpid()))
+        for filename, content in ((base + '.prom', self.prometheus_text()),
+                                  (base + '.json', json.dumps(self.snapshot(), indent=2))):
+            with open(filename + '.tmp', 'w') as metrics_file:
+                metrics_file.write(content)
+            os.replace(filename + '.tmp', filename)
+
+
+_metrics = {}
+
+
+def get_metrics():
+    # one registry per process
+    pid = os.getpid()
+    if pid not in _metrics:
+        _metrics[pid] = Metrics()
+    return _metrics[pid]
+
+
+def profiling_mode():
+    return os.environ.get(PROFILE_ENV)
+
+
+_profiles = {}  # section name -> finished cProfile.Profile objects
+_profiles_lock = threading.Lock()
+_active = threading.local()
+
+
+@contextmanager
+def profile_section(name):
+    # opt-in cProfile around a hot path. python allows one profiler per thread, so concurrent or
+    # nested sections in a thread (e.g. many process_resource tasks on one event loop) share the
+    # profiler of the outermost one, which stays on until the last of them finishes
+    if profiling_mode() != 'cprofile':
+        yield
+        return
+
+    if getattr(_active, 'depth', 0) == 0:
+        _active.name = name
+        _active.profile = cProfile.Profile()
+        _active.profile.enable()
+    _active.depth = getattr(_active, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _active.depth -= 1
+        if _active.depth == 0:
+            _active.profile.disable()
+            with _profiles_lock:
+                _profiles.setdefault(_active.name, []).append(_active.profile)
+
+
+def dump_profiles(profile_dir=PROFILE_DIR):
+    # one .pstats file per section for this process, open with pstats or snakeviz
+    with _profiles_lock:
+        sections = {name: profiles for name, profiles in _profiles.items() if profiles}
+        _profiles.clear()
+    if not sections:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    for name, profiles in sections.items():
+        filename = os.path.join(profile_dir, '{0}-{1}.pstats'.format(name, os.getpid()))
+        stats = pstats.Stats(*profiles)
+        if os.path.isfile(filename):
+            stats.add(filename)
+        stats.dump_stats(filename)
+        print('wrote profile', filename)
+
+
+class SamplingProfiler:
+    # samples every thread's stack from a background thread; coroutines and threads are both covered
+    # without touching the code being measured. writes collapsed stacks for flamegraph tools
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('{0}:{1}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, profile_dir=PROFILE_DIR):
+        self.stopped.set()
+        self.thread.join()
+        os.makedirs(profile_dir, exist_ok=True)
+        filename = os.path.join(profile_dir, 'samples-{0}.collapsed'.format(os.getpid()))
+        with open(filename, 'w') as samples_file:
+            for stack, count in self.stacks.most_common():
+                samples_file.write('{0} {1}\n'.format(stack, count))
+        print('wrote', sum(self.stacks.values()), 'stack samples to', filename)
+
+
+def flush_metrics(metrics_dir=METRICS_DIR, profile_dir=PROFILE_DIR):
+    # for worker processes to call on the way out
+    get_metrics().write(metrics_dir)
+    dump_profiles(profile_dir)
+
+
+@contextmanager
+def export_metrics(metrics_dir=METRICS_DIR, interval=WORKER_EXPORT_INTERVAL):
+    # for worker processes: writes this process's snapshot every interval while the body runs, so the
+    # parent's Progress line can add it up, and flushes once more on the way out
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            get_metrics().write(metrics_dir)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+        flush_metrics(metrics_dir)
+
+
+def read_worker_totals(metrics_dir, since):
+    # counters summed over the snapshots other processes on this host wrote since the given time
+    totals = Counter()
+    host, pid = socket.gethostname(), os.getpid()
+    for filename in glob.glob(os.path.join(metrics_dir, '{0}-*.json'.format(host))):
+        try:
+            with open(filename) as metrics_file:
+                snapshot = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+        if snapshot['pid'] == pid or snapshot['time'] - snapshot['uptime'] < since:
+            continue
+        for counter in snapshot['counters']:
+            totals[counter['name']] += counter['value']
+    return totals
+
+
+class Progress:
+    # live one-line status on stderr, metrics exported every EXPORT_INTERVAL and once more at the end,
+    # and the sampling profiler running for the duration if SCRAPER_PROFILE=sample
+
+    def __init__(self, label, metrics_dir=METRICS_DIR, interval=PROGRESS_INTERVAL, export_interval=EXPORT_INTERVAL):
+        self.label = label
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self.export_interval = export_interval
+        self.metrics = get_metrics()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.sampler = None
+        self.started = time.time()
+        self.last = (time.monotonic(), 0)
+
+    def line(self):
+        # worker processes started during the run (see export_metrics) count towards the totals
+        worker_totals = read_worker_totals(self.metrics_dir, self.started)
+
+        def total(name):
+            return self.metrics.total(name) + worker_totals[name]
+
+        now = time.monotonic()
+        n_bytes = total('bytes_total')
+        rate = (n_bytes - self.last[1])/max(now - self.last[0], 1e-6)
+        self.last = (now, n_bytes)
+        return '{0}: {1} items, {2} files, {3:.1f} MB at {4:.1f} MB/s, {5} skipped, {6} retries, {7} failed'.format(
+            self.label, total('items_total'), total('files_total'), n_bytes/2**20, rate/2**20, total('skips_total'),
+            total('retries_total'), total('failures_total'))
+
+    def run(self):
+        last_export = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            sys.stderr.write('\r' + self.line() + '\x1b[K')
+            sys.stderr.flush()
+            if time.monotonic() - last_export >= self.export_interval:
+                self.metrics.write(self.metrics_dir)
+                last_export = time.monotonic()
+
+    def __enter__(self):
+        if profiling_mode() == 'sample':
+            self.sampler = SamplingProfiler().start()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        sys.stderr.write('\r' + self.line() + '\x1b[K\n')
+        if self.sampler:
+            self.sampler.stop()
+        flush_metrics(self.metrics_dir)
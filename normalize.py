@@ -0,0 +1,215 @@
+import csv
+import datetime
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import xlrd
+
+from fs_index import folder_files, get_folder_index
+from sniff import SNIFF_SIZE, sniff_kind
+from utils import read_json, write_json
+
+
+EXCEL_FORMATS = ('xls', 'xlsx')
+OUTPUT_FORMATS = ('csv', 'parquet')
+NORMALIZED_SUFFIX = '.normalized.json'  # sidecar recording which version of a workbook was converted
+PARQUET_BATCH_ROWS = 10000
+
+# trees the batch stage walks: (root, folder depth, folder names to leave out)
+NORMALIZE_TREES = (
+    ('data/ckan', 2, ('preprocessed',)),
+    ('data/ddw-s3', 1, ('labeled',)),
+    ('data/ddw-s3/labeled', 1, ()),
+)
+
+
+def cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def iter_xls_sheets(excel_filename):
+    # legacy workbooks; on_demand loads one sheet at a time
+    workbook = xlrd.open_workbook(excel_filename, on_demand=True)
+    try:
+        for sheet_name in workbook.sheet_names():
+            sheet = workbook.sheet_by_name(sheet_name)
+
+            def rows(sheet=sheet):
+                for row_ind in range(sheet.nrows):
+                    yield [xlrd.xldate_as_datetime(cell.value, workbook.datemode) if cell.ctype == xlrd.XL_CELL_DATE
+                           else cell.value for cell in sheet.row(row_ind)]
+
+            yield sheet_name, sheet.ncols, rows()
+            workbook.unload_sheet(sheet_name)
+    finally:
+        workbook.release_resources()
+
+
+def iter_xlsx_sheets(excel_filename):
+    # read_only streams rows out of the xml instead of building the whole workbook in memory
+    import openpyxl
+
+    # (opened as a file object, since openpyxl refuses paths that don't end in .xlsx)
+    with open(excel_filename, 'rb') as excel_file:
+        workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield sheet.title, sheet.max_column, sheet.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+
+def iter_sheets(excel_filename):
+    # yields (sheet name, column count or None, rows) for every sheet. the reader is picked from the
+    # file's leading bytes, since portals mix up xls and xlsx extensions
+    with open(excel_filename, 'rb') as excel_file:
+        kind = sniff_kind(excel_file.read(SNIFF_SIZE))
+    if kind == 'xls':
+        return iter_xls_sheets(excel_filename)
+    if kind == 'xlsx':
+        return iter_xlsx_sheets(excel_filename)
+    raise ValueError('{0} is not an excel workbook, looks like {1}'.format(excel_filename, kind))
+
+
+def write_csv(rows, csv_filename):
+    tmp_filename = csv_filename + '.tmp'
+    with open(tmp_filename, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerows([cell_text(value) for value in row] for row in rows)
+    os.replace(tmp_filename, csv_filename)
+
+
+def write_parquet(rows, n_cols, parquet_filename, batch_rows=PARQUET_BATCH_ROWS):
+    # every column as strings, like the csv. the width is the wider of the sheet's recorded
+    # dimensions and the first batch; rows longer than that further down are cut off
+    tmp_filename = parquet_filename + '.tmp'
+    writer = None
+    n_truncated = 0
+    batch = []
+    try:
+        for row in rows:
+            batch.append([cell_text(value) for value in row])
+            if len(batch) == batch_rows:
+                if writer is None:
+                    n_cols, writer = open_parquet_writer(tmp_filename, batch, n_cols)
+                n_truncated += write_parquet_batch(writer, batch, n_cols)
+                batch = []
+        if writer is None:
+            n_cols, writer = open_parquet_writer(tmp_filename, batch, n_cols)
+        n_truncated += write_parquet_batch(writer, batch, n_cols)
+    finally:
+        if writer is not None:
+            writer.close()
+    if n_truncated:
+        print(n_truncated, 'rows wider than', n_cols, 'columns were cut off in', parquet_filename)
+    os.replace(tmp_filename, parquet_filename)
+
+
+def open_parquet_writer(filename, first_batch, n_cols=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    n_cols = max([n_cols or 0, *(len(row) for row in first_batch)])
+    schema = pa.schema([('column_{0}'.format(ind), pa.string()) for ind in range(n_cols)])
+    return n_cols, pq.ParquetWriter(filename, schema)
+
+
+def write_parquet_batch(writer, batch, n_cols):
+    import pyarrow as pa
+
+    if not batch:
+        return 0
+    n_truncated = sum(len(row) > n_cols for row in batch)
+    columns = [[row[ind] if ind < len(row) else '' for row in batch] for ind in range(n_cols)]
+    writer.write_table(pa.Table.from_arrays([pa.array(column, pa.string()) for column in columns], schema=writer.schema))
+    return n_truncated
+
+
+def output_filename(excel_filename, sheet_name, out_format, sheet_ind=0, used=None):
+    # sheet names that sanitize to the same name ("Data 1" and "Data-1") get the sheet's index appended.
+    # used holds the (lowercased, for case-insensitive filesystems) names already taken in the workbook
+    stem = os.path.splitext(excel_filename)[0]
+    safe_name = ''.join(c if c.isalnum() or c in '-_.' else '-' for c in sheet_name.strip()) or 'sheet'
+    used = set() if used is None else used
+    name, suffix = safe_name, 0
+    while name.lower() in used:
+        name = '{0}-{1}'.format(safe_name, sheet_ind + suffix)
+        suffix += 1
+    used.add(name.lower())
+    return '{0}.{1}.{2}'.format(stem, name, out_format)
+
+
+def source_version(excel_filename):
+    stat = os.stat(excel_filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_normalized(excel_filename, out_format):
+    sidecar = excel_filename + NORMALIZED_SUFFIX
+    if not os.path.isfile(sidecar):
+        return False
+    record = read_json(sidecar)
+    return (record['format'] == out_format and record['source'] == source_version(excel_filename)
+            and all(os.path.isfile(output) for output in record['outputs']))
+
+
+def normalize_file(excel_filename, out_format='csv'):
+    # converts every sheet of the workbook to <stem>.<sheet>.<format> next to it, unless this version
+    # of the workbook was converted already. returns the output files
+    if out_format not in OUTPUT_FORMATS:
+        raise ValueError('unknown output format: {0}'.format(out_format))
+    if is_normalized(excel_filename, out_format):
+        return read_json(excel_filename + NORMALIZED_SUFFIX)['outputs']
+
+    version = source_version(excel_filename)
+    outputs = []
+    used = set()
+    for sheet_ind, (sheet_name, n_cols, rows) in enumerate(iter_sheets(excel_filename)):
+        output = output_filename(excel_filename, sheet_name, out_format, sheet_ind, used)
+        if out_format == 'csv':
+            write_csv(rows, output)
+        else:
+            write_parquet(rows, n_cols, output)
+        outputs.append(output)
+
+    write_json({'format': out_format, 'source': version, 'outputs': outputs}, excel_filename + NORMALIZED_SUFFIX)
+    return outputs
+
+
+def normalize_files(excel_filenames, out_format='csv', n_workers=None):
+    # conversion is cpu bound, so workbooks are spread over processes
+    n_converted = 0
+    with ProcessPoolExecutor(max_workers=n_workers or multiprocessing.cpu_count()) as executor:
+        futures = {executor.submit(normalize_file, excel_filename, out_format): excel_filename
+                   for excel_filename in excel_filenames}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                n_converted += 1
+            except Exception as e:
+                print('error normalizing', futures[future])
+                print('error:', e)
+    print('normalized', n_converted, 'of', len(futures), 'workbooks to', out_format)
+
+
+def excel_files(root, depth=1, exclude=()):
+    files = []
+    for folder in get_folder_index().index(root, depth=depth, exclude=exclude):
+        for excel_format in EXCEL_FORMATS:
+            files.extend(folder_files(folder, '.' + excel_format))
+    return files
+
+
+def normalize_all(trees=NORMALIZE_TREES, out_format='csv', n_workers=None):
+    excel_filenames = []
+    for root, depth, exclude in trees:
+        if os.path.isdir(root):
+            excel_filenames.extend(excel_files(root, depth, exclude))
+    normalize_files(excel_filenames, out_format, n_workers)
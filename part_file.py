@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+
+PART_SUFFIX = '.part'
+BUFFER_SIZE = 1 << 20
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+class PartFile:
+    # streams a download into <path>.part through one large reusable buffer, hashing as it goes,
+    # and only renames it over <path> once the size checks out, so an interrupted transfer never
+    # looks like a finished file and can be resumed from where it stopped
+
+    def __init__(self, path, buffer=None):
+        self.path = path
+        self.part_path = path + PART_SUFFIX
+        self.buffer = buffer if buffer is not None else bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.file = None
+        self.fill = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    @property
+    def n_bytes(self):
+        return self.size + self.fill
+
+    def existing_size(self):
+        return os.path.getsize(self.part_path) if os.path.isfile(self.part_path) else 0
+
+    def open(self, offset=0):
+        self.fill = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        if offset:
+            self.file = open(self.part_path, 'r+b', buffering=0)
+            self.file.truncate(offset)
+            self._hash_existing(offset)
+        else:
+            self.file = open(self.part_path, 'wb', buffering=0)
+
+    def _hash_existing(self, offset):
+        # resumed downloads still need the digest of the whole file
+        self.file.seek(0)
+        while self.size < offset:
+            n_read = self.file.readinto(self.view[:min(len(self.buffer), offset - self.size)])
+            if not n_read:
+                break
+            self.sha256.update(self.view[:n_read])
+            self.size += n_read
+        self.file.seek(self.size)
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            n_copy = min(len(data), len(self.buffer) - self.fill)
+            self.view[self.fill:self.fill + n_copy] = data[:n_copy]
+            self.fill += n_copy
+            data = data[n_copy:]
+            if self.fill == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        if self.fill:
+            chunk = self.view[:self.fill]
+            self.sha256.update(chunk)
+            self.size += self.fill
+            while chunk:
+                chunk = chunk[self.file.write(chunk):]
+            self.fill = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def commit(self, expected_size=None):
+        self.close()
+        if expected_size is not None and self.size != expected_size:
+            raise IncompleteDownload('got {0} of {1} bytes for {2}'.format(self.size, expected_size, self.path))
+        os.replace(self.part_path, self.path)
+        return self.size, self.sha256.hexdigest()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.isfile(self.part_path):
+            os.remove(self.part_path)
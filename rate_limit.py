@@ -0,0 +1,249 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+from connections import get_session
+from metrics import get_metrics
+from utils import open_db
+
+
+RATE_LIMIT_PATH = 'data/rate-limits.db'
+
+DEFAULT_RATE = 4.0  # requests per second per host
+MAX_RATE = 50.0
+MIN_RATE = 0.05
+BURST = 8
+RATE_STEP = 0.1  # additive increase per successful request
+BACKOFF_FACTOR = 0.5  # multiplicative decrease per throttling signal
+
+MIN_WAIT = 2
+MAX_WAIT = 300
+MAX_RETRIES = 8
+
+THROTTLE_STATUSES = (429, 500, 502, 503, 504, 509)
+
+
+class Throttled(Exception):
+
+    def __init__(self, status, retry_after=None):
+        super().__init__('throttled with status {0}, retry after {1}'.format(status, retry_after))
+        self.status = status
+        self.retry_after = retry_after
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostRateLimiter:
+    # token bucket per host with AIMD rate adaptation: every success nudges the rate up, every
+    # 429/5xx halves it and blocks the host for Retry-After (or an exponential backoff). the state
+    # lives in sqlite so every worker thread and process talking to a host shares one bucket
+
+    def __init__(self, db_path=RATE_LIMIT_PATH, rate=DEFAULT_RATE, max_rate=MAX_RATE, burst=BURST, host_rates=None):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self.lock = threading.Lock()
+        self._executor = None
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS hosts (
+                                host TEXT PRIMARY KEY,
+                                rate REAL NOT NULL,
+                                tokens REAL NOT NULL,
+                                updated REAL NOT NULL,
+                                blocked_until REAL NOT NULL,
+                                strikes INTEGER NOT NULL)''')
+
+    def _update(self, host, func):
+        # read-modify-write a host's bucket inside one write transaction
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = self.conn.execute('SELECT * FROM hosts WHERE host = ?', (host,)).fetchone()
+                if row:
+                    state = dict(row)
+                    # refill the bucket for the time since the last update
+                    state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated'])*state['rate'])
+                else:
+                    rate = self.host_rates.get(host, self.rate)
+                    state = {'host': host, 'rate': rate, 'tokens': self.burst, 'blocked_until': 0.0, 'strikes': 0}
+                state['updated'] = now
+                result = func(state, now)
+                self.conn.execute('INSERT OR REPLACE INTO hosts VALUES (:host, :rate, :tokens, :updated, :blocked_until, :strikes)',
+                                  state)
+                self.conn.execute('COMMIT')
+                return result
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def reserve(self, host):
+        # take a token and return how long to wait before using it
+        def take(state, now):
+            state['tokens'] -= 1
+            wait = -state['tokens']/state['rate'] if state['tokens'] < 0 else 0.0
+            return max(wait, state['blocked_until'] - now)
+        return self._update(host, take)
+
+    def acquire(self, host):
+        wait = self.reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def _run_async(self, func, *args):
+        # the bucket's write transactions can block on other processes' locks, so coroutines run
+        # them on a thread of their own rather than stalling the event loop
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rate-limit')
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def acquire_async(self, host):
+        wait = await self._run_async(self.reserve, host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def succeeded_async(self, host):
+        await self._run_async(self.succeeded, host)
+
+    async def throttled_async(self, host, retry_after=None):
+        return await self._run_async(self.throttled, host, retry_after)
+
+    def succeeded(self, host):
+        def speed_up(state, now):
+            state['strikes'] = 0
+            state['rate'] = min(self.max_rate, state['rate'] + RATE_STEP)
+        self._update(host, speed_up)
+
+    def set_rate(self, host, rate):
+        # start a host at a known rate, it keeps adapting from there
+        def reset(state, now):
+            state['rate'] = min(self.max_rate, max(MIN_RATE, rate))
+            state['blocked_until'] = 0.0
+            state['strikes'] = 0
+        self._update(host, reset)
+
+    def throttled(self, host, retry_after=None):
+        def back_off(state, now):
+            state['strikes'] += 1
+            state['rate'] = max(MIN_RATE, state['rate']*BACKOFF_FACTOR)
+            state['tokens'] = min(state['tokens'], 0.0)
+            wait = min(MAX_WAIT, MIN_WAIT*2**(state['strikes'] - 1))
+            if retry_after is not None:
+                wait = max(wait, retry_after)
+            state['blocked_until'] = max(state['blocked_until'], now + wait)
+            return wait
+        return self._update(host, back_off)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.conn.close()
+
+
+class ThroughputTarget:
+    # shared byte-rate pacing for a set of worker processes: each transfer reserves a slice of time
+    # proportional to its size. the target lives in shared memory so it can be retuned while the
+    # workers run, a target of 0 means unthrottled
+
+    def __init__(self, bytes_per_sec=0):
+        self.target = multiprocessing.Value('d', bytes_per_sec)
+        self.next_free = multiprocessing.Value('d', 0.0)
+        self.next_check = multiprocessing.Value('d', 0.0)
+
+    def check_due(self, interval):
+        # true for one caller across all the processes every interval seconds, to re-read the target
+        with self.next_check.get_lock():
+            now = time.time()
+            if now < self.next_check.value:
+                return False
+            self.next_check.value = now + interval
+            return True
+
+    def set_target(self, bytes_per_sec):
+        if bytes_per_sec != self.target.value:
+            print('throughput target set to', round(bytes_per_sec/2**20, 2), 'MB/s')
+            self.target.value = bytes_per_sec
+
+    def wait(self, n_bytes):
+        with self.next_free.get_lock():
+            target = self.target.value
+            if target <= 0 or not n_bytes:
+                return
+            now = time.time()
+            start = max(now, self.next_free.value)
+            self.next_free.value = start + n_bytes/target
+        if start > now:
+            time.sleep(start - now)
+
+
+_limiters = {}
+
+
+def get_rate_limiter(db_path=RATE_LIMIT_PATH):
+    # one connection per process, so pool workers can share the limiter file
+    key = (os.getpid(), db_path)
+    if key not in _limiters:
+        _limiters[key] = HostRateLimiter(db_path)
+    return _limiters[key]
+
+
+def limited_get(url, limiter=None, max_retries=MAX_RETRIES, **kwargs):
+    # get over the host's keep-alive session that waits its turn with the host's bucket and
+    # retries throttled responses
+    limiter = limiter or get_rate_limiter()
+    metrics = get_metrics()
+    host = get_host(url)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(host)
+        try:
+            with metrics.timer('request_seconds', host=host):
+                response = get_session(host).get(url, **kwargs)
+        except requests.exceptions.ConnectionError as err:
+            print('connection error requesting from url:', url)
+            print('error:', err)
+            if attempt == max_retries:
+                metrics.inc('failures_total', host=host, reason='connection')
+                raise err
+            limiter.throttled(host)
+            metrics.inc('retries_total', host=host, reason='connection')
+            continue
+
+        metrics.inc('requests_total', host=host, status=response.status_code)
+        if response.status_code in THROTTLE_STATUSES:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print('throttled by', host, 'status:', response.status_code, 'retry after:', retry_after)
+            limiter.throttled(host, retry_after)
+            if attempt == max_retries:
+                # still throttled after the last retry, the caller gets the response to deal with
+                metrics.inc('failures_total', host=host, reason='throttled')
+                return response
+            metrics.inc('retries_total', host=host, reason='throttled')
+            response.close()
+            continue
+
+        limiter.succeeded(host)
+        return response
@@ -0,0 +1,181 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from metrics import get_metrics
+
+
+SOURCE_QUEUE_SIZE = 256
+WORK_QUEUE_SIZE = 1024
+POLL_INTERVAL = 0.05
+RESULT_TIMEOUT = 5
+
+
+class PageTracker:
+    # counts outstanding work items per catalog page for one source and moves its cursor past a
+    # page only once every item on it has come back from a worker, so a crash never skips work
+
+    def __init__(self, cursor=None):
+        self.cursor = cursor
+        self.pages = OrderedDict()  # offset after page -> items still out
+        self.lock = threading.Lock()
+        self.enumerated = False
+
+    def add_page(self, page_end, n_items):
+        with self.lock:
+            self.pages[page_end] = n_items
+            self._advance()
+
+    def item_done(self, page_end):
+        with self.lock:
+            self.pages[page_end] -= 1
+            self._advance()
+
+    def finish_enumeration(self):
+        with self.lock:
+            self.enumerated = True
+            self._advance()
+
+    def _advance(self):
+        while self.pages and next(iter(self.pages.values())) == 0:
+            page_end, _ = self.pages.popitem(last=False)
+            if self.cursor:
+                self.cursor.save(page_end)
+        if self.enumerated and not self.pages and self.cursor:
+            self.cursor.clear()
+
+
+def run_producer(name, produce, source_queue):
+    # produce(put) enumerates one source; the None sentinel marks it finished even if it fails
+    try:
+        produce(lambda item: source_queue.put(item))
+    except Exception as err:
+        print('error enumerating', name)
+        print('error:', err)
+        traceback.print_exc()
+    finally:
+        source_queue.put(None)
+
+
+def dispatch_round_robin(source_queues, work_queue, dispatched, outstanding=None):
+    # take one item from each source in turn so one huge catalog can't crowd out the small ones.
+    # outstanding, if given, collects every dispatched item by id until its result comes back
+    active = list(source_queues.items())
+    while active:
+        progressed = False
+        for name, source_queue in list(active):
+            try:
+                item = source_queue.get_nowait()
+            except queue.Empty:
+                continue
+            progressed = True
+            if item is None:
+                active.remove((name, source_queue))
+            else:
+                if outstanding is not None:
+                    outstanding[item['id']] = item
+                work_queue.put(item)
+                dispatched[0] += 1
+        if not progressed:
+            time.sleep(POLL_INTERVAL)
+
+
+def run_work_queue(producers, worker_target, worker_args=(), on_result=None, n_workers=None,
+                   work_queue_size=WORK_QUEUE_SIZE):
+    # producers maps a source name to produce(put). items are dispatched fairly across sources onto
+    # one bounded queue, worker processes take whatever is next when they have room (so nobody sits
+    # idle while another worker has a backlog) and every item's result comes back here
+    work_queue = multiprocessing.Queue(maxsize=work_queue_size)
+    result_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker_target, args=(work_queue, result_queue, *worker_args))
+               for _ in range(n_workers or multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.start()
+
+    source_queues = {name: queue.Queue(maxsize=SOURCE_QUEUE_SIZE) for name in producers}
+    producer_threads = [threading.Thread(target=run_producer, args=(name, produce, source_queues[name]), daemon=True)
+                        for name, produce in producers.items()]
+    for thread in producer_threads:
+        thread.start()
+
+    dispatched = [0]
+    outstanding = {}
+    dispatcher = threading.Thread(target=dispatch_round_robin, args=(source_queues, work_queue, dispatched, outstanding),
+                                  daemon=True)
+    dispatcher.start()
+
+    metrics = get_metrics()
+    n_results = 0
+    failures = []
+    aborted = False
+    while dispatcher.is_alive() or n_results < dispatched[0]:
+        metrics.set('queue_depth', dispatched[0] - n_results, queue='work')
+        # workers only exit on the sentinel sent below, so one gone already died (e.g. oom killed)
+        # and took its in-flight items with it: they'd never come back, so give up on the rest
+        if any(worker.exitcode is not None for worker in workers):
+            lost = list(outstanding.values())
+            print('a worker exited with', len(lost), 'items outstanding, stopping')
+            failures.extend(dict(item, errors=['worker exited before the item finished']) for item in lost)
+            metrics.inc('items_total', len(lost), result='lost')
+            aborted = True
+            break
+        try:
+            result = result_queue.get(timeout=RESULT_TIMEOUT)
+        except queue.Empty:
+            continue
+        n_results += 1
+        outstanding.pop(result['id'], None)
+        metrics.inc('items_total', source=result['source'], result='error' if result['errors'] else 'ok')
+        if result['errors']:
+            failures.append(result)
+        if on_result:
+            on_result(result)
+
+    if aborted:
+        # the lost items aren't passed to on_result, so page cursors stay before them for the next run
+        work_queue.cancel_join_thread()
+        for worker in workers:
+            worker.terminate()
+    else:
+        for _ in workers:
+            work_queue.put(None)
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            print('worker', worker.pid, 'exited with code', worker.exitcode)
+
+    return failures
+
+
+async def drain_work_queue(work_queue, result_queue, handle_item, max_active):
+    # worker side: keep up to max_active items in progress, pulling the next one only when there is
+    # room. handle_item returns a list of error strings (empty on success)
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_active)
+    tasks = set()
+
+    async def run(item):
+        try:
+            errors = await handle_item(item)
+        except Exception:
+            errors = [traceback.format_exc()]
+        finally:
+            slots.release()
+        result_queue.put({'id': item['id'], 'source': item['source'], 'page': item['page'],
+                          'name': item['name'], 'errors': errors})
+
+    while True:
+        await slots.acquire()
+        item = await loop.run_in_executor(None, work_queue.get)
+        if item is None:
+            break
+        task = asyncio.ensure_future(run(item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.wait(tasks)
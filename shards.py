@@ -0,0 +1,311 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from utils import open_db
+
+
+SHARD_DB_PATH = 'data/shards.db'
+LEASE_TIME = 300  # seconds a claimed shard stays ours without a heartbeat
+HEARTBEAT_INTERVAL = 60
+LEASE_CHECK_INTERVAL = 5  # seconds between lease checks while a shard's downloads run
+MAX_ATTEMPTS = 5
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def default_worker_id():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def new_lease(worker_id):
+    # every claim gets its own token, so a worker can't act on a lease it already lost even if the
+    # shard comes back to it later
+    return '{0}:{1}'.format(worker_id, uuid.uuid4().hex)
+
+
+class SQLiteShardQueue:
+    # shard queue in a sqlite file, for worker processes on one machine. the file is opened in WAL
+    # mode, which needs shared memory between the processes and so doesn't work on a network
+    # filesystem: nodes on several machines use the redis backend. a shard is leased to one worker
+    # at a time and goes back to pending if its lease runs out (the worker died or lost contact)
+
+    def __init__(self, db_path=SHARD_DB_PATH, lease_time=LEASE_TIME):
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS shards (
+                                shard_id TEXT PRIMARY KEY,
+                                kind TEXT NOT NULL,
+                                payload TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                worker TEXT,
+                                lease_until REAL,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                error TEXT,
+                                updated REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS shards_status ON shards (status, lease_until)')
+
+    def add(self, shard_id, kind, payload):
+        # idempotent, so every node can run the same coordinator step
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO shards (shard_id, kind, payload, status, updated) VALUES (?, ?, ?, ?, ?)',
+                              (shard_id, kind, json.dumps(payload), PENDING, time.time()))
+
+    def claim(self, worker_id):
+        # the shard with its lease token, which heartbeat and complete need
+        now = time.time()
+        lease = new_lease(worker_id)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # expired leases out of attempts are given up on, like failed attempts in complete
+                self.conn.execute('''UPDATE shards SET status = ?, error = COALESCE(error, ?), updated = ?
+                                     WHERE status = ? AND lease_until < ? AND attempts >= ?''',
+                                  (FAILED, 'lease expired', now, LEASED, now, MAX_ATTEMPTS))
+                row = self.conn.execute('''SELECT * FROM shards
+                                           WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ?
+                                           ORDER BY attempts, rowid LIMIT 1''',
+                                        (PENDING, LEASED, now, MAX_ATTEMPTS)).fetchone()
+                if row:
+                    self.conn.execute('''UPDATE shards SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1,
+                                         updated = ? WHERE shard_id = ?''',
+                                      (LEASED, lease, now + self.lease_time, now, row['shard_id']))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return {'shard_id': row['shard_id'], 'kind': row['kind'], 'payload': json.loads(row['payload']), 'lease': lease}
+
+    def heartbeat(self, shard_id, lease):
+        # extends the lease, False means someone else owns the shard now
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute('UPDATE shards SET lease_until = ?, updated = ? WHERE shard_id = ? AND worker = ? AND status = ?',
+                                       (now + self.lease_time, now, shard_id, lease, LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id, lease, error=None):
+        # failed shards go back to pending until they run out of attempts. False if the lease was lost
+        with self.lock:
+            row = self.conn.execute('SELECT attempts FROM shards WHERE shard_id = ?', (shard_id,)).fetchone()
+            if error is None:
+                status = DONE
+            else:
+                status = FAILED if row['attempts'] >= MAX_ATTEMPTS else PENDING
+            cursor = self.conn.execute('UPDATE shards SET status = ?, error = ?, updated = ? WHERE shard_id = ? AND worker = ? AND status = ?',
+                                       (status, error, time.time(), shard_id, lease, LEASED))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) AS n FROM shards GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+
+# lua scripts, so requeueing expired leases, claiming, renewing and completing each happen atomically
+# on the redis server and a worker whose lease was taken over can't touch the shard any more
+REDIS_CLAIM = """
+local prefix, now, lease_time, lease, max_attempts = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4], tonumber(ARGV[5])
+for _, shard_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], 0, now)) do
+    redis.call('ZREM', KEYS[2], shard_id)
+    redis.call('HSET', prefix .. ':shard:' .. shard_id, 'status', 'pending')
+    redis.call('RPUSH', KEYS[1], shard_id)
+end
+while true do
+    local shard_id = redis.call('LPOP', KEYS[1])
+    if not shard_id then
+        return false
+    end
+    local key = prefix .. ':shard:' .. shard_id
+    local attempts = tonumber(redis.call('HGET', key, 'attempts') or '0')
+    if attempts >= max_attempts then
+        redis.call('HSET', key, 'status', 'failed')
+    elseif redis.call('HGET', key, 'status') == 'pending' then
+        redis.call('HSET', key, 'status', 'leased', 'worker', lease, 'attempts', attempts + 1)
+        redis.call('ZADD', KEYS[2], now + lease_time, shard_id)
+        return {shard_id, redis.call('HGET', key, 'kind'), redis.call('HGET', key, 'payload')}
+    end
+end
+"""
+REDIS_HEARTBEAT = """
+if redis.call('HGET', KEYS[1], 'worker') ~= ARGV[2] or redis.call('HGET', KEYS[1], 'status') ~= 'leased' then
+    return 0
+end
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]), ARGV[1])
+return 1
+"""
+REDIS_COMPLETE = """
+local shard_id, lease, error, max_attempts = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4])
+if redis.call('HGET', KEYS[1], 'worker') ~= lease or redis.call('HGET', KEYS[1], 'status') ~= 'leased' then
+    return 0
+end
+redis.call('ZREM', KEYS[2], shard_id)
+if error == '' then
+    redis.call('HSET', KEYS[1], 'status', 'done')
+elseif tonumber(redis.call('HGET', KEYS[1], 'attempts') or '0') >= max_attempts then
+    redis.call('HSET', KEYS[1], 'status', 'failed', 'error', error)
+else
+    redis.call('HSET', KEYS[1], 'status', 'pending', 'error', error)
+    redis.call('RPUSH', KEYS[3], shard_id)
+end
+return 1
+"""
+
+
+class RedisShardQueue:
+    # the same queue on a redis-compatible server, for nodes that don't share a filesystem.
+    # shards live in hashes, pending ids in a list and active leases in a sorted set by expiry
+
+    def __init__(self, url, lease_time=LEASE_TIME, prefix='shards'):
+        import redis  # optional, only needed for this backend
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.lease_time = lease_time
+        self.prefix = prefix
+        self._claim = self.redis.register_script(REDIS_CLAIM)
+        self._heartbeat = self.redis.register_script(REDIS_HEARTBEAT)
+        self._complete = self.redis.register_script(REDIS_COMPLETE)
+
+    def _key(self, *parts):
+        return ':'.join([self.prefix, *parts])
+
+    def add(self, shard_id, kind, payload):
+        if self.redis.hsetnx(self._key('shard', shard_id), 'payload', json.dumps(payload)):
+            self.redis.hset(self._key('shard', shard_id), mapping={'kind': kind, 'status': PENDING, 'attempts': 0})
+            self.redis.rpush(self._key('pending'), shard_id)
+
+    def claim(self, worker_id):
+        lease = new_lease(worker_id)
+        shard = self._claim(keys=[self._key('pending'), self._key('leased')],
+                            args=[self.prefix, time.time(), self.lease_time, lease, MAX_ATTEMPTS])
+        if not shard:
+            return None
+        shard_id, kind, payload = shard
+        return {'shard_id': shard_id, 'kind': kind, 'payload': json.loads(payload), 'lease': lease}
+
+    def heartbeat(self, shard_id, lease):
+        return bool(self._heartbeat(keys=[self._key('shard', shard_id), self._key('leased')],
+                                    args=[shard_id, lease, time.time() + self.lease_time]))
+
+    def complete(self, shard_id, lease, error=None):
+        return bool(self._complete(keys=[self._key('shard', shard_id), self._key('leased'), self._key('pending')],
+                                   args=[shard_id, lease, error or '', MAX_ATTEMPTS]))
+
+    def counts(self):
+        counts = {}
+        for key in self.redis.scan_iter(self._key('shard', '*')):
+            status = self.redis.hget(key, 'status')
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+def get_shard_queue(queue_url=SHARD_DB_PATH):
+    # redis://host:port/db selects the redis backend (needed across machines), anything else is a
+    # sqlite file path on local disk
+    if queue_url.startswith(('redis://', 'rediss://')):
+        return RedisShardQueue(queue_url)
+    return SQLiteShardQueue(queue_url)
+
+
+class Heartbeat:
+    # keeps a claimed shard's lease alive from a background thread while it is being worked on.
+    # handlers call check() between items and stop once the lease is gone, since by then another
+    # worker may be working on the same shard
+
+    def __init__(self, shard_queue, shard_id, lease, interval=HEARTBEAT_INTERVAL):
+        self.shard_queue = shard_queue
+        self.shard_id = shard_id
+        self.lease = lease
+        self.interval = interval
+        self.lease_until = time.time() + shard_queue.lease_time
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            try:
+                renewed = self.shard_queue.heartbeat(self.shard_id, self.lease)
+            except Exception as err:
+                # can't reach the queue, keep trying until the lease we have runs out
+                print('heartbeat failed for shard', self.shard_id, ':', err)
+                continue
+            if not renewed:
+                print('lost lease on shard', self.shard_id)
+                self.lost = True
+                return
+            self.lease_until = now + self.shard_queue.lease_time
+
+    def is_lost(self):
+        return self.lost or time.time() > self.lease_until
+
+    def check(self):
+        if self.is_lost():
+            raise LeaseLost('lost lease on shard {0}'.format(self.shard_id))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_shard_worker(queue_url, handlers, worker_id=None, idle_exit=True, poll_interval=10):
+    # claim, work and complete shards until the queue is empty. handlers maps a shard kind to
+    # handle(payload, heartbeat); an exception marks the attempt failed so the shard gets retried
+    # elsewhere, LeaseLost abandons the shard to whoever holds it now. with idle_exit the worker
+    # stays until no shard is pending or leased, so it can take over the leases of workers that die
+    shard_queue = get_shard_queue(queue_url)
+    worker_id = worker_id or default_worker_id()
+    while True:
+        shard = shard_queue.claim(worker_id)
+        if shard is None:
+            counts = shard_queue.counts()
+            if idle_exit and not (counts.get(PENDING) or counts.get(LEASED)):
+                print(worker_id, 'found no shards left, counts:', counts)
+                return
+            time.sleep(poll_interval)
+            continue
+
+        print(worker_id, 'working on shard', shard['shard_id'])
+        error = None
+        with Heartbeat(shard_queue, shard['shard_id'], shard['lease']) as heartbeat:
+            try:
+                handlers[shard['kind']](shard['payload'], heartbeat)
+            except LeaseLost:
+                print(worker_id, 'abandoning shard', shard['shard_id'])
+                continue
+            except Exception:
+                error = traceback.format_exc()
+                print('error in shard', shard['shard_id'])
+                print(error)
+        if not shard_queue.complete(shard['shard_id'], shard['lease'], error):
+            print(worker_id, 'lost lease on shard', shard['shard_id'], 'before completing it')
+
+
+def run_shard_workers(queue_url, handlers, n_workers=None):
+    # one claim loop per process on this node
+    workers = [multiprocessing.Process(target=run_shard_worker, args=(queue_url, handlers))
+               for _ in range(n_workers or multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
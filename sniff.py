@@ -0,0 +1,71 @@
+SNIFF_SIZE = 8 << 10
+
+# leading bytes of the binary formats we collect
+OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # legacy xls
+ZIP_MAGIC = b'PK\x03\x04'  # xlsx and plain zip archives
+GZIP_MAGIC = b'\x1f\x8b'
+PDF_MAGIC = b'%PDF'
+OOXML_MARKERS = (b'[Content_Types].xml', b'_rels/', b'docProps/', b'xl/')
+
+DELIMITERS = ',;\t|'
+
+HTML_MARKERS = (b'<!doctype html', b'<html', b'<head', b'<body', b'<?xml', b'<script')
+MAX_CONTROL_RATE = 0.1  # share of control characters above which "text" is really some binary format
+
+
+class BogusContent(Exception):
+    pass
+
+
+def sniff_kind(head):
+    # best guess at what the first few KB of a body actually are
+    if head.startswith(OLE2_MAGIC):
+        return 'xls'
+    if head.startswith(ZIP_MAGIC):
+        # xlsx is a zip whose first entries are the office package parts
+        return 'xlsx' if any(marker in head for marker in OOXML_MARKERS) else 'zip'
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(PDF_MAGIC):
+        return 'pdf'
+
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if text.startswith(HTML_MARKERS) or b'<html' in text[:1024]:
+        return 'html'
+    if text[:1] in (b'{', b'['):
+        return 'json'
+    if b'\x00' in head:
+        return 'binary'
+    return 'text'
+
+
+def looks_like_csv(head):
+    # only text that clearly isn't a table is turned away. plenty of real csvs have a title or notes
+    # above the header that the sniffer can't parse, so it failing on plain text is no reason to reject
+    try:
+        text = head.decode('utf-8')
+    except UnicodeDecodeError:
+        text = head.decode('latin-1')
+    n_control = sum(char < ' ' and char not in '\t\r\n\f' for char in text)
+    return n_control <= MAX_CONTROL_RATE*len(text)
+
+
+# formats we accept for each requested format
+ACCEPTED_KINDS = {
+    'csv': ('text',),
+    'txt': ('text', 'json'),
+    'json': ('json',),
+    'xls': ('xls', 'xlsx'),  # portals mislabel these two all the time, both open fine
+    'xlsx': ('xlsx', 'xls'),
+}
+
+
+def check_content(head, file_format):
+    # raise BogusContent if the start of a download doesn't look like the format it claims to be
+    if not head or file_format not in ACCEPTED_KINDS:
+        return
+    kind = sniff_kind(head)
+    if kind not in ACCEPTED_KINDS[file_format]:
+        raise BogusContent('expected {0}, got {1}'.format(file_format, kind))
+    if file_format == 'csv' and not looks_like_csv(head):
+        raise BogusContent('expected csv, text is mostly control characters')
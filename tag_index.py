@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+
+from fs_index import get_folder_index
+from utils import open_db
+
+
+TAG_INDEX_PATH = 'data/tag-index.db'
+
+
+class TagIndex:
+    # dataset tags kept up to date by the scrapers as they write tags files, with per-tag counts
+    # maintained alongside so frequency and top-n queries never scan the datasets. datasets are
+    # keyed by (source, dataset), source being the ckan instance or ddw bucket/project
+
+    def __init__(self, db_path=TAG_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = open_db(db_path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS datasets (
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                updated REAL NOT NULL,
+                                PRIMARY KEY (source, dataset))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS dataset_tags (
+                                source TEXT NOT NULL,
+                                dataset TEXT NOT NULL,
+                                tag TEXT NOT NULL,
+                                PRIMARY KEY (source, dataset, tag))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS dataset_tags_tag ON dataset_tags (tag)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tag_counts (
+                                tag TEXT NOT NULL,
+                                source TEXT NOT NULL,
+                                n INTEGER NOT NULL,
+                                PRIMARY KEY (tag, source))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tag_counts_n ON tag_counts (n)')
+
+    def set_tags(self, source, dataset, tags):
+        # replace a dataset's tags, adjusting the counts by the difference only
+        tags = set(tags or [])
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                old_tags = {row['tag'] for row in self.conn.execute(
+                    'SELECT tag FROM dataset_tags WHERE source = ? AND dataset = ?', (source, dataset))}
+                removed = [(source, dataset, tag) for tag in old_tags - tags]
+                added = [(source, dataset, tag) for tag in tags - old_tags]
+                self.conn.executemany('DELETE FROM dataset_tags WHERE source = ? AND dataset = ? AND tag = ?', removed)
+                self.conn.executemany('INSERT INTO dataset_tags VALUES (?, ?, ?)', added)
+                self.conn.executemany('UPDATE tag_counts SET n = n - 1 WHERE tag = ? AND source = ?',
+                                      [(tag, source) for _, _, tag in removed])
+                self.conn.executemany('''INSERT INTO tag_counts VALUES (?, ?, 1)
+                                         ON CONFLICT (tag, source) DO UPDATE SET n = n + 1''',
+                                      [(tag, source) for _, _, tag in added])
+                self.conn.execute('DELETE FROM tag_counts WHERE n <= 0')
+                self.conn.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)', (source, dataset, time.time()))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def get_tags(self, source, dataset):
+        with self.lock:
+            rows = self.conn.execute('SELECT tag FROM dataset_tags WHERE source = ? AND dataset = ? ORDER BY tag',
+                                     (source, dataset)).fetchall()
+        return [row['tag'] for row in rows]
+
+    def tag_frequencies(self, source=None):
+        with self.lock:
+            if source is None:
+                rows = self.conn.execute('SELECT tag, SUM(n) AS n FROM tag_counts GROUP BY tag').fetchall()
+            else:
+                rows = self.conn.execute('SELECT tag, n FROM tag_counts WHERE source = ?', (source,)).fetchall()
+        return {row['tag']: row['n'] for row in rows}
+
+    def top_tags(self, n_tags=100, source=None):
+        # [(tag, count)] most frequent first
+        with self.lock:
+            if source is None:
+                rows = self.conn.execute('SELECT tag, SUM(n) AS n FROM tag_counts GROUP BY tag ORDER BY n DESC, tag LIMIT ?',
+                                         (n_tags,)).fetchall()
+            else:
+                rows = self.conn.execute('SELECT tag, n FROM tag_counts WHERE source = ? ORDER BY n DESC, tag LIMIT ?',
+                                         (source, n_tags)).fetchall()
+        return [(row['tag'], row['n']) for row in rows]
+
+    def datasets_with_tag(self, tag, source=None):
+        # [(source, dataset)]
+        with self.lock:
+            if source is None:
+                rows = self.conn.execute('SELECT source, dataset FROM dataset_tags WHERE tag = ?', (tag,)).fetchall()
+            else:
+                rows = self.conn.execute('SELECT source, dataset FROM dataset_tags WHERE tag = ? AND source = ?',
+                                         (tag, source)).fetchall()
+        return [(row['source'], row['dataset']) for row in rows]
+
+    def iter_dataset_tags(self, source=None, batch_size=10000):
+        # yields (dataset, tags) for every tagged dataset of source (or (source, dataset) keys for all
+        # sources) in key order, reading batch_size rows at a time
+        query = 'SELECT source, dataset, tag FROM dataset_tags {0} ORDER BY source, dataset, tag'.format(
+            'WHERE source = ?' if source is not None else '')
+        with self.lock:
+            cursor = self.conn.execute(query, (source,) if source is not None else ())
+        key, tags = None, []
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                row_key = row['dataset'] if source is not None else (row['source'], row['dataset'])
+                if row_key != key:
+                    if tags:
+                        yield key, tags
+                    key, tags = row_key, []
+                tags.append(row['tag'])
+        if tags:
+            yield key, tags
+
+    def n_datasets(self, source=None, tagged=True):
+        table = 'dataset_tags' if tagged else 'datasets'
+        with self.lock:
+            if source is None:
+                row = self.conn.execute('SELECT COUNT(*) AS n FROM (SELECT DISTINCT source, dataset FROM {0})'.format(table)).fetchone()
+            else:
+                row = self.conn.execute('SELECT COUNT(DISTINCT dataset) AS n FROM {0} WHERE source = ?'.format(table),
+                                        (source,)).fetchone()
+        return row['n']
+
+    def close(self):
+        self.conn.close()
+
+
+def backfill_tag_index(base_dir, source, depth=1, exclude=()):
+    # load tags files written before the index existed, found through the folder index
+    tag_index = get_tag_index()
+    n_datasets = 0
+    for folder in get_folder_index().index(base_dir, depth=depth, exclude=exclude):
+        if folder['tags_file']:
+            tag_index.set_tags(source, os.path.relpath(folder['path'], base_dir), folder['tags'])
+            n_datasets += 1
+    print('indexed tags of', n_datasets, 'datasets from', base_dir)
+
+
+_indexes = {}
+
+
+def get_tag_index(db_path=TAG_INDEX_PATH):
+    # one connection per process, so pool workers can share the index file
+    key = (os.getpid(), db_path)
+    if key not in _indexes:
+        _indexes[key] = TagIndex(db_path)
+    return _indexes[key]
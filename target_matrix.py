@@ -0,0 +1,160 @@
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import read_json, write_json
+
+
+TARGET_DIR = 'target-matrix'
+TARGET_CHUNK_SIZE = 100000  # datasets factorized per step
+INDEX_DTYPE = np.int32
+INDPTR_DTYPE = np.int64  # on disk, so appends can pass 2**31 nonzeros
+
+# a target matrix directory holds raw arrays that memory-map straight into a csr matrix:
+#   indices.i32     column (tag) index of every nonzero, rows back to back
+#   indptr.i64      row start offsets into indices, n_rows + 1 of them
+#   tags.jsonl      the tag vocabulary, one json string per line; new tags only ever get appended,
+#                   so a tag keeps its column across runs
+#   dataset-ids.jsonl  the dataset of every row, in order
+#   meta.json       row, column and nonzero counts. written last, so anything past them on disk is
+#                   an interrupted append and gets ignored (and overwritten by the next one)
+INDICES_FILENAME = 'indices.i32'
+INDPTR_FILENAME = 'indptr.i64'
+TAGS_FILENAME = 'tags.jsonl'
+DATASET_IDS_FILENAME = 'dataset-ids.jsonl'
+META_FILENAME = 'meta.json'
+
+
+def read_jsonl(filename, n_lines):
+    values = []
+    if n_lines:
+        with open(filename) as jsonl_file:
+            for line in jsonl_file:
+                values.append(json.loads(line))
+                if len(values) == n_lines:
+                    break
+    return values
+
+
+def append_jsonl(filename, values, n_lines):
+    # append after the first n_lines, dropping whatever an interrupted append left behind
+    with open(filename, 'a+') as jsonl_file:
+        jsonl_file.seek(0)
+        for _ in range(n_lines):
+            jsonl_file.readline()
+        jsonl_file.truncate(jsonl_file.tell())
+        jsonl_file.writelines(json.dumps(value) + '\n' for value in values)
+
+
+def append_array(filename, values, n_values, dtype):
+    with open(filename, 'ab') as array_file:
+        array_file.truncate(n_values*np.dtype(dtype).itemsize)
+        array_file.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+
+def factorize_tags(tag_lists, tag_to_index, tags):
+    # (nonzeros per row, column index of each nonzero) for a chunk of tag lists. tags are factorized
+    # with one np.unique over the whole chunk, so the vocabulary lookup runs once per distinct tag
+    # instead of once per occurrence. unseen tags are appended to tags in sorted order
+    lengths = np.fromiter((len(tag_list) for tag_list in tag_lists), dtype=np.int64, count=len(tag_lists))
+    rows = np.repeat(np.arange(len(tag_lists), dtype=INDEX_DTYPE), lengths)
+    flat_tags = np.fromiter((tag for tag_list in tag_lists for tag in tag_list), dtype=object, count=lengths.sum())
+    if not len(flat_tags):
+        return np.zeros(len(tag_lists), dtype=np.int64), np.empty(0, dtype=INDEX_DTYPE)
+
+    unique_tags, inverse = np.unique(flat_tags, return_inverse=True)
+    unique_cols = np.empty(len(unique_tags), dtype=INDEX_DTYPE)
+    for ind, tag in enumerate(unique_tags):
+        if tag not in tag_to_index:
+            tag_to_index[tag] = len(tags)
+            tags.append(tag)
+        unique_cols[ind] = tag_to_index[tag]
+    cols = unique_cols[inverse.ravel()]
+
+    # sort each row's columns and drop repeated tags
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    keep = np.ones(len(cols), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return np.bincount(rows[keep], minlength=len(tag_lists)), cols[keep]
+
+
+class TargetMatrixWriter:
+    # builds the dataset x tag matrix chunk by chunk, appending rows to what is already on disk;
+    # datasets that already have a row are skipped
+
+    def __init__(self, target_dir, rebuild=False):
+        self.target_dir = target_dir
+        os.makedirs(target_dir, exist_ok=True)
+        meta_file = os.path.join(target_dir, META_FILENAME)
+        if rebuild or not os.path.isfile(meta_file):
+            self.meta = {'n_rows': 0, 'n_cols': 0, 'nnz': 0}
+            append_array(self.path(INDPTR_FILENAME), [0], 0, INDPTR_DTYPE)
+            self.save_meta()
+        else:
+            self.meta = read_json(meta_file)
+        self.tags = read_jsonl(self.path(TAGS_FILENAME), self.meta['n_cols'])
+        self.tag_to_index = {tag: ind for ind, tag in enumerate(self.tags)}
+        self.dataset_ids = set(read_jsonl(self.path(DATASET_IDS_FILENAME), self.meta['n_rows']))
+
+    def path(self, filename):
+        return os.path.join(self.target_dir, filename)
+
+    def add_chunk(self, dataset_tags):
+        # dataset_tags: [(dataset_id, tags)]
+        new = [(data_id, tags) for data_id, tags in dataset_tags if data_id not in self.dataset_ids]
+        if not new:
+            return 0
+        data_ids = [data_id for data_id, _ in new]
+        n_cols = len(self.tags)
+        row_nnz, cols = factorize_tags([tags for _, tags in new], self.tag_to_index, self.tags)
+        indptr = self.meta['nnz'] + np.cumsum(row_nnz)
+
+        append_array(self.path(INDICES_FILENAME), cols, self.meta['nnz'], INDEX_DTYPE)
+        append_array(self.path(INDPTR_FILENAME), indptr, self.meta['n_rows'] + 1, INDPTR_DTYPE)
+        append_jsonl(self.path(TAGS_FILENAME), self.tags[n_cols:], n_cols)
+        append_jsonl(self.path(DATASET_IDS_FILENAME), data_ids, self.meta['n_rows'])
+        self.dataset_ids.update(data_ids)
+        self.meta = {'n_rows': self.meta['n_rows'] + len(new), 'n_cols': len(self.tags), 'nnz': int(indptr[-1])}
+        self.save_meta()
+        return len(new)
+
+    def save_meta(self):
+        tmp_file = self.path(META_FILENAME + '.tmp')
+        write_json(self.meta, tmp_file)
+        os.replace(tmp_file, self.path(META_FILENAME))
+
+
+def write_target_matrix(dataset_tags, target_dir, chunk_size=TARGET_CHUNK_SIZE, rebuild=False):
+    # dataset_tags is any iterable of (dataset_id, tags), consumed chunk_size at a time
+    writer = TargetMatrixWriter(target_dir, rebuild=rebuild)
+    chunk = []
+    n_added = 0
+    for item in dataset_tags:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            n_added += writer.add_chunk(chunk)
+            chunk = []
+    n_added += writer.add_chunk(chunk)
+    print('added', n_added, 'rows, target matrix is now', writer.meta)
+    return writer.meta
+
+
+def load_target_matrix(target_dir, mmap_mode='r'):
+    # returns the csr matrix with its indices memory-mapped from disk, plus tags and dataset ids
+    meta = read_json(os.path.join(target_dir, META_FILENAME))
+    indices = np.memmap(os.path.join(target_dir, INDICES_FILENAME), dtype=INDEX_DTYPE, mode=mmap_mode,
+                        shape=(meta['nnz'],)) if meta['nnz'] else np.empty(0, dtype=INDEX_DTYPE)
+    indptr = np.fromfile(os.path.join(target_dir, INDPTR_FILENAME), dtype=INDPTR_DTYPE, count=meta['n_rows'] + 1)
+    if meta['nnz'] < np.iinfo(INDEX_DTYPE).max:
+        # scipy wants both index arrays in one dtype, and indices is the big one
+        indptr = indptr.astype(INDEX_DTYPE)
+    data = np.ones(meta['nnz'], dtype=bool)
+    target_matrix = sp.csr_matrix((data, indices, indptr), shape=(meta['n_rows'], meta['n_cols']), copy=False)
+    return {
+        'target_matrix': target_matrix,
+        'tags': read_jsonl(os.path.join(target_dir, TAGS_FILENAME), meta['n_cols']),
+        'dataset_ids': read_jsonl(os.path.join(target_dir, DATASET_IDS_FILENAME), meta['n_rows']),
+    }
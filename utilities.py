@@ -1,40 +1,33 @@
 import json
-import csv
-import xlrd
 
-from ckanapi import RemoteCKAN
+from health import probe_instances, report_health
+from normalize import iter_sheets, write_csv
 
 
 def get_timestamp():
     return datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
 
 
-def test_ckan_instances(instances_file='data/ckan/ckan-instances.json'):
+def test_ckan_instances(instances_file='ckan-instances.json', ttl=0):
+    # probes every instance concurrently with lightweight api calls instead of listing its catalog
     with open(instances_file) as json_file:
         instances = json.load(json_file)
 
-    problems = []
-    for ckan_url in instances:
-        instance = RemoteCKAN(ckan_url)
-        try:
-            datasets = instance.action.current_package_list_with_resources()
-            print('success:', ckan_url)
-        except Exception as err:
-            print('error:', err)
-            print('problem with instance, url:', ckan_url)
-            problems.append(ckan_url)
+    health = probe_instances(instances.values(), ttl=ttl)
+    report_health(health)
 
+    problems = [ckan_url for ckan_url, result in health.items() if not result['alive']]
     print('problem urls:', problems)
+    return health
 
 
-def excel_to_csv(excel_filename, csv_filename):
-    with xlrd.open_workbook(excel_filename) as workbook:
-        assert len(workbook.sheets) == 1
-        sh = workbook.sheet_by_index(0)
-        with open(csv_filename, 'w') as csv_file:
-            writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
-            for row in range(sh.nrows):
-                writer.writerow(sh.row_values(row))
+def excel_to_csv(excel_filename, csv_filename, sheet=0):
+    # one sheet (by index or name), streamed row by row; normalize.normalize_file converts every sheet
+    for ind, (sheet_name, _, rows) in enumerate(iter_sheets(excel_filename)):
+        if sheet in (ind, sheet_name):
+            write_csv(rows, csv_filename)
+            return
+    raise ValueError('no sheet {0} in {1}'.format(sheet, excel_filename))
 
 
 def strip_empty(to_strip):
@@ -65,6 +58,15 @@ def get_dataset_name(dataset, safe_chars=['-', '.', '_']):
     return name.replace('----', '-').replace('---', '-').replace('--', '-')
 
 
-def is_valid_resource(resource, formats=['xls', 'xlsx', 'csv']):
-    # TODO size limitation?
-    return resource['format'].lower() in formats  # and (resource['size'] > 0)
+def get_resource_size(resource):
+    # ckan's size field is often missing, empty or a string
+    try:
+        return int(resource.get('size'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_valid_resource(resource, formats=['xls', 'xlsx', 'csv'], max_size=None):
+    size = get_resource_size(resource)
+    too_large = max_size is not None and size is not None and size > max_size
+    return resource['format'].lower() in formats and not too_large
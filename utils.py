@@ -2,6 +2,7 @@ import time
 import os
 from datetime import datetime
 import json
+import sqlite3
 
 import numpy as np
 from inflection import underscore
@@ -32,6 +33,29 @@ def max_of_rows(vectors):
     return np.amax(vectors, axis=0)
 
 
+def ragged_starts(lengths):
+    # where each group starts in rows stacked back to back, for the groups that have any rows
+    return (np.cumsum(lengths) - lengths)[lengths > 0]
+
+
+def mean_of_ragged_rows(vectors, lengths):
+    # mean_of_rows for many groups at once: vectors holds each group's rows back to back, lengths
+    # says how many belong to each. empty groups get zeros
+    pooled = np.zeros((len(lengths), vectors.shape[1]), dtype=vectors.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        pooled[nonempty] = np.add.reduceat(vectors, ragged_starts(lengths), axis=0)/lengths[nonempty, None]
+    return pooled
+
+
+def max_of_ragged_rows(vectors, lengths):
+    pooled = np.zeros((len(lengths), vectors.shape[1]), dtype=vectors.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        pooled[nonempty] = np.maximum.reduceat(vectors, ragged_starts(lengths), axis=0)
+    return pooled
+
+
 def in_vocab(word_list, model):
     if isinstance(word_list, str):
         word_list = word_list.split(' ')
@@ -70,3 +94,16 @@ def read_json(fpath):
 def write_json(obj, fpath):
     with open(fpath, 'w') as json_file:
         json.dump(obj, json_file, indent=2)
+
+
+def open_db(db_path):
+    # sqlite connection shared between threads (callers serialize writes) and safe to open from
+    # several processes at once thanks to WAL mode and a generous busy timeout
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.isdir(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn